@@ -31,6 +31,8 @@ import gobject
 import dbus, dbus.service, dbus.mainloop.glib
 import locale
 
+gobject.threads_init() # for external.in_thread, before the main loop runs
+
 from configuration import conf, runtime, dialogs, load_ui_file
 
 import widgets, idle
@@ -245,7 +247,7 @@ class HamsterApplet(object):
 
 
         runtime.storage.connect('activities-changed', self.after_activity_update)
-        runtime.storage.connect('facts-changed', self.after_fact_update)
+        runtime.storage.connect('fact-changes', self.after_fact_changes)
         runtime.storage.connect('toggle-called', self.on_toggle_called)
 
         self.screen = None
@@ -560,6 +562,17 @@ class HamsterApplet(object):
         self.load_day()
         self.update_label()
 
+    def after_fact_changes(self, storage, sequence, fact_ids, start_date, end_date):
+        # skip changes of other days, unless they touch what we are showing
+        if start_date:
+            day_start = conf.get("day_start_minutes")
+            today = (dt.datetime.now() - dt.timedelta(minutes = day_start)).date()
+            shown = set(fact.id for fact in self.todays_facts or [])
+            if not start_date <= today <= end_date and not shown.intersection(fact_ids):
+                return
+
+        self.after_fact_update(storage)
+
     def on_idle_changed(self, event, state):
         # state values: 0 = active, 1 = idle
 
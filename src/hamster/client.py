@@ -19,11 +19,13 @@
 # along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os, mmap, time, bisect, itertools
+import logging
 import datetime as dt
 from calendar import timegm
 import dbus, dbus.mainloop.glib
 import gobject
-from lib import stuff, trophies
+from lib import stuff, trophies, factpack
 
 
 
@@ -42,12 +44,172 @@ def from_dbus_fact(fact):
             id = fact[0]
             )
 
+class LocalCache(object):
+    """Facts and lookups the client has fetched lately. Facts are kept by
+       the days they cover and dropped as changes to these days or to their
+       activities come in. Lists with ongoing facts expire after a while, as
+       their duration grows"""
+    def __init__(self, size = 20, ongoing_ttl = 60):
+        self.size = size
+        self.ongoing_ttl = ongoing_ttl
+        self.facts = {} # key -> [first day, last day, facts, expiry time, tick of last use]
+        self.lookups = {} # (kind, params) -> result
+        self.tick = 0
+        self.hits, self.misses = 0, 0
+
+    def get_facts(self, key):
+        entry = self.facts.get(key)
+        if entry and entry[3] and entry[3] < time.time():
+            del self.facts[key]
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.tick += 1
+        entry[4] = self.tick
+        return list(entry[2])
+
+    def put_facts(self, key, first_day, last_day, facts):
+        if key not in self.facts and len(self.facts) >= self.size:
+            oldest = min(self.facts, key = lambda key: self.facts[key][4])
+            del self.facts[oldest]
+
+        expires = None
+        if any(fact.end_time is None for fact in facts):
+            expires = time.time() + self.ongoing_ttl
+
+        self.tick += 1
+        self.facts[key] = [first_day, last_day, list(facts), expires, self.tick]
+
+    def get_lookup(self, kind, params):
+        if (kind, params) not in self.lookups:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return list(self.lookups[(kind, params)])
+
+    def put_lookup(self, kind, params, result):
+        self.lookups[(kind, params)] = list(result)
+
+    def drop_facts(self, first_day = None, last_day = None, activity_ids = None):
+        """drops facts of any of the given days or activities, or all of
+           them if neither is given"""
+        if first_day is None and activity_ids is None:
+            self.facts = {}
+            return
+
+        activity_ids = set(activity_ids or [])
+        for key, entry in self.facts.items():
+            if first_day is not None and entry[0] <= last_day and entry[1] >= first_day \
+               or any(fact.activity_id in activity_ids for fact in entry[2]):
+                del self.facts[key]
+
+    def drop_lookups(self, *kinds):
+        for kind, params in self.lookups.keys():
+            if kind in kinds:
+                del self.lookups[(kind, params)]
+
+    def clear(self):
+        self.facts, self.lookups = {}, {}
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"cached_ranges": len(self.facts),
+                "cached_lookups": len(self.lookups),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / total if total else 0.0}
+
+
+class TagVocabulary(object):
+    """All the tags with the number of facts each is on. The tags are kept
+       sorted by lowercase name for prefix lookups. They are fetched once,
+       after that only the tags that the tag-changes signal names are
+       fetched again."""
+    def __init__(self, storage):
+        self.storage = storage
+        self.tags = None # id -> (name, autocomplete, uses)
+        self.index = [] # (lowercase name, id), sorted
+        storage.connect("tag-changes", self._on_tag_changes)
+
+    def _load(self):
+        if self.tags is None:
+            self.tags, self.index = {}, []
+            self._apply([], self.storage.conn.GetTagUsage([]))
+
+    def _apply(self, tag_ids, rows):
+        """puts in the fetched rows, drops the asked for ids that are gone"""
+        if self.tags is None:
+            return # will be loaded in full anyway
+
+        for tag_id in set(tag_ids) | set(row[0] for row in rows):
+            if tag_id in self.tags:
+                self.index.remove((self.tags.pop(tag_id)[0].lower(), tag_id))
+
+        for tag_id, name, autocomplete, uses in rows:
+            self.tags[tag_id] = (unicode(name), bool(autocomplete), int(uses))
+            bisect.insort(self.index, (name.lower(), tag_id))
+
+    def _on_tag_changes(self, storage, sequence, tag_ids):
+        if not tag_ids:
+            self.clear() # anything might have changed
+        elif self.tags is not None:
+            self.storage._call_async("GetTagUsage", (tag_ids,), lambda rows: rows,
+                                     lambda rows: self._apply(tag_ids, rows))
+
+    def clear(self):
+        self.tags, self.index = None, []
+
+    def get_tags(self, only_autocomplete = True):
+        """tag names sorted by name"""
+        self._load()
+        return [self.tags[tag_id][0] for key, tag_id in self.index
+                    if self.tags[tag_id][1] or not only_autocomplete]
+
+    def find(self, prefix, only_autocomplete = True):
+        """tag names starting with prefix, the most used first"""
+        self._load()
+        prefix = prefix.lower()
+        found = []
+        for key, tag_id in itertools.islice(self.index, bisect.bisect_left(self.index, (prefix,)), None):
+            if not key.startswith(prefix):
+                break
+            name, autocomplete, uses = self.tags[tag_id]
+            if autocomplete or not only_autocomplete:
+                found.append((-uses, key, name))
+        return [name for uses, key, name in sorted(found)]
+
+
+class Request(object):
+    """A call to the storage that is on its way. Cancel it when the result is
+       not needed anymore, say when a newer search has superseded it, and the
+       callbacks will not be called"""
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
 class Storage(gobject.GObject):
     """Hamster client class, communicating to hamster storage daemon via d-bus.
        Subscribe to the `tags-changed`, `facts-changed` and `activities-changed`
        signals to be notified when an appropriate factoid of interest has been
+       changed. The `tag-changes`, `fact-changes` and `activity-changes`
+       signals tell also what has changed, along with the change sequence
+       number that can be passed to get_changes_since later.
+
+       With cache set, facts, activities, categories and tags that have been
+       fetched are kept around until the service tells that they have
        changed.
 
+       The *_async variants of the getters return right away and pass the
+       result to the callback once it arrives, keeping the main loop going.
+
        In storage a distinguishment is made between the classificator of
        activities and the event in tracking log.
        When talking about the event we use term 'fact'. For the classificator
@@ -60,20 +222,37 @@ class Storage(gobject.GObject):
         "facts-changed": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
         "activities-changed": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
         "toggle-called": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+
+        # sequence, changed ids and the date range of the changed facts.
+        # no ids and no dates means that everything might have changed
+        "tag-changes": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                        (gobject.TYPE_UINT64, gobject.TYPE_PYOBJECT)),
+        "fact-changes": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                         (gobject.TYPE_UINT64, gobject.TYPE_PYOBJECT,
+                          gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT)),
+        "activity-changes": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                             (gobject.TYPE_UINT64, gobject.TYPE_PYOBJECT,
+                              gobject.TYPE_PYOBJECT)),
     }
 
-    def __init__(self):
+    def __init__(self, cache = False):
         gobject.GObject.__init__(self)
 
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
         self.bus = dbus.SessionBus()
         self._connection = None # will be initiated on demand
+        self._cache = LocalCache() if cache else None
+        self._tag_vocabulary = None # made on demand
 
         self.bus.add_signal_receiver(self._on_tags_changed, 'TagsChanged', 'org.gnome.Hamster')
         self.bus.add_signal_receiver(self._on_facts_changed, 'FactsChanged', 'org.gnome.Hamster')
         self.bus.add_signal_receiver(self._on_activities_changed, 'ActivitiesChanged', 'org.gnome.Hamster')
         self.bus.add_signal_receiver(self._on_toggle_called, 'ToggleCalled', 'org.gnome.Hamster')
 
+        self.bus.add_signal_receiver(self._on_tag_changes, 'TagChanges', 'org.gnome.Hamster')
+        self.bus.add_signal_receiver(self._on_fact_changes, 'FactChanges', 'org.gnome.Hamster')
+        self.bus.add_signal_receiver(self._on_activity_changes, 'ActivityChanges', 'org.gnome.Hamster')
+
         self.bus.add_signal_receiver(self._on_dbus_connection_change, 'NameOwnerChanged',
                                      'org.freedesktop.DBus', arg0='org.gnome.Hamster')
     @staticmethod
@@ -90,6 +269,10 @@ class Storage(gobject.GObject):
 
     def _on_dbus_connection_change(self, name, old, new):
         self._connection = None
+        if self._cache:
+            self._cache.clear() # might have missed changes
+        if self._tag_vocabulary:
+            self._tag_vocabulary.clear()
 
     def _on_tags_changed(self):
         self.emit("tags-changed")
@@ -103,10 +286,76 @@ class Storage(gobject.GObject):
     def _on_toggle_called(self):
         self.emit("toggle-called")
 
+    @staticmethod
+    def _date_range(start_date, end_date):
+        if not start_date and not end_date:
+            return None, None
+        return (dt.datetime.utcfromtimestamp(start_date).date(),
+                dt.datetime.utcfromtimestamp(end_date).date())
+
+    def _on_tag_changes(self, sequence, tag_ids):
+        if self._cache:
+            # tag names of facts do not change
+            self._cache.drop_lookups("tags")
+        self.emit("tag-changes", sequence, list(tag_ids))
+
+    def _on_fact_changes(self, sequence, fact_ids, start_date, end_date):
+        start_date, end_date = self._date_range(start_date, end_date)
+        if self._cache:
+            self._cache.drop_facts(start_date, end_date)
+            self._cache.drop_lookups("activities") # sorted by last use
+        self.emit("fact-changes", sequence, list(fact_ids), start_date, end_date)
+
+    def _on_activity_changes(self, sequence, activity_ids, category_ids):
+        if self._cache:
+            self._cache.drop_lookups("activities", "categories")
+            if category_ids or not activity_ids:
+                self._cache.drop_facts()
+            else:
+                self._cache.drop_facts(activity_ids = activity_ids)
+        self.emit("activity-changes", sequence, list(activity_ids), list(category_ids))
+
+    def _changing(self, *kinds):
+        """drops what our own write is about to change, as the signals
+           telling so will arrive only later"""
+        if self._cache:
+            if "facts" in kinds:
+                self._cache.drop_facts()
+            self._cache.drop_lookups(*kinds)
+
     def toggle(self):
         """toggle visibility of the main application window if any"""
         self.conn.Toggle()
 
+    def get_cache_stats(self):
+        """returns dictionary of the storage cache counters and hit rates"""
+        return dict(self.conn.GetCacheStats())
+
+    def get_local_cache_stats(self):
+        """returns dictionary of the counters and hit rate of the local cache,
+           empty if there is none"""
+        return self._cache.stats() if self._cache else {}
+
+    def get_changes_since(self, sequence):
+        """returns dictionary of what has changed after the given change
+           sequence number: fact ids and the date range of the changed facts,
+           activity, category and tag ids. if complete is false, the changes
+           do not go back that far and everything should be reloaded.
+           fact_ids is empty when there are too many, reload the range then.
+        """
+        (sequence, complete, fact_ids, start_date, end_date,
+         activity_ids, category_ids, tag_ids) = self.conn.GetChangesSince(sequence)
+
+        start_date, end_date = self._date_range(start_date, end_date)
+        return {"sequence": sequence,
+                "complete": bool(complete),
+                "fact_ids": list(fact_ids),
+                "start_date": start_date,
+                "end_date": end_date,
+                "activity_ids": list(activity_ids),
+                "category_ids": list(category_ids),
+                "tag_ids": list(tag_ids)}
+
     def get_todays_facts(self):
         """returns facts of the current date, respecting hamster midnight
            hamster midnight is stored in gconf, and presented in minutes
@@ -119,29 +368,228 @@ class Storage(gobject.GObject):
            to boolean AND.
            Filter is applied to tags, categories, activity names and description
         """
-        date = timegm(date.timetuple())
-        end_date = end_date or 0
-        if end_date:
-            end_date = timegm(end_date.timetuple())
+        facts = self._cached_facts(date, end_date, search_terms)
+        if facts is None:
+            dbus_date, dbus_end_date = self._dbus_range(date, end_date)
+            facts = self._received_facts(self.conn.GetFacts(dbus_date, dbus_end_date, search_terms),
+                                         date, end_date, search_terms)
+        return facts
+
+    def get_facts_async(self, callback, date, end_date = None, search_terms = "",
+                        error_callback = None):
+        """Same as get_facts, but passes the facts to callback once they
+           arrive. Returns the Request"""
+        facts = self._cached_facts(date, end_date, search_terms)
+        if facts is not None:
+            return self._reply_later(callback, facts)
+
+        dbus_date, dbus_end_date = self._dbus_range(date, end_date)
+        return self._call_async("GetFacts", (dbus_date, dbus_end_date, search_terms),
+                                lambda facts: self._received_facts(facts, date, end_date, search_terms),
+                                callback, error_callback)
+
+    def _cached_facts(self, date, end_date, search_terms):
+        if self._cache:
+            return self._cache.get_facts((date, end_date, search_terms))
+        return None
+
+    def _received_facts(self, dbus_facts, date, end_date, search_terms):
+        facts = [from_dbus_fact(fact) for fact in dbus_facts]
+        if self._cache:
+            # ongoing facts of the day before might show up too
+            first_day, last_day = date, end_date or date
+            if isinstance(first_day, dt.datetime):
+                first_day = first_day.date()
+            if isinstance(last_day, dt.datetime):
+                last_day = last_day.date()
+            self._cache.put_facts((date, end_date, search_terms),
+                                  first_day - dt.timedelta(days = 1), last_day, facts)
+        return facts
+
+    def iter_facts(self, date, end_date = None, search_terms = "", page_size = 500):
+        """Same as get_facts, but fetches the facts page by page, as they
+           are consumed. Good for long time spans.
+        """
+        date, end_date = self._dbus_range(date, end_date)
+
+        cursor = ""
+        while True:
+            facts, cursor = self.conn.GetFactsPage(date, end_date, search_terms,
+                                                   cursor, page_size)
+            for fact in facts:
+                yield from_dbus_fact(fact)
+
+            if not cursor:
+                break
+
+    def get_facts_packed(self, date, end_date = None, search_terms = ""):
+        """Same as get_facts, but the facts are handed over in a file and
+           decoded as they are accessed. Use for large exports and
+           statistics. Returns a read-only sequence.
+        """
+        date, end_date = self._dbus_range(date, end_date)
+
+        fd = self.conn.GetFactsFd(date, end_date, search_terms).take()
+        try:
+            packed = mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
+        finally:
+            os.close(fd) # the map holds on to the file
+
+        return factpack.FactReader(packed, from_dbus_fact)
+
+    def get_totals(self, date, end_date = None, group_by = "category",
+                   search_terms = "", categories = None, activities = None, tags = None):
+        """Returns time spent in the time span as list of (key, duration,
+           fact count) tuples, summed up by the storage. group_by is one of
+           category, activity, tag, day (key is date) or weekday (key is
+           number, monday is 0).
+           Facts can be limited by search terms as in get_facts, and to the
+           given categories and activities, and facts that have all the given
+           tags.
+        """
+        date, end_date = self._dbus_range(date, end_date)
+        totals = self.conn.GetTotals(date, end_date, group_by, search_terms,
+                                     categories or [], activities or [], tags or [])
+        return self._to_totals(totals, group_by)
+
+    def get_totals_async(self, callback, date, end_date = None, group_by = "category",
+                         search_terms = "", categories = None, activities = None, tags = None,
+                         error_callback = None):
+        """Same as get_totals, but passes the totals to callback once they
+           arrive. Returns the Request"""
+        date, end_date = self._dbus_range(date, end_date)
+        return self._call_async("GetTotals",
+                                (date, end_date, group_by, search_terms,
+                                 categories or [], activities or [], tags or []),
+                                lambda totals: self._to_totals(totals, group_by),
+                                callback, error_callback)
 
-        return [from_dbus_fact(fact) for fact in self.conn.GetFacts(date,
-                                                                    end_date,
-                                                                    search_terms)]
+    @staticmethod
+    def _to_totals(totals, group_by):
+        res = []
+        for key, duration, count in totals:
+            if group_by == "day":
+                key = dt.datetime.strptime(key, "%Y-%m-%d").date()
+            elif group_by == "weekday":
+                key = (int(key) + 6) % 7
+            res.append((key, dt.timedelta(seconds = duration), count))
+        return res
 
     def get_activities(self, search = ""):
         """returns list of activities name matching search criteria.
            results are sorted by most recent usage.
            search is case insensitive
         """
-        return self._to_dict(('name', 'category'), self.conn.GetActivities(search))
+        return self._lookup("activities", (search,),
+                            lambda: self._to_dict(('name', 'category'), self.conn.GetActivities(search)))
 
     def get_categories(self):
         """returns list of categories"""
-        return self._to_dict(('id', 'name'), self.conn.GetCategories())
+        return self._lookup("categories", (),
+                            lambda: self._to_dict(('id', 'name'), self.conn.GetCategories()))
 
     def get_tags(self, only_autocomplete = False):
         """returns list of all tags. by default only those that have been set for autocomplete"""
-        return self._to_dict(('id', 'name', 'autocomplete'), self.conn.GetTags(only_autocomplete))
+        return self._lookup("tags", (only_autocomplete,),
+                            lambda: self._to_dict(('id', 'name', 'autocomplete'), self.conn.GetTags(only_autocomplete)))
+
+    def get_tag_vocabulary(self):
+        """returns the TagVocabulary shared by everyone using this storage"""
+        if not self._tag_vocabulary:
+            self._tag_vocabulary = TagVocabulary(self)
+        return self._tag_vocabulary
+
+    def get_activities_async(self, callback, search = "", error_callback = None):
+        """Same as get_activities, but passes the activities to callback once
+           they arrive. Returns the Request"""
+        return self._lookup_async("activities", (search,), "GetActivities", (search,),
+                                  lambda res: self._to_dict(('name', 'category'), res),
+                                  callback, error_callback)
+
+    def get_categories_async(self, callback, error_callback = None):
+        """Same as get_categories, but passes the categories to callback once
+           they arrive. Returns the Request"""
+        return self._lookup_async("categories", (), "GetCategories", (),
+                                  lambda res: self._to_dict(('id', 'name'), res),
+                                  callback, error_callback)
+
+    def get_matches(self, search, kind = "", limit = 10):
+        """returns activities and categories with names like the search,
+           also when partly typed or misspelt, best first. kind is
+           "activity" or "category" to look for just these. categories come
+           with empty activity name"""
+        return self._to_dict(('kind', 'name', 'category', 'score'),
+                             self.conn.GetMatches(search, kind, limit))
+
+    def get_matches_async(self, callback, search, kind = "", limit = 10, error_callback = None):
+        """Same as get_matches, but passes the matches to callback once
+           they arrive. Returns the Request"""
+        return self._call_async("GetMatches", (search, kind, limit),
+                                lambda res: self._to_dict(('kind', 'name', 'category', 'score'), res),
+                                callback, error_callback)
+
+    def _lookup(self, kind, params, fetch):
+        if not self._cache:
+            return fetch()
+
+        res = self._cache.get_lookup(kind, params)
+        if res is None:
+            res = fetch()
+            self._cache.put_lookup(kind, params, res)
+        return res
+
+    def _lookup_async(self, kind, params, method, args, convert, callback, error_callback):
+        if self._cache:
+            res = self._cache.get_lookup(kind, params)
+            if res is not None:
+                return self._reply_later(callback, res)
+
+        def received(res):
+            res = convert(res)
+            if self._cache:
+                self._cache.put_lookup(kind, params, res)
+            return res
+
+        return self._call_async(method, args, received, callback, error_callback)
+
+    @staticmethod
+    def _dbus_range(date, end_date):
+        """dates in seconds since epoch, end date is 0 when not given"""
+        return timegm(date.timetuple()), timegm(end_date.timetuple()) if end_date else 0
+
+    def _call_async(self, method, args, convert, callback, error_callback = None):
+        """calls the storage method without waiting for the reply, which is
+           passed through convert to callback, unless the request has been
+           cancelled by then. errors go to error_callback, or to the log"""
+        request = Request()
+
+        def on_reply(*res):
+            if not request.cancelled:
+                callback(convert(*res))
+
+        def on_error(error):
+            if request.cancelled:
+                return
+            if error_callback:
+                error_callback(error)
+            else:
+                logging.warn("%s failed: %s" % (method, error))
+
+        getattr(self.conn, method)(*args, reply_handler = on_reply, error_handler = on_error)
+        return request
+
+    def _reply_later(self, callback, result):
+        """passes the cached result to callback from the main loop, as if it
+           had come from the storage"""
+        request = Request()
+
+        def reply():
+            if not request.cancelled:
+                callback(result)
+            return False
+
+        gobject.idle_add(reply)
+        return request
 
 
     def get_tag_ids(self, tags):
@@ -151,13 +599,39 @@ class Storage(gobject.GObject):
            be created.
            on database changes the `tags-changed` signal is emitted.
         """
+        self._changing("tags")
         return self._to_dict(('id', 'name', 'autocomplete'), self.conn.GetTagIds(tags))
 
     def update_autocomplete_tags(self, tags):
         """update list of tags that should autocomplete. this list replaces
            anything that is currently set"""
+        self._changing("tags")
         self.conn.SetTagsAutocomplete(tags)
 
+    def batch(self, operations):
+        """runs a list of (method name, arguments) operations in one call and
+           one transaction. methods and arguments are the ones of the d-bus
+           interface, see Batch in storage. returns list of their results.
+           if any of the operations fails, none of them is applied and the
+           exception is raised"""
+        self._changing("facts", "activities", "categories", "tags")
+        return list(self.conn.Batch(operations))
+
+    def import_facts(self, path, format = ""):
+        """imports facts from a TSV, XML or iCal export. format is guessed
+           from the file extension if not given. returns the number of
+           imported and skipped facts"""
+        self._changing("facts", "activities", "categories", "tags")
+        imported, skipped = self.conn.ImportFacts(os.path.abspath(path), format,
+                                                  timeout = 3600)
+        return int(imported), int(skipped)
+
+    def repair_overlaps(self):
+        """sorts out all the overlapping facts in one go. returns the number
+           of overlaps found"""
+        self._changing("facts")
+        return int(self.conn.RepairOverlaps(timeout = 3600))
+
     def get_fact(self, id):
         """returns fact by it's ID"""
         return from_dbus_fact(self.conn.GetFact(id))
@@ -180,6 +654,7 @@ class Storage(gobject.GObject):
         if end_timestamp:
             end_timestamp = timegm(end_timestamp.timetuple())
 
+        self._changing("facts", "activities", "categories", "tags")
         new_id = self.conn.AddFact(serialized,
                                    start_timestamp,
                                    end_timestamp,
@@ -195,10 +670,12 @@ class Storage(gobject.GObject):
         """Stop tracking current activity. end_time can be passed in if the
         activity should have other end time than the current moment"""
         end_time = timegm((end_time or dt.datetime.now()).timetuple())
+        self._changing("facts", "activities")
         return self.conn.StopTracking(end_time)
 
     def remove_fact(self, fact_id):
         "delete fact from database"
+        self._changing("facts", "activities")
         self.conn.RemoveFact(fact_id)
 
     def update_fact(self, fact_id, fact, temporary_activity = False):
@@ -214,6 +691,7 @@ class Storage(gobject.GObject):
         if end_time:
             end_time = timegm(end_time.timetuple())
 
+        self._changing("facts", "activities", "categories", "tags")
         new_id =  self.conn.UpdateFact(fact_id,
                                        fact.serialized_name(),
                                        start_time,
@@ -240,26 +718,35 @@ class Storage(gobject.GObject):
            unless told otherwise in the resurrect param
         """
         category_id = category_id or 0
+        if resurrect:
+            self._changing("activities")
         return self.conn.GetActivityByName(activity, category_id, resurrect)
 
     # category and activity manipulations (normally just via preferences)
     def remove_activity(self, id):
+        self._changing("facts", "activities", "categories")
         self.conn.RemoveActivity(id)
 
     def remove_category(self, id):
+        self._changing("facts", "activities", "categories")
         self.conn.RemoveCategory(id)
 
     def change_category(self, id, category_id):
+        self._changing("facts", "activities", "categories")
         return self.conn.ChangeCategory(id, category_id)
 
     def update_activity(self, id, name, category_id):
+        self._changing("facts", "activities", "categories")
         return self.conn.UpdateActivity(id, name, category_id)
 
     def add_activity(self, name, category_id = -1):
+        self._changing("facts", "activities", "categories")
         return self.conn.AddActivity(name, category_id)
 
     def update_category(self, id, name):
+        self._changing("facts", "activities", "categories")
         return self.conn.UpdateCategory(id, name)
 
     def add_category(self, name):
+        self._changing("facts", "activities", "categories")
         return self.conn.AddCategory(name)
@@ -66,7 +66,7 @@ class RuntimeStore(Singleton):
         self.data_dir = os.path.realpath(self.data_dir)
 
 
-        self.storage = Storage()
+        self.storage = Storage(cache = True)
 
 
         self.home_data_dir = os.path.realpath(os.path.join(xdg_data_home, "hamster-applet"))
@@ -175,8 +175,17 @@ class GConfStore(gobject.GObject, Singleton):
         'workspace_mapping'           :   [],          # Mapping between workspace numbers and activities
         'standalone_window_box'       :   [],          # X, Y, W, H
         'standalone_window_maximized' :   False,       # Is overview window maximized
-        'activities_source'           :   "",          # Source of TODO items ("", "evo", "gtg")
+        'activities_source'           :   "",          # Source of TODO items ("", "evo", "gtg", "mock" for testing)
+        'activities_source_seconds'   :   60,          # How long to keep the TODO items before asking again
         'last_report_folder'          :   "~",         # Path to directory where the last report was saved
+        'db_cache_kilobytes'          :   8 * 1024,    # Size of the SQLite page cache
+        'db_mmap_kilobytes'           :   64 * 1024,   # How much of the database file SQLite may memory-map
+        'db_synchronous'              :   "normal",    # SQLite synchronous level ("off", "normal", "full")
+        'db_statement_cache'          :   100,         # How many prepared statements to keep around
+        'db_result_cache'             :   20,          # How many fact query results to keep around
+        'db_read_threads'             :   2,           # Threads answering the fact queries, 0 for none
+        'change_signal_milliseconds'  :   100,         # How long to gather changes before telling the clients
+        'db_merge_replaced'           :   True,        # Signal only what differs when the database file gets replaced
     }
 
     __gsignals__ = {
@@ -33,15 +33,308 @@ except ImportError:
         raise
 
 import os, time
+import threading, Queue
+import bisect, heapq
 import datetime
 import storage
 from shutil import copy as copyfile
-import itertools
+from calendar import timegm
 import datetime as dt
-import gio
+import gio, gobject
 from xdg.BaseDirectory import xdg_data_home
 
-from lib import stuff, trophies
+from lib import stuff, trophies, trigrams
+
+# tags of a fact are packed in a single column, separated by the unit separator
+TAG_SEPARATOR = u"\x1f"
+FACT_TAGS = """(SELECT group_concat(e.name, '%s')
+                  FROM fact_tags d
+                  JOIN tags e ON e.id = d.tag_id
+                 WHERE d.fact_id = a.id)""" % TAG_SEPARATOR
+
+# the "hamster day" of a fact, shifted by day_start_minutes. facts spanning
+# over the hamster midnight belong to the day that got most of the fact.
+# stored in seconds since epoch at the midnight of the day
+FACT_DATE = """
+    CASE WHEN %(end)s IS NOT NULL
+              AND (%(end)s - %(shift)s) / 86400 - (%(start)s - %(shift)s) / 86400 = 1
+              AND 2 * ((%(end)s - %(shift)s) / 86400 * 86400 + %(shift)s) <= %(start)s + %(end)s
+         THEN (%(end)s - %(shift)s) / 86400 * 86400
+         ELSE (%(start)s - %(shift)s) / 86400 * 86400
+    END""" % {"shift": "(SELECT value * 60 FROM settings WHERE name = 'day_start_minutes')",
+              "start": "%(prefix)sstart_time",
+              "end": "%(prefix)send_time"}
+
+# what the totals can be grouped by: key column and the extra joins it needs
+# when summing up facts. days are keyed by the epoch, weekdays by number,
+# 1970-01-01 being a thursday
+TOTALS_GROUPS = {
+    "category": ("coalesce(c.name, ?)", ""),
+    "activity": ("coalesce(b.name, '')", ""),
+    "tag": ("e.name", """JOIN fact_tags d ON d.fact_id = a.id
+                         JOIN tags e ON e.id = d.tag_id"""),
+    "day": ("%(day)s", ""),
+    "weekday": ("(%(day)s / 86400 + 4) %% 7", ""),
+}
+
+# first day of the month of the given date in seconds since epoch
+MONTH_START = "CAST(strftime('%%s', %s, 'unixepoch', 'start of month') AS integer)"
+
+# durations and counts of finished facts per hamster day and month, by
+# activity and by tag. kept up to date by triggers, these are the queries to
+# build them anew
+ROLLUP_PERIODS = (("days", "day", "%s"),
+                  ("months", "month", MONTH_START))
+
+ACTIVITY_ROLLUP = """SELECT %(period)s, activity_id, sum(end_time - start_time), count(*)
+                       FROM facts
+                      WHERE end_time IS NOT NULL %(where)s
+                   GROUP BY 1, 2"""
+TAG_ROLLUP = """SELECT %(period)s, d.tag_id, sum(a.end_time - a.start_time), count(*)
+                  FROM facts a
+                  JOIN fact_tags d ON d.fact_id = a.id
+                 WHERE a.end_time IS NOT NULL %(where)s
+              GROUP BY 1, 2"""
+
+# table -> query of the whole rollup. the period rollups are limited to the
+# days listed in the temp.changed_days table and the months they fall in
+ROLLUPS, PERIOD_ROLLUPS = {}, {}
+for suffix, column, period in ROLLUP_PERIODS:
+    for table, query, fact_date in (("activity_", ACTIVITY_ROLLUP, "fact_date"),
+                                    ("tag_", TAG_ROLLUP, "a.fact_date")):
+        periods = "SELECT DISTINCT %s FROM temp.changed_days" % (period % "day")
+        where = "AND %s IN (%s)" % (period % fact_date, periods)
+        ROLLUPS[table + suffix] = query % {"period": period % fact_date, "where": ""}
+        PERIOD_ROLLUPS[table + suffix] = (column, periods,
+                                          query % {"period": period % fact_date, "where": where})
+
+# rows of the full text index
+FACT_INDEX_ROWS = """SELECT a.id, a.id, b.name, c.name, a.description,
+                            (SELECT group_concat(e.name, ' ')
+                               FROM fact_tags d
+                               JOIN tags e ON e.id = d.tag_id
+                              WHERE d.fact_id = a.id)
+                       FROM facts a
+                  LEFT JOIN activities b ON a.activity_id = b.id
+                  LEFT JOIN categories c ON b.category_id = c.id"""
+
+# what is compared to tell what a replaced database file has changed
+SNAPSHOT_FACTS = """SELECT id, fact_date, start_time, end_time, activity_id, description,
+                           (SELECT group_concat(tag_id) FROM fact_tags WHERE fact_id = facts.id)
+                      FROM facts"""
+SNAPSHOT_TABLES = {"activity": "SELECT id, name, category_id, deleted FROM activities",
+                   "category": "SELECT id, name FROM categories",
+                   "tag": "SELECT id, name, autocomplete, uses FROM tags"}
+
+# the change log keeps this many entries for GetChangesSince. changed fact
+# ids are sent along only up to a limit, past that it's just the date range
+CHANGES_KEPT = 10000
+MAX_CHANGED_FACTS = 1000
+
+# imported facts go in with executemany, this many at a time
+IMPORT_CHUNK = 5000
+
+# facts are indexed by their span in an r*tree, ongoing ones reach till here.
+# the r*tree keeps 32 bit floats rounded outwards, so what it finds has to
+# be checked against the facts
+SPAN_END = 2 ** 32
+FACT_SPAN = {"start": "min(%(row)sstart_time, coalesce(%(row)send_time, %(row)sstart_time))",
+             "end": "coalesce(max(%(row)sstart_time, %(row)send_time), " + str(SPAN_END) + ")"}
+
+# when putting in an ongoing fact, a fact starting this soon after it
+# gives it the end time
+SQUEEZE_LOOKAHEAD = dt.timedelta(hours = 12)
+
+# how many activities are suggested for autocomplete
+ACTIVITY_SUGGESTIONS = 50
+
+# fact tuples as returned by __get_fact_rows
+FACT_KEYS = ("id", "start_time", "end_time", "description", "name",
+             "activity_id", "category", "tags", "date", "delta")
+
+
+def to_epoch(time):
+    """seconds since epoch of the date or naive datetime, without any
+       timezone conversion - same as what goes over d-bus"""
+    return timegm(time.timetuple())
+
+def from_epoch(seconds):
+    if seconds is None:
+        return None
+    return dt.datetime.utcfromtimestamp(seconds)
+
+# times are stored in seconds since epoch
+sqlite.register_adapter(dt.datetime, to_epoch)
+sqlite.register_adapter(dt.date, to_epoch)
+
+
+class StatementCache(object):
+    """Keeps count of the statement cache of the sqlite connection.
+       The sqlite module reuses prepared statements in a LRU keyed by the SQL
+       text, we follow the same bookkeeping to know how often it gets hit.
+       sqlite3 does not tell its own numbers, so these are estimates - they
+       can drift from what it does, for one as the statements of cursors
+       that are still open are not reused"""
+    def __init__(self, size):
+        self.size = size
+        self.statements = {} # statement -> tick of last use
+        self.tick = 0
+        self.hits, self.misses = 0, 0
+
+    def touch(self, statement):
+        self.tick += 1
+        if statement in self.statements:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if len(self.statements) >= self.size:
+                oldest = min(self.statements, key = self.statements.get)
+                del self.statements[oldest]
+        self.statements[statement] = self.tick
+
+    def clear(self):
+        self.statements = {}
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"statement_cache_size": len(self.statements),
+                "statement_hits": self.hits,
+                "statement_misses": self.misses,
+                "statement_hit_rate": float(self.hits) / total if total else 0.0}
+
+
+class ResultCache(object):
+    """Fact rows as they come from the database, kept until a change touches
+       the days they cover or the activities they are of. Entries that have
+       not been used for the longest make way for new ones"""
+    def __init__(self, size):
+        self.size = size
+        self.entries = {} # key -> [first day, last day, result, tick of last use]
+        self.tick = 0
+        self.hits, self.misses, self.invalidations = 0, 0, 0
+
+        # the readers use the cache too. generation goes up with every
+        # invalidation, so that results queried before it do not get in
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.tick += 1
+            entry[3] = self.tick
+            return entry[2]
+
+    def put(self, key, first_day, last_day, result, generation):
+        """keeps the result, unless there have been invalidations since the
+           given generation"""
+        if self.size <= 0:
+            return
+
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            if key not in self.entries and len(self.entries) >= self.size:
+                oldest = min(self.entries, key = lambda key: self.entries[key][3])
+                del self.entries[oldest]
+
+            self.tick += 1
+            self.entries[key] = [first_day, last_day, result, self.tick]
+
+    def invalidate(self, first_day = None, last_day = None):
+        """drops entries covering any of the given days, or all of them"""
+        with self.lock:
+            if first_day is None:
+                stale = self.entries.keys()
+            else:
+                stale = [key for key, entry in self.entries.iteritems()
+                                if entry[0] <= last_day and entry[1] >= first_day]
+
+            self._drop(stale)
+
+    def invalidate_activities(self, activity_ids):
+        """drops entries that have facts of any of the given activities"""
+        activity_ids = set(activity_ids)
+        with self.lock:
+            self._drop([key for key, entry in self.entries.iteritems()
+                                if any(fact[5] in activity_ids for fact in entry[2])])
+
+    def _drop(self, keys):
+        self.generation += 1
+        for key in keys:
+            del self.entries[key]
+        self.invalidations += len(keys)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"result_cache_size": len(self.entries),
+                "result_hits": self.hits,
+                "result_misses": self.misses,
+                "result_invalidations": self.invalidations,
+                "result_hit_rate": float(self.hits) / total if total else 0.0}
+
+
+class ActivityIndex(object):
+    """Activities sorted by lowercase name, for autocomplete lookups that do
+       not go to the database on every keystroke. Matches come most recently
+       used first, the never used ones last, by name"""
+    def __init__(self, rows):
+        # (search name, name, category, last used)
+        self.rows = sorted(rows)
+        self.names = [row[0] for row in self.rows]
+        self.recent = heapq.nsmallest(ACTIVITY_SUGGESTIONS, self.rows, key = self.rank)
+
+    @staticmethod
+    def rank(row):
+        search_name, name, category, last_used = row
+        return (last_used is None, -(last_used or 0), name.lower())
+
+    def find(self, prefix):
+        if not prefix:
+            return self.recent
+
+        start = bisect.bisect_left(self.names, prefix)
+        end = bisect.bisect_left(self.names, prefix + u"\uffff", start)
+        return heapq.nsmallest(ACTIVITY_SUGGESTIONS, self.rows[start:end], key = self.rank)
+
+
+class ReaderPool(object):
+    """Threads with connections of their own, for the queries that would
+       otherwise keep the main loop, and the writes with it, waiting. The
+       connections are read-only, replies and errors are handed back in the
+       main loop"""
+    def __init__(self, size, connect):
+        gobject.threads_init()
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target = self._work, args = (connect,),
+                                      name = "hamster-reader-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self, func, args, reply_handler, error_handler):
+        self.queue.put((func, args, reply_handler, error_handler))
+
+    def _work(self, connect):
+        while True:
+            func, args, reply_handler, error_handler = self.queue.get()
+            try:
+                connect()
+                result = func(*args)
+            except Exception, e:
+                logging.error("Read failed: %s" % e)
+                gobject.idle_add(error_handler, e)
+            else:
+                gobject.idle_add(reply_handler, result)
+
 
 class Storage(storage.Storage):
     con = None # Connection will be created on demand
@@ -53,7 +346,26 @@ class Storage(storage.Storage):
 
         self.__con = None
         self.__cur = None
-        self.__last_etag = None
+        self.__cursor = None
+        self.__tuple_cursor = None
+        self.__statements = None
+        self.__data_version = None # of the main connection, see __changed_externally
+        self.__last_change = None # change log entry last signalled
+        self.__in_batch = False
+
+        from configuration import conf
+        self.__results = ResultCache(conf.get("db_result_cache"))
+
+        # reader threads keep their connection here. the file generation
+        # goes up when the database file gets replaced, so that they know to
+        # reconnect
+        self.__readers = None
+        self.__reader = threading.local()
+        self.__file_generation = 0
+        self.__day_start = conf.get("day_start_minutes")
+        self.__snapshot = None # see __take_snapshot
+        self.__activity_index = None # built on demand, dropped on changes
+        self.__match_index = None # same, for __get_matches
 
 
         self.db_path = self.__init_db_file()
@@ -62,16 +374,21 @@ class Storage(storage.Storage):
         # when db file is rewritten
         def on_db_file_change(monitor, gio_file, event_uri, event):
             if event == gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT:
-                if gio_file.query_info(gio.FILE_ATTRIBUTE_ETAG_VALUE).get_etag() == self.__last_etag:
+                if not self.__changed_externally():
                     # ours
                     return
             elif event == gio.FILE_MONITOR_EVENT_CREATED:
                 # treat case when instead of a move, a remove and create has been performed
                 self.con = None
+                self.__file_generation += 1
 
             if event in (gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT, gio.FILE_MONITOR_EVENT_CREATED):
                 print "DB file has been modified externally. Calling all stations"
-                self.dispatch_overwrite()
+                if not self.__merge_replaced():
+                    self.__results.invalidate()
+                    self.__activity_index, self.__match_index = None, None
+                    self.__last_change = self.__get_last_change()
+                    self.dispatch_overwrite(self.__last_change)
 
                 # plan "b" – synchronize the time tracker's database from external source while the tracker is running
                 trophies.unlock("plan_b")
@@ -81,8 +398,37 @@ class Storage(storage.Storage):
         self.__db_monitor = self.__database_file.monitor_file()
         self.__db_monitor.connect("changed", on_db_file_change)
 
+        # other sqlite clients write to the write-ahead log, the database
+        # file itself changes only on checkpoints. the log comes and goes
+        # on its own, so only writes count there
+        def on_wal_change(monitor, gio_file, event_uri, event):
+            if event == gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT:
+                on_db_file_change(monitor, gio_file, event_uri, event)
+
+        self.__wal_monitor = gio.File(self.db_path + "-wal").monitor_file()
+        self.__wal_monitor.connect("changed", on_wal_change)
+
         self.run_fixtures()
 
+        from configuration import conf
+
+        # what the database looks like now, to tell what a replaced file
+        # has changed
+        if conf.get("db_merge_replaced"):
+            self.__snapshot = self.__take_snapshot()
+
+        # fact dates depend on hamster midnight, recalculate them on change
+        def on_conf_changed(conf, key, value):
+            if key == "day_start_minutes":
+                self.start_transaction()
+                changed = self.__set_day_start(value)
+                self.end_transaction()
+
+                if changed:
+                    self.emit_changed(self.FactsChanged)
+
+        conf.connect("conf-changed", on_conf_changed)
+
     def __init_db_file(self):
         home_data_dir = os.path.realpath(os.path.join(xdg_data_home, "hamster-applet"))
         if not os.path.exists(home_data_dir):
@@ -123,10 +469,14 @@ class Storage(storage.Storage):
         return db_path
 
 
-    def register_modification(self):
-        # db.execute calls this so we know that we were the ones
-        # that modified the DB and no extra refesh is not needed
-        self.__last_etag = self.__database_file.query_info(gio.FILE_ATTRIBUTE_ETAG_VALUE).get_etag()
+    def __changed_externally(self):
+        """tells if anyone else has committed to the database since the last
+           check. sqlite moves data_version on the commits of other
+           connections only, so our writes need no bookkeeping"""
+        version = self.fetchone("PRAGMA data_version")[0]
+        changed = version != self.__data_version
+        self.__data_version = version
+        return changed
 
     #tags, here we come!
     def __get_tags(self, only_autocomplete = False):
@@ -135,61 +485,73 @@ class Storage(storage.Storage):
         else:
             return self.fetchall("select * from tags order by name")
 
-    def __get_tag_ids(self, tags):
-        """look up tags by their name. create if not found"""
-
-        db_tags = self.fetchall("select * from tags where name in (%s)"
-                                            % ",".join(["?"] * len(tags)), tags) # bit of magic here - using sqlites bind variables
-
-        changes = False
-
-        # check if any of tags needs resurrection
-        set_complete = [str(tag["id"]) for tag in db_tags if tag["autocomplete"] == "false"]
-        if set_complete:
-            changes = True
-            self.execute("update tags set autocomplete='true' where id in (%s)" % ", ".join(set_complete))
+    def __get_tag_usage(self, tag_ids):
+        query = "SELECT id, name, autocomplete != 'false', uses FROM tags %s"
+        if not tag_ids:
+            return self.fetchall(query % "", as_tuples = True)
 
+        tags = []
+        for i in range(0, len(tag_ids), 500):
+            ids = list(tag_ids[i:i + 500])
+            tags.extend(self.fetchall(query % "WHERE id IN (%s)" % ",".join(["?"] * len(ids)),
+                                      ids, as_tuples = True))
+        return tags
 
-        found_tags = [tag["name"] for tag in db_tags]
+    def __set_tag_names(self, names):
+        """fills temp.tag_names, for the tag queries to join against"""
+        self.execute("DELETE FROM temp.tag_names")
+        self.executemany("INSERT OR IGNORE INTO temp.tag_names VALUES (?)", [(name,) for name in names])
 
-        add = set(tags) - set(found_tags)
-        if add:
-            statement = "insert into tags(name) values(?)"
+    def __total_changes(self):
+        """rows changed on the connection so far, triggers included"""
+        return (self.__con or self.connection).total_changes
 
-            self.execute([statement] * len(add), [(tag,) for tag in add])
-
-            return self.__get_tag_ids(tags)[0], True # all done, recurse
-        else:
-            return db_tags, changes
+    def __get_tag_ids(self, tags):
+        """look up tags by their name. creates the missing ones and puts the
+           ones that had been taken off autocomplete back on. returns the tags
+           and whether any had to be changed"""
+        if not tags:
+            return [], False
+
+        tags = list(set(tags))
+        if len(tags) <= 100:
+            # usually they are all there, and then one query does
+            db_tags = self.fetchall("SELECT * FROM tags WHERE name IN (%s)"
+                                                % ",".join(["?"] * len(tags)), tags)
+            if len(db_tags) == len(tags) and all(tag["autocomplete"] != "false" for tag in db_tags):
+                return db_tags, False
+
+        self.__set_tag_names(tags)
+        changes = self.__total_changes()
+        # the ignored rows would use up ids all the same, so the known names
+        # are left out from the start
+        self.execute("""INSERT OR IGNORE INTO tags (name)
+                             SELECT name FROM temp.tag_names
+                              WHERE name NOT IN (SELECT name FROM tags)""")
+        self.execute("""UPDATE tags SET autocomplete = 'true'
+                         WHERE autocomplete = 'false'
+                           AND name IN (SELECT name FROM temp.tag_names)""")
+        db_tags = self.fetchall("SELECT * FROM tags WHERE name IN (SELECT name FROM temp.tag_names)")
+        return db_tags, self.__total_changes() != changes
 
     def __update_autocomplete_tags(self, tags):
         tags = [tag.strip() for tag in tags.split(",") if tag.strip()]  # split by comma
 
         #first we will create new ones
-        tags, changes = self.__get_tag_ids(tags)
-        tags = [tag["id"] for tag in tags]
+        changes = self.__get_tag_ids(tags)[1]
 
-        #now we will find which ones are gone from the list
-        query = """
-                    SELECT b.id as id, b.autocomplete, count(a.fact_id) as occurences
-                      FROM tags b
-                 LEFT JOIN fact_tags a on a.tag_id = b.id
-                     WHERE b.id not in (%s)
-                  GROUP BY b.id
-                """ % ",".join(["?"] * len(tags)) # bit of magic here - using sqlites bind variables
-
-        gone = self.fetchall(query, tags)
-
-        to_delete = [str(tag["id"]) for tag in gone if tag["occurences"] == 0]
-        to_uncomplete = [str(tag["id"]) for tag in gone if tag["occurences"] > 0 and tag["autocomplete"] == "true"]
+        # the ones gone from the list are deleted if no fact has them and
+        # are taken off autocomplete otherwise
+        self.__set_tag_names(tags)
+        total_changes = self.__total_changes()
+        self.execute("""DELETE FROM tags
+                         WHERE uses = 0
+                           AND name NOT IN (SELECT name FROM temp.tag_names)""")
+        self.execute("""UPDATE tags SET autocomplete = 'false'
+                         WHERE autocomplete != 'false'
+                           AND name NOT IN (SELECT name FROM temp.tag_names)""")
 
-        if to_delete:
-            self.execute("delete from tags where id in (%s)" % ", ".join(to_delete))
-
-        if to_uncomplete:
-            self.execute("update tags set autocomplete='false' where id in (%s)" % ", ".join(to_uncomplete))
-
-        return changes or len(to_delete + to_uncomplete) > 0
+        return changes or self.__total_changes() != total_changes
 
     def __get_categories(self):
         return self.fetchall("SELECT id, name FROM categories ORDER BY lower(name)")
@@ -204,10 +566,6 @@ class Storage(storage.Storage):
         """
         self.execute(query, (name, name.lower(), category_id, id))
 
-        affected_ids = [res[0] for res in self.fetchall("select id from facts where activity_id = ?", (id,))]
-        self.__remove_index(affected_ids)
-
-
     def __change_category(self, id, category_id):
         # first check if we don't have an activity with same name before us
         activity = self.fetchone("select name from activities where id = ?", (id, ))
@@ -238,11 +596,6 @@ class Storage(storage.Storage):
 
             self.execute(statement, (category_id, id))
 
-        affected_ids = [res[0] for res in self.fetchall("select id from facts where activity_id = ?", (id,))]
-        if existing_activity:
-            affected_ids.extend([res[0] for res in self.fetchall("select id from facts where activity_id = ?", (existing_activity['id'],))])
-        self.__remove_index(affected_ids)
-
         return True
 
     def __add_category(self, name):
@@ -262,15 +615,6 @@ class Storage(storage.Storage):
             """
             self.execute(update, (name, name.lower(), id))
 
-        affected_query = """
-            SELECT id
-              FROM facts
-             WHERE activity_id in (SELECT id FROM activities where category_id=?)
-        """
-        affected_ids = [res[0] for res in self.fetchall(affected_query, (id,))]
-        self.__remove_index(affected_ids)
-
-
     def __get_activity_by_name(self, name, category_id = None, resurrect = True):
         """get most recent, preferably not deleted activity by it's name"""
 
@@ -335,44 +679,35 @@ class Storage(storage.Storage):
 
     def __get_fact(self, id):
         query = """
-                   SELECT a.id AS id,
-                          a.start_time AS start_time,
-                          a.end_time AS end_time,
-                          a.description as description,
-                          b.name AS name, b.id as activity_id,
-                          coalesce(c.name, ?) as category, coalesce(c.id, -1) as category_id,
-                          e.name as tag
+                   SELECT a.id, a.start_time, a.end_time,
+                          coalesce(a.description, ''),
+                          coalesce(b.name, ''), coalesce(b.id, 0),
+                          coalesce(c.name, ?),
+                          %s,
+                          a.fact_date,
+                          coalesce(a.end_time - a.start_time, 0)
                      FROM facts a
                 LEFT JOIN activities b ON a.activity_id = b.id
                 LEFT JOIN categories c ON b.category_id = c.id
-                LEFT JOIN fact_tags d ON d.fact_id = a.id
-                LEFT JOIN tags e ON e.id = d.tag_id
                     WHERE a.id = ?
-                 ORDER BY e.name
-        """
+        """ % FACT_TAGS
 
-        return self.__group_tags(self.fetchall(query, (_("Unsorted"), id)))[0]
-
-    def __group_tags(self, facts):
-        """put the fact back together and move all the unique tags to an array"""
-        if not facts: return facts  #be it None or whatever
-
-        grouped_facts = []
-        for fact_id, fact_tags in itertools.groupby(facts, lambda f: f["id"]):
-            fact_tags = list(fact_tags)
-
-            # first one is as good as the last one
-            grouped_fact = fact_tags[0]
+        fact = self.fetchone(query, (_("Unsorted"), id), as_tuples = True)
+        if not fact:
+            return None
 
-            # we need dict so we can modify it (sqlite.Row is read only)
-            # in python 2.5, sqlite does not have keys() yet, so we hardcode them (yay!)
-            keys = ["id", "start_time", "end_time", "description", "name",
-                    "activity_id", "category", "tag"]
-            grouped_fact = dict([(key, grouped_fact[key]) for key in keys])
+        tags = fact[7]
+        fact = fact[:7] + (sorted(tags.split(TAG_SEPARATOR)) if tags else [],) + fact[8:]
+        return self.__fact_dict(fact)
 
-            grouped_fact["tags"] = [ft["tag"] for ft in fact_tags if ft["tag"]]
-            grouped_facts.append(grouped_fact)
-        return grouped_facts
+    def __fact_dict(self, fact):
+        """turn fact tuple into a dict with python dates and times"""
+        fact = dict(zip(FACT_KEYS, fact))
+        fact["start_time"] = from_epoch(fact["start_time"])
+        fact["end_time"] = from_epoch(fact["end_time"] or None)
+        fact["date"] = from_epoch(fact["date"]).date()
+        fact["delta"] = dt.timedelta(seconds = fact["delta"])
+        return fact
 
 
     def __touch_fact(self, fact, end_time):
@@ -398,28 +733,36 @@ class Storage(storage.Storage):
         # or maybe there is something after us - so we know to adjust end time
         # in the latter case go only few hours ahead. everything else is madness, heh
         query = """
-                   SELECT a.*, b.name
-                     FROM facts a
-                LEFT JOIN activities b on b.id = a.activity_id
-                    WHERE ((start_time < ? and end_time > ?)
-                           OR (start_time > ? and start_time < ? and end_time is null)
-                           OR (start_time > ? and start_time < ?))
-                 ORDER BY start_time
+                   SELECT a.*
+                     FROM fact_spans s
+                     JOIN facts a ON a.id = s.id
+                    WHERE s.start_time < :start AND s.end_time > :start
+                      AND ((a.start_time < :start AND a.end_time > :start)
+                           OR (a.start_time > :since AND a.start_time < :start AND a.end_time IS NULL))
+                 ORDER BY a.start_time
                     LIMIT 1
                 """
-        fact = self.fetchone(query, (start_time, start_time,
-                                     start_time - dt.timedelta(hours = 12),
-                                     start_time, start_time,
-                                     start_time + dt.timedelta(hours = 12)))
+        fact = self.fetchone(query, {"start": start_time,
+                                     "since": start_time - SQUEEZE_LOOKAHEAD})
+        if not fact:
+            query = """
+                       SELECT *
+                         FROM facts
+                        WHERE start_time > ? AND start_time < ?
+                     ORDER BY start_time
+                        LIMIT 1
+                    """
+            fact = self.fetchone(query, (start_time, start_time + SQUEEZE_LOOKAHEAD))
+
         end_time = None
         if fact:
-            if start_time > fact["start_time"]:
+            if start_time > from_epoch(fact["start_time"]):
                 #we are in middle of a fact - truncate it to our start
                 self.execute("UPDATE facts SET end_time=? WHERE id=?",
                              (start_time, fact["id"]))
 
             else: #otherwise we have found a task that is after us
-                end_time = fact["start_time"]
+                end_time = from_epoch(fact["start_time"])
 
         return end_time
 
@@ -435,23 +778,29 @@ class Storage(storage.Storage):
         #             |----------------- NEW -----------------|
         #      |--- old --- 1|   |2 --- old --- 1|   |2 --- old ---|
         # |3 -----------------------  big old   ------------------------ 3|
+        # the span index narrows it down to the facts crossing the interval
         query = """
                    SELECT a.*, b.name, c.name as category
-                     FROM facts a
+                     FROM fact_spans s
+                     JOIN facts a ON a.id = s.id
                 LEFT JOIN activities b on b.id = a.activity_id
                 LEFT JOIN categories c on b.category_id = c.id
-                    WHERE (end_time > ? and end_time < ?)
-                       OR (start_time > ? and start_time < ?)
-                       OR (start_time < ? and end_time > ?)
-                 ORDER BY start_time
+                    WHERE s.start_time < :end AND s.end_time > :start
+                      AND ((a.end_time > :start and a.end_time < :end)
+                           OR (a.start_time > :start and a.start_time < :end)
+                           OR (a.start_time < :start and a.end_time > :end))
+                 ORDER BY a.start_time
                 """
-        conflicts = self.fetchall(query, (start_time, end_time,
-                                          start_time, end_time,
-                                          start_time, end_time))
+        conflicts = self.fetchall(query, {"start": start_time, "end": end_time})
 
         for fact in conflicts:
+            fact = dict([(key, fact[key]) for key in ("id", "name", "category", "description")],
+                        start_time = from_epoch(fact["start_time"]),
+                        end_time = from_epoch(fact["end_time"]))
+
             # won't eliminate as it is better to have overlapping entries than loosing data
-            if start_time < fact["start_time"] and end_time > fact["end_time"]:
+            # (nor move ongoing ones that start within)
+            if start_time < fact["start_time"] and (fact["end_time"] is None or end_time > fact["end_time"]):
                 continue
 
             # split - truncate until beginning of new entry and create new activity for end
@@ -507,8 +856,9 @@ class Storage(storage.Storage):
 
 
         # get tags from database - this will create any missing tags too
-        tags = [dict(zip(('id', 'name', 'autocomplete'), row))
-                                           for row in self.GetTagIds(fact.tags)]
+        tags, new_added = self.__get_tag_ids(fact.tags)
+        if new_added:
+            self.emit_changed(self.TagsChanged)
 
 
         now = datetime.datetime.now()
@@ -612,120 +962,721 @@ class Storage(storage.Storage):
         params = [(fact_id, tag["id"]) for tag in tags]
         self.execute(insert, params)
 
-        self.__remove_index([fact_id])
         return fact_id
 
     def __last_insert_rowid(self):
         return self.fetchone("SELECT last_insert_rowid();")[0]
 
 
-    def __get_todays_facts(self):
-        from configuration import conf
-        day_start = conf.get("day_start_minutes")
-        day_start = dt.time(day_start / 60, day_start % 60)
-        today = (dt.datetime.now() - dt.timedelta(hours = day_start.hour,
-                                                  minutes = day_start.minute)).date()
-        return self.__get_facts(today)
-
-
-    def __get_facts(self, date, end_date = None, search_terms = ""):
-        from configuration import conf
-        day_start = conf.get("day_start_minutes")
+    def __get_hamster_today(self):
+        day_start = self.__day_start
         day_start = dt.time(day_start / 60, day_start % 60)
+        return (dt.datetime.now() - dt.timedelta(hours = day_start.hour,
+                                                 minutes = day_start.minute)).date()
 
-        split_time = day_start
-        datetime_from = dt.datetime.combine(date, split_time)
+    def __get_todays_facts(self):
+        return self.__get_facts(self.__get_hamster_today())
 
-        end_date = end_date or date
-        datetime_to = dt.datetime.combine(end_date, split_time) + dt.timedelta(days = 1)
 
+    def __get_facts(self, date, end_date = None, search_terms = ""):
+        return [self.__fact_dict(fact)
+                    for fact in self.__get_fact_rows(date, end_date, search_terms)]
+
+
+    def __search_filter(self, search_terms):
+        """condition limiting facts to the ones matching search terms"""
+        search_terms = search_terms.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace("'", "''")
+        return """ AND a.id in (SELECT docid
+                                  FROM fact_index
+                                 WHERE fact_index MATCH '%s')""" % search_terms
+
+    def __get_fact_rows(self, date, end_date = None, search_terms = "", ongoing_only = False):
+        """returns facts of the given hamster days as tuples of (id,
+           start_time, end_time, description, name, activity_id, category,
+           tags, date, delta) with the times and duration in seconds. this is
+           also the layout GetFacts sends out. ongoing facts have end_time 0"""
+        key = (date, end_date, search_terms, ongoing_only, self.__day_start)
+
+        # rows are cached as they come from the database, as the duration of
+        # ongoing facts changes by the minute. in the middle of a transaction
+        # the cache could be behind, so we skip it
+        facts = None
+        if not self.__con:
+            facts = self.__results.get(key)
+
+        if facts is None:
+            generation = self.__results.generation
+            facts = self.__query_fact_rows(date, end_date, search_terms, ongoing_only)
+            if not self.__con:
+                # ongoing facts are looked up also on the day before
+                self.__results.put(key, to_epoch(date) - 86400,
+                                   to_epoch(end_date or date), facts, generation)
+
+        return self.__finish_fact_rows(facts, date, end_date)
+
+    def __get_fact_page(self, date, end_date = None, search_terms = "", cursor = "", limit = 500):
+        """returns up to limit facts, in the layout of __get_fact_rows,
+           following the ones that the cursor points to, and the cursor for
+           the next page. the cursor is empty on first and after last page"""
+        after = None
+        if cursor:
+            after = [int(part) for part in cursor.split(":")]
+
+        facts = self.__query_fact_rows(date, end_date, search_terms,
+                                       after = after, limit = limit)
+        next_cursor = ""
+        if len(facts) == limit:
+            next_cursor = "%d:%d" % (facts[-1][1], facts[-1][0])
+
+        return self.__finish_fact_rows(facts, date, end_date), next_cursor
+
+    def __query_fact_rows(self, date, end_date = None, search_terms = "",
+                          ongoing_only = False, after = None, limit = None):
+        """facts of the given days as they are in the database, ordered by
+           start time. when after is given as (start_time, id), only the
+           facts following it are returned. limit is for pages"""
+        date = to_epoch(date)
+        end_date = to_epoch(end_date) if end_date else date
+
+        # the date of an ongoing fact is the one it started on, but as time
+        # goes on, it might move to the next day. so for these we also check
+        # the day before
         query = """
-                   SELECT a.id AS id,
-                          a.start_time AS start_time,
-                          a.end_time AS end_time,
-                          a.description as description,
-                          b.name AS name, b.id as activity_id,
-                          coalesce(c.name, ?) as category,
-                          e.name as tag
-                     FROM facts a
+                   SELECT a.id, a.start_time, coalesce(a.end_time, 0),
+                          coalesce(a.description, ''),
+                          coalesce(b.name, ''), coalesce(b.id, 0),
+                          coalesce(c.name, ?),
+                          %s,
+                          a.fact_date
+                     FROM facts a %s
                 LEFT JOIN activities b ON a.activity_id = b.id
                 LEFT JOIN categories c ON b.category_id = c.id
-                LEFT JOIN fact_tags d ON d.fact_id = a.id
-                LEFT JOIN tags e ON e.id = d.tag_id
-                    WHERE (a.end_time >= ? OR a.end_time IS NULL) AND a.start_time <= ?
-        """
+                    WHERE a.fact_date BETWEEN ? AND ?
+                      AND (a.fact_date >= ? OR a.end_time IS NULL)
+        """ % (FACT_TAGS, "INDEXED BY idx_facts_start_end" if limit else "")
+        params = [_("Unsorted"), date - 86400, end_date, date]
+
+        if ongoing_only:
+            query += " AND a.end_time IS NULL"
 
         if search_terms:
-            # check if we need changes to the index
-            self.__check_index(datetime_from, datetime_to)
+            query += self.__search_filter(search_terms)
 
-            search_terms = search_terms.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace("'", "''")
-            query += """ AND a.id in (SELECT id
-                                        FROM fact_index
-                                       WHERE fact_index MATCH '%s')""" % search_terms
+        if limit:
+            # pages walk the start time index, so that they do not have to
+            # go through the whole range. a fact starts at most two days
+            # before the day it belongs to
+            after = after or (date - 2 * 86400, 0)
+            query += """ AND a.start_time >= ? AND a.start_time < ?
+                         AND (a.start_time > ? OR a.id > ?)"""
+            params.extend([after[0], end_date + 2 * 86400, after[0], after[1]])
 
+        query += " ORDER BY a.start_time, a.id"
 
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
 
-        query += " ORDER BY a.start_time, e.name"
+        return self.fetchall(query, params, as_tuples = True)
 
-        facts = self.fetchall(query, (_("Unsorted"),
-                                      datetime_from,
-                                      datetime_to))
+    def __finish_fact_rows(self, facts, date, end_date = None):
+        """figures out duration of the queried facts and the date of the
+           ongoing ones"""
+        day_start = self.__day_start * 60
 
-        #first let's put all tags in an array
-        facts = self.__group_tags(facts)
+        date = to_epoch(date)
+        end_date = to_epoch(end_date) if end_date else date
 
-        res = []
-        for fact in facts:
-            # heuristics to assign tasks to proper days
+        now = to_epoch(dt.datetime.now())
+        today = to_epoch(dt.date.today())
 
+        res = []
+        for id, start_time, end_time, description, name, activity_id, category, tags, fact_date in facts:
             # if fact has no end time, set the last minute of the day,
             # or current time if fact has happened in last 24 hours
-            if fact["end_time"]:
-                fact_end_time = fact["end_time"]
-            elif (dt.date.today() - fact["start_time"].date()) <= dt.timedelta(days=1):
-                fact_end_time = dt.datetime.now().replace(microsecond = 0)
+            if end_time:
+                fact_end_time = end_time
+            elif today - (start_time - start_time % 86400) <= 86400:
+                fact_end_time = now
             else:
-                fact_end_time = fact["start_time"]
-
-            fact_start_date = fact["start_time"].date() \
-                - dt.timedelta(1 if fact["start_time"].time() < split_time else 0)
-            fact_end_date = fact_end_time.date() \
-                - dt.timedelta(1 if fact_end_time.time() < split_time else 0)
-            fact_date_span = fact_end_date - fact_start_date
-
-            # check if the task spans across two dates
-            if fact_date_span.days == 1:
-                datetime_split = dt.datetime.combine(fact_end_date, split_time)
-                start_date_duration = datetime_split - fact["start_time"]
-                end_date_duration = fact_end_time - datetime_split
-                if start_date_duration > end_date_duration:
-                    # most of the task was done during the previous day
-                    fact_date = fact_start_date
-                else:
-                    fact_date = fact_end_date
+                fact_end_time = start_time
+
+            if not end_time:
+                # ongoing fact - see if most of it is on the next day by now
+                end_day = fact_end_time - day_start
+                end_day -= end_day % 86400
+                if end_day - fact_date == 86400 \
+                   and 2 * (end_day + day_start) <= start_time + fact_end_time:
+                    fact_date = end_day
+
+                if fact_date < date or fact_date > end_date:
+                    # due to spanning we've jumped outside of given period
+                    continue
+
+            tags = sorted(tags.split(TAG_SEPARATOR)) if tags else []
+            res.append((id, start_time, end_time, description, name, activity_id,
+                        category, tags, fact_date, fact_end_time - start_time))
+
+        return res
+
+    def __get_totals(self, date, end_date = None, group_by = "category",
+                     search_terms = "", categories = None, activities = None, tags = None):
+        """returns list of (key, duration in seconds, fact count) of the facts
+           in the given hamster days, grouped by category, activity, tag, day
+           (as YYYY-MM-DD) or weekday (0 is sunday).
+           facts can be further limited to given categories and activities,
+           and to facts that have all the listed tags"""
+        key, joins = TOTALS_GROUPS[group_by]
+        categories, activities, tags = categories or [], activities or [], tags or []
+
+        # finished facts come from the rollups unless we have to look at the
+        # individual facts. ongoing facts are summed up below, as their
+        # duration and date depend on the current time
+        use_rollups = not search_terms and not tags \
+                      and not (group_by == "tag" and (categories or activities))
+
+        if use_rollups:
+            table = "tag" if group_by == "tag" else "activity"
+            if group_by in ("day", "weekday"):
+                # these need the days
+                rollup = """SELECT day, activity_id, duration, facts
+                              FROM activity_days
+                             WHERE day BETWEEN ? AND ?"""
+                params = [to_epoch(date), to_epoch(end_date or date)]
+            else:
+                # months that are fully in range, plus the days around them
+                rollup = """SELECT %(table)s_id, duration, facts
+                              FROM %(table)s_days
+                             WHERE day BETWEEN ? AND ? OR day BETWEEN ? AND ?
+                         UNION ALL
+                            SELECT %(table)s_id, duration, facts
+                              FROM %(table)s_months
+                             WHERE month BETWEEN ? AND ?""" % {"table": table}
+                params = self.__split_months(date, end_date or date)
+
+            if group_by == "tag":
+                query = """
+                           SELECT %s, sum(r.duration), sum(r.facts)
+                             FROM (%s) r
+                             JOIN tags e ON e.id = r.tag_id
+                """ % (key, rollup)
+            elif group_by in ("day", "weekday") and not (categories or activities):
+                query = """
+                           SELECT %s, sum(r.duration), sum(r.facts)
+                             FROM (%s) r
+                """ % (key % {"day": "r.day"}, rollup)
             else:
-                # either doesn't span or more than 24 hrs tracked
-                # (in which case we give up)
-                fact_date = fact_start_date
+                query = """
+                           SELECT %s, sum(r.duration), sum(r.facts)
+                             FROM (%s) r
+                        LEFT JOIN activities b ON b.id = r.activity_id
+                        LEFT JOIN categories c ON c.id = b.category_id
+                """ % (key % {"day": "r.day"}, rollup)
+            query += " WHERE 1 = 1"
+        else:
+            query = """
+                       SELECT %s, sum(a.end_time - a.start_time), count(*)
+                         FROM facts a
+                    LEFT JOIN activities b ON a.activity_id = b.id
+                    LEFT JOIN categories c ON b.category_id = c.id
+                           %s
+                        WHERE a.end_time IS NOT NULL
+                          AND a.fact_date BETWEEN ? AND ?
+            """ % (key % {"day": "a.fact_date"}, joins)
+            params = [to_epoch(date), to_epoch(end_date or date)]
+
+        if group_by == "category":
+            params.insert(0, _("Unsorted"))
+
+        if categories:
+            query += " AND coalesce(c.name, ?) IN (%s)" % ",".join(["?"] * len(categories))
+            params.extend([_("Unsorted")] + list(categories))
+
+        if activities:
+            query += " AND b.name IN (%s)" % ",".join(["?"] * len(activities))
+            params.extend(activities)
+
+        if tags:
+            query += """ AND a.id IN (SELECT ft.fact_id
+                                        FROM fact_tags ft
+                                        JOIN tags t ON t.id = ft.tag_id
+                                       WHERE t.name IN (%s)
+                                    GROUP BY ft.fact_id
+                                      HAVING count(DISTINCT t.name) = ?)""" % ",".join(["?"] * len(tags))
+            params.extend(list(tags) + [len(set(tags))])
 
-            if fact_date < date or fact_date > end_date:
-                # due to spanning we've jumped outside of given period
+        if search_terms:
+            query += self.__search_filter(search_terms)
+
+        query += " GROUP BY 1"
+
+        totals = {}
+        for key, duration, count in self.fetchall(query, params, as_tuples = True):
+            if group_by == "day":
+                key = from_epoch(key).strftime("%Y-%m-%d")
+            elif group_by == "weekday":
+                key = str(key)
+            totals[key] = [duration, count]
+
+        for fact in self.__get_fact_rows(date, end_date, search_terms, ongoing_only = True):
+            if categories and fact[6] not in categories:
+                continue
+            if activities and fact[4] not in activities:
+                continue
+            if tags and not set(tags).issubset(fact[7]):
                 continue
 
-            fact["date"] = fact_date
-            fact["delta"] = fact_end_time - fact["start_time"]
-            res.append(fact)
+            if group_by == "category":
+                keys = [fact[6]]
+            elif group_by == "activity":
+                keys = [fact[4]]
+            elif group_by == "tag":
+                keys = fact[7]
+            elif group_by == "day":
+                keys = [from_epoch(fact[8]).strftime("%Y-%m-%d")]
+            else:
+                keys = [from_epoch(fact[8]).strftime("%w")]
+
+            for key in keys:
+                total = totals.setdefault(key, [0, 0])
+                total[0] += fact[9]
+                total[1] += 1
+
+        return [(key, duration, count) for key, (duration, count) in sorted(totals.items())]
+
+    def __split_months(self, date, end_date):
+        """splits the range in months that are fully in it and the days
+           before and after them. returns query params for the two day
+           ranges and the month range"""
+        after = end_date + dt.timedelta(days = 1)
+        first_month = date.replace(day = 1)
+        if first_month < date:
+            first_month = (first_month + dt.timedelta(days = 32)).replace(day = 1)
+        last_month = after.replace(day = 1)
+
+        if first_month >= last_month:
+            first_month = last_month = after
+
+        return [to_epoch(date), to_epoch(first_month) - 1,
+                to_epoch(last_month), to_epoch(end_date),
+                to_epoch(first_month), to_epoch(last_month) - 1]
+
+    def __rebuild_rollups(self):
+        for table, query in ROLLUPS.items():
+            self.execute("DELETE FROM %s" % table)
+            self.execute("INSERT INTO %s %s" % (table, query))
+
+    def __check_rollups(self, repair = False):
+        """compares the rollups with what they should be according to facts.
+           returns number of rows that differ. on repair the rollups are
+           rebuilt if anything is off"""
+        mismatches = 0
+        for table, query in ROLLUPS.items():
+            expected = "(%s)" % query
+            mismatches += self.fetchone("""SELECT count(*) FROM (SELECT * FROM %s
+                                                                  EXCEPT
+                                                                  SELECT * FROM %s)""" % (expected, table))[0]
+            mismatches += self.fetchone("""SELECT count(*) FROM (SELECT * FROM %s
+                                                                  EXCEPT
+                                                                  SELECT * FROM %s)""" % (table, expected))[0]
+
+        if mismatches and repair:
+            self.__rebuild_rollups()
+
+        return mismatches
+
+    def __set_day_start(self, day_start):
+        """store hamster midnight and recalculate fact dates if it has moved.
+           returns True if anything has changed"""
+        self.__day_start = day_start
+
+        current = self.fetchone("SELECT value FROM settings WHERE name = 'day_start_minutes'")
+        if current and current["value"] == day_start:
+            return False
 
-        return res
+        self.execute("UPDATE settings SET value = ? WHERE name = 'day_start_minutes'",
+                     (day_start,))
+        fact_date = FACT_DATE % {"prefix": ""}
+        self.execute("UPDATE facts SET fact_date = %s WHERE fact_date IS NOT %s" % (fact_date, fact_date))
+        return True
+
+    def __get_last_change(self):
+        """sequence number of the last logged change"""
+        last = self.fetchone("SELECT seq FROM sqlite_sequence WHERE name = 'changes'")
+        return last["seq"] if last else 0
+
+    def __get_changes(self, sequence):
+        """changes logged after the given sequence number. returns the last
+           sequence number, changed fact, activity, category and tag ids by
+           kind and the hamster days of the changed facts"""
+        changes = self.fetchall("""SELECT id, kind, item_id, start_date, end_date
+                                     FROM changes
+                                    WHERE id > ?
+                                 ORDER BY id""", (sequence,), as_tuples = True)
+
+        ids = {"fact": set(), "activity": set(), "category": set(), "tag": set()}
+        start_date, end_date = None, None
+        for change_id, kind, item_id, start, end in changes:
+            sequence = change_id
+            ids[kind].add(item_id)
+            if start is not None:
+                start_date = start if start_date is None else min(start_date, start)
+                end_date = end if end_date is None else max(end_date, end)
+
+        return sequence, ids, start_date or 0, end_date or 0
+
+    def __get_changes_since(self, sequence):
+        last_change = self.__get_last_change()
+        if sequence > last_change:
+            # database has been replaced
+            return last_change, False, [], 0, 0, [], [], []
+
+        oldest = self.fetchone("SELECT min(id) FROM changes")[0]
+        complete = sequence == last_change or (oldest is not None and oldest <= sequence + 1)
+
+        last_change, ids, start_date, end_date = self.__get_changes(sequence)
+        fact_ids = ids["fact"] if len(ids["fact"]) <= MAX_CHANGED_FACTS else []
+        return (last_change, complete, sorted(fact_ids), start_date, end_date,
+                sorted(ids["activity"]), sorted(ids["category"]), sorted(ids["tag"]))
+
+    def __dispatch_changes(self):
+        """send out the detailed change signals for everything that has been
+           logged since the last time and drop the cached results it touches"""
+        if self.__last_change is None:
+            return # not set up yet
+
+        last_change, ids, start_date, end_date = self.__get_changes(self.__last_change)
+        if last_change == self.__last_change:
+            return
+
+        oldest = self.fetchone("SELECT min(id) FROM changes")[0]
+        if oldest > self.__last_change + 1:
+            # a single commit went past the log size and the first of its
+            # changes have been pruned already
+            self.__last_change = last_change
+            self.__results.invalidate()
+            self.__activity_index, self.__match_index = None, None
+            if self.__snapshot:
+                self.__snapshot = self.__take_snapshot()
+            self.TagChanges(last_change, [])
+            self.FactChanges(last_change, [], 0, 0)
+            self.ActivityChanges(last_change, [], [])
+            return
+        self.__last_change = last_change
+
+        if self.__snapshot:
+            self.__update_snapshot(ids)
+        self.__announce_changes(last_change, ids, start_date, end_date)
+
+    def __announce_changes(self, last_change, ids, start_date, end_date):
+        """drops the cached results that the changes touch and sends out
+           the detailed change signals"""
+        # activities are ranked by the last fact. fuzzy matches take a
+        # while to index, their usage counts can wait for the next change
+        # of activities
+        if ids["fact"] or ids["activity"] or ids["category"]:
+            self.__activity_index = None
+        if ids["activity"] or ids["category"]:
+            self.__match_index = None
+
+        # tags are never renamed, new ones and autocomplete changes do not
+        # matter to the cached facts
+        if ids["category"] or (ids["fact"] and not start_date):
+            self.__results.invalidate()
+        else:
+            if ids["fact"]:
+                self.__results.invalidate(start_date, end_date)
+            if ids["activity"]:
+                self.__results.invalidate_activities(ids["activity"])
+
+        if ids["fact"]:
+            fact_ids = ids["fact"] if len(ids["fact"]) <= MAX_CHANGED_FACTS else []
+            self.FactChanges(last_change, sorted(fact_ids), start_date, end_date)
+        if ids["activity"] or ids["category"]:
+            self.ActivityChanges(last_change, sorted(ids["activity"]), sorted(ids["category"]))
+        if ids["tag"]:
+            self.TagChanges(last_change, sorted(ids["tag"]))
+
+    def __take_snapshot(self, fact_ids = None):
+        """facts by id as (date, digest of the rest), and the rows of the
+           activities, categories and tags by kind and id. with fact_ids
+           given, it is just the facts of these that are still there"""
+        facts = {}
+        if fact_ids is None:
+            rows = self.fetchall(SNAPSHOT_FACTS, as_tuples = True)
+        else:
+            fact_ids, rows = list(fact_ids), []
+            for i in range(0, len(fact_ids), 500):
+                chunk = fact_ids[i:i + 500]
+                rows.extend(self.fetchall(SNAPSHOT_FACTS + " WHERE id IN (%s)" % ",".join("?" * len(chunk)),
+                                          chunk, as_tuples = True))
+        for row in rows:
+            facts[row[0]] = (row[1], hash(row[2:]))
+
+        if fact_ids is not None:
+            return facts
+
+        snapshot = {"fact": facts}
+        for kind, query in SNAPSHOT_TABLES.iteritems():
+            snapshot[kind] = dict((row[0], row) for row in self.fetchall(query, as_tuples = True))
+        return snapshot
+
+    def __update_snapshot(self, ids):
+        """brings the snapshot up to date with our own changes"""
+        if len(ids["fact"]) > IMPORT_CHUNK:
+            self.__snapshot = self.__take_snapshot()
+            return
+
+        if ids["fact"]:
+            facts = self.__snapshot["fact"]
+            for fact_id in ids["fact"]:
+                facts.pop(fact_id, None)
+            facts.update(self.__take_snapshot(ids["fact"]))
+
+        for kind, query in SNAPSHOT_TABLES.iteritems():
+            if ids[kind]:
+                self.__snapshot[kind] = dict((row[0], row) for row in self.fetchall(query, as_tuples = True))
+
+    def __merge_replaced(self):
+        """compares the database file, as replaced or changed by someone
+           else, with the snapshot of what it was. brings the index and
+           rollup rows of the facts that differ up to date and sends out
+           change signals for just these. returns False when not merging"""
+        if self.__snapshot is None:
+            return False
+
+        # the file might come from an older version
+        self.run_fixtures()
+
+        before, after = self.__snapshot, self.__take_snapshot()
+        self.__snapshot = after
+
+        ids, days = {}, set()
+        for kind in after:
+            old, new = before[kind], after[kind]
+            ids[kind] = set(id for id in set(old) | set(new) if old.get(id) != new.get(id))
+
+        for fact_id in ids["fact"]:
+            for fact in (before["fact"].get(fact_id), after["fact"].get(fact_id)):
+                if fact and fact[0] is not None:
+                    days.add(fact[0])
+
+        if not any(ids.values()):
+            return True
+
+        # facts of renamed activities and categories have their names in
+        # the full text index
+        indexed = set(ids["fact"])
+        if ids["activity"] or ids["category"]:
+            indexed.update(row[0] for row in self.fetchall("""
+                               SELECT a.id
+                                 FROM facts a
+                                 JOIN activities b ON b.id = a.activity_id
+                                WHERE b.id IN (%s) OR b.category_id IN (%s)""" % \
+                                   (",".join(str(id) for id in ids["activity"]),
+                                    ",".join(str(id) for id in ids["category"])),
+                               as_tuples = True))
+
+        self.start_transaction()
+        self.__refresh_derived(indexed, days)
+        self.end_transaction()
+
+        self.__last_change = self.__get_last_change()
+        self.__announce_changes(self.__last_change, ids,
+                                min(days) if days else 0, max(days) if days else 0)
+
+        if ids["tag"]:
+            self.emit_changed(self.TagsChanged)
+        if ids["fact"]:
+            self.emit_changed(self.FactsChanged)
+        if ids["activity"] or ids["category"]:
+            self.emit_changed(self.ActivitiesChanged)
+        return True
+
+    def __refresh_derived(self, fact_ids, days):
+        """rebuilds the full text index rows of the given facts and the
+           rollup rows of the given days and their months"""
+        self.executemany("INSERT INTO temp.changed_facts VALUES (?)", [(id,) for id in fact_ids])
+        self.executemany("INSERT INTO temp.changed_days VALUES (?)", [(day,) for day in days])
+
+        self.execute("DELETE FROM fact_index WHERE docid IN (SELECT id FROM temp.changed_facts)")
+        self.execute("""INSERT INTO fact_index (docid, id, name, category, description, tag)
+                             %s WHERE a.id IN (SELECT id FROM temp.changed_facts)""" % FACT_INDEX_ROWS)
+
+        for table, (column, periods, query) in PERIOD_ROLLUPS.iteritems():
+            self.execute("DELETE FROM %s WHERE %s IN (%s)" % (table, column, periods))
+            self.execute("INSERT INTO %s %s" % (table, query))
+
+        self.execute("DELETE FROM temp.changed_facts")
+        self.execute("DELETE FROM temp.changed_days")
+
+    def __import_facts(self, records):
+        """adds the (activity, category, description, tags, start_time,
+           end_time) records in one transaction. names are resolved in memory,
+           facts and their tags go in by the chunk and overlaps are solved
+           once everything is in. records with no end time are skipped, as
+           are the ones that are already there. returns the number of
+           imported and skipped records"""
+        self.start_batch()
+        try:
+            categories = {}
+            for id, name in self.fetchall("SELECT id, name FROM categories ORDER BY id",
+                                          as_tuples = True):
+                categories[name.lower()] = id
+
+            # the same preference as in __get_activity_by_name - not deleted
+            # ones first, then the most recent
+            activities = {}
+            for id, name, category_id, deleted in self.fetchall("""
+                           SELECT id, name, coalesce(category_id, -1), deleted
+                             FROM activities
+                         ORDER BY deleted DESC, id""", as_tuples = True):
+                activities[(name.lower(), category_id)] = (id, deleted)
+
+            tags = {}
+            for id, name, autocomplete in self.fetchall("SELECT id, name, autocomplete FROM tags",
+                                                        as_tuples = True):
+                tags[name] = (id, autocomplete)
+
+
+            def get_category_id(name):
+                if not name or name == _("Unsorted"):
+                    return -1
+                if name.lower() not in categories:
+                    categories[name.lower()] = self.__add_category(name)
+                return categories[name.lower()]
+
+            def get_activity_id(name, category_id):
+                key = (name.lower(), category_id)
+                if key not in activities:
+                    self.execute("""INSERT INTO activities (name, search_name, category_id)
+                                         VALUES (?, ?, ?)""", (name, name.lower(), category_id))
+                    activities[key] = (self.__last_insert_rowid(), None)
+                elif activities[key][1]:
+                    self.execute("UPDATE activities SET deleted = null WHERE id = ?",
+                                 (activities[key][0],))
+                    activities[key] = (activities[key][0], None)
+                return activities[key][0]
+
+            def get_tag_id(name):
+                if name not in tags:
+                    self.execute("INSERT INTO tags (name) VALUES (?)", (name,))
+                    tags[name] = (self.__last_insert_rowid(), "true")
+                elif tags[name][1] == "false":
+                    self.execute("UPDATE tags SET autocomplete = 'true' WHERE id = ?",
+                                 (tags[name][0],))
+                    tags[name] = (tags[name][0], "true")
+                return tags[name][0]
+
+
+            # ids are handed out here, so that the tags can go in by the chunk too
+            first_id = self.fetchone("""
+                           SELECT max(coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'facts'), 0),
+                                      coalesce((SELECT max(id) FROM facts), 0)) + 1""")[0]
+            next_id, skipped = [first_id], 0
+            pending = []
+
+            def flush():
+                """inserts the pending facts, leaving out the ones that are
+                   there already or come twice"""
+                if not pending:
+                    return 0
+
+                # overlaps of the imported facts have been sorted out since,
+                # so they are told by the records they came from
+                span = (min(fact[1] for fact in pending), max(fact[1] for fact in pending))
+                existing = set(self.fetchall("""SELECT start_time, end_time, activity_id
+                                                  FROM facts
+                                                 WHERE start_time BETWEEN ? AND ?
+                                                 UNION
+                                                SELECT start_time, end_time, activity_id
+                                                  FROM imported_facts
+                                                 WHERE start_time BETWEEN ? AND ?""",
+                                             span + span, as_tuples = True))
+                fact_rows, tag_rows, keys = [], [], []
+                for activity_id, start_time, end_time, description, tag_ids in pending:
+                    if (start_time, end_time, activity_id) in existing:
+                        continue
+                    existing.add((start_time, end_time, activity_id))
+                    keys.append((start_time, end_time, activity_id))
+
+                    fact_id = next_id[0]
+                    next_id[0] += 1
+                    fact_rows.append((fact_id, activity_id, start_time, end_time, description))
+                    tag_rows.extend([(fact_id, tag_id) for tag_id in tag_ids])
+
+                # tags go first. that way the triggers on facts index and
+                # roll them up along with the fact, and the ones on fact_tags
+                # have nothing to do yet
+                self.executemany("INSERT INTO fact_tags (fact_id, tag_id) VALUES (?, ?)", tag_rows)
+                self.executemany("""INSERT INTO facts (id, activity_id, start_time, end_time, description)
+                                         VALUES (?, ?, ?, ?, ?)""", fact_rows)
+                self.executemany("""INSERT INTO imported_facts (start_time, end_time, activity_id)
+                                         VALUES (?, ?, ?)""", keys)
+
+                duplicates = len(pending) - len(fact_rows)
+                del pending[:]
+                return duplicates
+
+            for activity, category, description, fact_tags, start_time, end_time in records:
+                if not activity or not start_time or not end_time or end_time < start_time:
+                    skipped += 1
+                    continue
+
+                activity_id = get_activity_id(activity, get_category_id(category))
+                pending.append((activity_id, to_epoch(start_time), to_epoch(end_time),
+                                description or None, set([get_tag_id(tag) for tag in fact_tags])))
+
+                if len(pending) == IMPORT_CHUNK:
+                    skipped += flush()
+            skipped += flush()
+
+            self.__repair_overlaps(first_id)
+        except:
+            self.cancel_batch()
+            raise
+        self.end_batch()
+
+        return next_id[0] - first_id, skipped
+
+    def __repair_overlaps(self, first_id = 0):
+        """solves overlaps of the facts from the given id on, as if they had
+           been added one by one - later facts push earlier ones aside.
+           facts that fit completely in a later one are left as they are.
+           returns the number of overlaps found"""
+        span = self.fetchone("SELECT min(start_time), max(end_time) FROM facts WHERE id >= ?",
+                             (first_id,), as_tuples = True)
+        if span[0] is None:
+            return 0
+
+        facts = self.fetchall("""SELECT id, start_time, end_time
+                                   FROM facts
+                                  WHERE end_time > ? AND start_time < ?
+                               ORDER BY start_time, id""", span, as_tuples = True)
+
+        # sweep through the facts, keeping the ones that have not ended yet.
+        # of each overlapping pair, the later added fact makes room for itself
+        overlaps, pushing = 0, set()
+        running = []
+        for fact in facts:
+            running = [other for other in running if other[2] > fact[1]]
+            for other in running:
+                if max(fact[0], other[0]) >= first_id:
+                    overlaps += 1
+                    pushing.add(max(fact[0], other[0]))
+            running.append(fact)
+
+        for fact_id in sorted(pushing, reverse = True):
+            fact = self.fetchone("SELECT start_time, end_time FROM facts WHERE id = ?", (fact_id,))
+            self.__solve_overlaps(from_epoch(fact["start_time"]), from_epoch(fact["end_time"]))
+
+        return overlaps
 
     def __remove_fact(self, fact_id):
         statements = ["DELETE FROM fact_tags where fact_id = ?",
                       "DELETE FROM facts where id = ?"]
         self.execute(statements, [(fact_id,)] * 2)
 
-        self.__remove_index([fact_id])
-
     def __get_category_activities(self, category_id):
         """returns list of activities, if category is specified, order by name
            otherwise - by activity_order"""
@@ -742,25 +1693,52 @@ class Storage(storage.Storage):
 
 
     def __get_activities(self, search):
-        """returns list of activities for autocomplete,
-           activity names converted to lowercase"""
-
-        query = """
-                   SELECT a.name AS name, b.name AS category
-                     FROM activities a
-                LEFT JOIN categories b ON coalesce(b.id, -1) = a.category_id
-                LEFT JOIN facts f ON a.id = f.activity_id
-                    WHERE deleted IS NULL
-                      AND a.search_name LIKE ? ESCAPE '\\'
-                 GROUP BY a.id
-                 ORDER BY max(f.start_time) DESC, lower(a.name)
-                    LIMIT 50
-        """
-        search = search.lower()
-        search = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
-        activities = self.fetchall(query, (u'%s%%' % search, ))
-
-        return activities
+        """returns list of activities for autocomplete, the ones starting
+           with the search, case insensitive, most recently used first"""
+        if self.__activity_index is None:
+            rows = self.fetchall("""SELECT a.search_name, a.name, b.name, a.last_used
+                                      FROM activities a
+                                 LEFT JOIN categories b ON b.id = a.category_id
+                                     WHERE a.deleted IS NULL""", as_tuples = True)
+            self.__activity_index = ActivityIndex([(search_name or name.lower(), name, category, last_used)
+                                                   for search_name, name, category, last_used in rows])
+
+        return [{"name": name, "category": category}
+                    for search_name, name, category, last_used in self.__activity_index.find(search.lower())]
+
+    def __get_matches(self, search, kind = "", limit = 10):
+        """activities and categories with names like the search, also when
+           partial or misspelt, as (kind, activity, category, score), best
+           first. kind limits the search to activities or categories"""
+        if self.__match_index is None:
+            activities, categories = [], {}
+            for id, name, category, last_used, uses in self.fetchall("""
+                           SELECT a.id, a.name, coalesce(b.name, ''), a.last_used, coalesce(u.uses, 0)
+                             FROM activities a
+                        LEFT JOIN categories b ON b.id = a.category_id
+                        LEFT JOIN (SELECT activity_id, sum(facts) AS uses
+                                     FROM activity_months
+                                 GROUP BY activity_id) u ON u.activity_id = a.id
+                            WHERE a.deleted IS NULL""", as_tuples = True):
+                activities.append((("activity", name, category), name, uses, last_used))
+
+                # categories are as used as their activities
+                if category:
+                    category_uses, category_last_used = categories.get(category, (0, None))
+                    categories[category] = (category_uses + uses, max(category_last_used, last_used))
+
+            now = to_epoch(dt.datetime.now())
+            self.__match_index = {
+                "activity": trigrams.TrigramIndex(activities, now),
+                "category": trigrams.TrigramIndex([(("category", "", name), name, uses, last_used)
+                                                   for name, (uses, last_used) in categories.iteritems()], now)}
+
+        matches = []
+        for index_kind, index in self.__match_index.iteritems():
+            if kind in ("", index_kind):
+                matches.extend(index.find(search, limit))
+
+        return [key + (score,) for score, key in heapq.nlargest(limit, matches)]
 
     def __remove_activity(self, id):
         """ check if we have any facts with this activity and behave accordingly
@@ -781,21 +1759,11 @@ class Storage(storage.Storage):
 
     def __remove_category(self, id):
         """move all activities to unsorted and remove category"""
-
-        affected_query = """
-            SELECT id
-              FROM facts
-             WHERE activity_id in (SELECT id FROM activities where category_id=?)
-        """
-        affected_ids = [res[0] for res in self.fetchall(affected_query, (id,))]
-
         update = "update activities set category_id = -1 where category_id = ?"
         self.execute(update, (id, ))
 
         self.execute("delete from categories where id = ?", (id, ))
 
-        self.__remove_index(affected_ids)
-
 
     def __add_activity(self, name, category_id = None, temporary = False):
         # first check that we don't have anything like that yet
@@ -818,80 +1786,130 @@ class Storage(storage.Storage):
         self.execute(query, (name, name.lower(), category_id, deleted))
         return self.__last_insert_rowid()
 
-    def __remove_index(self, ids):
-        """remove affected ids from the index"""
-        if not ids:
-            return
+    """ Here be dragons (lame connection/cursor wrappers) """
+    def get_connection(self):
+        if self.con is None:
+            from configuration import conf
+            statement_cache = conf.get("db_statement_cache")
+            self.con = sqlite.connect(self.db_path,
+                                      cached_statements = statement_cache)
+            self.con.row_factory = sqlite.Row
+            self.__tune_connection(self.con)
+            self.__create_temp_tables(self.con)
+            self.__data_version = self.con.execute("PRAGMA data_version").fetchone()[0]
+
+            # one cursor serves all the queries of the connection, except
+            # for the bulk ones that are fine with plain tuples
+            self.__cursor = self.con.cursor()
+            self.__tuple_cursor = self.con.cursor()
+            self.__tuple_cursor.row_factory = None
+            if self.__statements and self.__statements.size == statement_cache:
+                self.__statements.clear() # new connection, nothing prepared yet
+            else:
+                self.__statements = StatementCache(statement_cache)
 
-        ids = ",".join((str(id) for id in ids))
-        self.execute("DELETE FROM fact_index where id in (%s)" % ids)
+        return self.con
 
+    connection = property(get_connection, None)
 
-    def __check_index(self, start_date, end_date):
-        """check if maybe index needs rebuilding in the time span"""
-        index_query = """SELECT id
-                           FROM facts
-                          WHERE (end_time >= ? OR end_time IS NULL)
-                            AND start_time <= ?
-                            AND id not in(select id from fact_index)"""
+    def __tune_connection(self, con):
+        """switch to write-ahead log and set cache sizes as configured"""
+        from configuration import conf
 
-        rebuild_ids = ",".join([str(res[0]) for res in self.fetchall(index_query, (start_date, end_date))])
+        synchronous = conf.get("db_synchronous").upper()
+        if synchronous not in ("OFF", "NORMAL", "FULL"):
+            logging.warn("Unknown synchronous level %s, using NORMAL" % synchronous)
+            synchronous = "NORMAL"
 
-        if rebuild_ids:
-            query = """
-                       SELECT a.id AS id,
-                              a.start_time AS start_time,
-                              a.end_time AS end_time,
-                              a.description as description,
-                              b.name AS name, b.id as activity_id,
-                              coalesce(c.name, ?) as category,
-                              e.name as tag
-                         FROM facts a
-                    LEFT JOIN activities b ON a.activity_id = b.id
-                    LEFT JOIN categories c ON b.category_id = c.id
-                    LEFT JOIN fact_tags d ON d.fact_id = a.id
-                    LEFT JOIN tags e ON e.id = d.tag_id
-                        WHERE a.id in (%s)
-                     ORDER BY a.id
-            """ % rebuild_ids
+        cur = con.cursor()
+        cur.execute("PRAGMA journal_mode = WAL")
+        cur.execute("PRAGMA synchronous = %s" % synchronous)
+        cur.execute("PRAGMA cache_size = %d" % -conf.get("db_cache_kilobytes"))
+        cur.execute("PRAGMA mmap_size = %d" % (conf.get("db_mmap_kilobytes") * 1024))
+        cur.close()
 
-            facts = self.__group_tags(self.fetchall(query, (_("Unsorted"), )))
+    def __create_temp_tables(self, con):
+        """scratch tables of the connection. they are made as it opens, as
+           sqlite3 commits whatever transaction is open before it runs any
+           statement other than an insert, update or delete"""
+        cur = con.cursor()
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS tag_names (name PRIMARY KEY)")
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS changed_facts (id integer PRIMARY KEY)")
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS changed_days (day integer PRIMARY KEY)")
+        cur.close()
 
-            insert = """INSERT INTO fact_index (id, name, category, description, tag)
-                             VALUES (?, ?, ?, ?, ?)"""
-            params = [(fact['id'], fact['name'], fact['category'], fact['description'], " ".join(fact['tags'])) for fact in facts]
+    def __read(self, func, args, reply_handler = None, error_handler = None):
+        """runs the query function in one of the reader threads when called
+           with dbus async callbacks. otherwise returns its result right away"""
+        if reply_handler is None:
+            return func(*args)
 
-            self.executemany(insert, params)
+        from configuration import conf
+        threads = conf.get("db_read_threads")
+        if threads <= 0:
+            reply_handler(func(*args))
+            return
 
+        if self.__readers is None:
+            # the settings are read here, the conf is not for threads
+            settings = (conf.get("db_cache_kilobytes"), conf.get("db_mmap_kilobytes"))
+            self.__readers = ReaderPool(threads, lambda: self.__connect_reader(*settings))
 
-    """ Here be dragons (lame connection/cursor wrappers) """
-    def get_connection(self):
-        if self.con is None:
-            self.con = sqlite.connect(self.db_path, detect_types=sqlite.PARSE_DECLTYPES|sqlite.PARSE_COLNAMES)
-            self.con.row_factory = sqlite.Row
+        self.__readers.run(func, args, reply_handler, error_handler)
 
-        return self.con
+    def __connect_reader(self, cache_kilobytes, mmap_kilobytes):
+        """opens the read-only connection of the current reader thread, or
+           reopens it when the database file has been replaced"""
+        reader = self.__reader
+        if getattr(reader, "generation", None) == self.__file_generation:
+            return
 
-    connection = property(get_connection, None)
+        if getattr(reader, "con", None):
+            reader.con.close()
 
-    def fetchall(self, query, params = None):
-        con = self.connection
-        cur = con.cursor()
+        reader.generation = self.__file_generation
+        reader.con = sqlite.connect(self.db_path)
+        reader.con.row_factory = sqlite.Row
+
+        cur = reader.con.cursor()
+        cur.execute("PRAGMA query_only = ON")
+        cur.execute("PRAGMA cache_size = %d" % -cache_kilobytes)
+        cur.execute("PRAGMA mmap_size = %d" % (mmap_kilobytes * 1024))
+        cur.close()
 
-        logging.debug("%s %s" % (query, params))
+        reader.cursor = reader.con.cursor()
+        reader.tuple_cursor = reader.con.cursor()
+        reader.tuple_cursor.row_factory = None
+
+    def __get_cache_stats(self):
+        self.get_connection()
+        stats = self.__statements.stats()
+        stats.update(self.__results.stats())
+        return stats
+
+    def fetchall(self, query, params = None, as_tuples = False):
+        """returns list of sqlite.Row, or plain tuples if as_tuples is set
+           (cheaper when there are many rows)"""
+        logging.debug("%s %s", query, params)
+
+        reader = self.__reader
+        if hasattr(reader, "cursor"):
+            # in a reader thread
+            cur = reader.tuple_cursor if as_tuples else reader.cursor
+        else:
+            self.get_connection()
+            cur = self.__tuple_cursor if as_tuples else self.__cursor
+            self.__statements.touch(query)
 
         if params:
             cur.execute(query, params)
         else:
             cur.execute(query)
 
-        res = cur.fetchall()
-        cur.close()
-
-        return res
+        return cur.fetchall()
 
-    def fetchone(self, query, params = None):
-        res = self.fetchall(query, params)
+    def fetchone(self, query, params = None, as_tuples = False):
+        res = self.fetchall(query, params, as_tuples)
         if res:
             return res[0]
         else:
@@ -903,45 +1921,330 @@ class Storage(storage.Storage):
         to save on cursor creation and closure
         """
         con = self.__con or self.connection
-        cur = self.__cur or con.cursor()
+        cur = self.__cur or self.__cursor
 
         if isinstance(statement, list) == False: # we expect to receive instructions in list
             statement = [statement]
             params = [params]
 
         for state, param in zip(statement, params):
-            logging.debug("%s %s" % (state, param))
+            logging.debug("%s %s", state, param)
+            self.__check_batch(state)
+            self.__statements.touch(state)
             cur.execute(state, param)
 
         if not self.__con:
             con.commit()
-            cur.close()
-            self.register_modification()
+            self.__dispatch_changes()
 
     def executemany(self, statement, params = []):
         con = self.__con or self.connection
-        cur = self.__cur or con.cursor()
+        cur = self.__cur or self.__cursor
 
-        logging.debug("%s %s" % (statement, params))
+        logging.debug("%s %s", statement, params)
+        self.__check_batch(statement)
+        self.__statements.touch(statement)
         cur.executemany(statement, params)
 
         if not self.__con:
             con.commit()
-            cur.close()
-            self.register_modification()
+            self.__dispatch_changes()
+
 
 
+    def __check_batch(self, statement):
+        """sqlite3 commits the open transaction before any statement that is
+           not a select, insert, update or delete. in a batch that would make
+           part of it stick even if it gets cancelled, so it is not allowed"""
+        if self.__in_batch and \
+           statement.split(None, 1)[0].upper() not in ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE"):
+            raise sqlite.ProgrammingError("Can not run %s in a batch" % statement.split(None, 1)[0])
 
     def start_transaction(self):
-        # will give some hints to execute not to close or commit anything
+        # will give some hints to execute not to commit anything
         self.__con = self.connection
-        self.__cur = self.__con.cursor()
+        self.__cur = self.__cursor
 
     def end_transaction(self):
+        if self.__in_batch:
+            return # the batch commits once it's done
+
         self.__con.commit()
-        self.__cur.close()
         self.__con, self.__cur = None, None
-        self.register_modification()
+        self.__dispatch_changes()
+
+    def start_batch(self):
+        """everything up to end_batch goes in one transaction. only plain
+           data statements can run in it - tables and indexes are made
+           outside of batches"""
+        self.start_transaction()
+        self.__in_batch = True
+
+    def end_batch(self):
+        self.__in_batch = False
+        self.end_transaction()
+
+    def cancel_batch(self):
+        """rolls back everything since start_batch"""
+        self.__in_batch = False
+        self.__con.rollback()
+        self.__con, self.__cur = None, None
+
+    def __create_triggers(self):
+        """triggers that keep the full text index, fact dates and rollups in sync"""
+        fact_tags = """(SELECT group_concat(e.name, ' ')
+                          FROM fact_tags d
+                          JOIN tags e ON e.id = d.tag_id
+                         WHERE d.fact_id = %s)"""
+
+        index_fact = """
+            INSERT INTO fact_index (docid, id, name, category, description, tag)
+                 VALUES (new.id, new.id,
+                         (SELECT name FROM activities WHERE id = new.activity_id),
+                         (SELECT c.name
+                            FROM activities b
+                            JOIN categories c ON c.id = b.category_id
+                           WHERE b.id = new.activity_id),
+                         new.description,
+                         %s);""" % (fact_tags % "new.id")
+
+        self.execute("""CREATE TRIGGER trg_facts_index_insert AFTER INSERT ON facts
+                        BEGIN %s END""" % index_fact)
+        self.execute("""CREATE TRIGGER trg_facts_index_update
+                         AFTER UPDATE OF id, activity_id, description ON facts
+                        BEGIN
+                            DELETE FROM fact_index WHERE docid = old.id;
+                            %s
+                        END""" % index_fact)
+        self.execute("""CREATE TRIGGER trg_facts_index_delete AFTER DELETE ON facts
+                        BEGIN
+                            DELETE FROM fact_index WHERE docid = old.id;
+                        END""")
+
+        for event, row in (("INSERT", "new"), ("DELETE", "old")):
+            self.execute("""CREATE TRIGGER trg_fact_tags_index_%(event)s AFTER %(event)s ON fact_tags
+                            BEGIN
+                                UPDATE fact_index
+                                   SET tag = %(tags)s
+                                 WHERE docid = %(row)s.fact_id;
+                            END""" % {"event": event.lower(), "row": row,
+                                      "tags": fact_tags % ("%s.fact_id" % row)})
+
+        self.execute("""CREATE TRIGGER trg_activities_index_update
+                         AFTER UPDATE OF name, category_id ON activities
+                        BEGIN
+                            UPDATE fact_index
+                               SET name = new.name,
+                                   category = (SELECT name FROM categories WHERE id = new.category_id)
+                             WHERE docid IN (SELECT id FROM facts WHERE activity_id = new.id);
+                        END""")
+
+        for event, row, name in (("UPDATE OF name", "new", "new.name"),
+                                 ("DELETE", "old", "null")):
+            self.execute("""CREATE TRIGGER trg_categories_index_%(trigger)s AFTER %(event)s ON categories
+                            BEGIN
+                                UPDATE fact_index
+                                   SET category = %(name)s
+                                 WHERE docid IN (SELECT f.id
+                                                   FROM facts f
+                                                   JOIN activities a ON a.id = f.activity_id
+                                                  WHERE a.category_id = %(row)s.id);
+                            END""" % {"trigger": event.split()[0].lower(), "event": event,
+                                      "name": name, "row": row})
+
+        self.execute("""CREATE TRIGGER trg_tags_index_update AFTER UPDATE OF name ON tags
+                        BEGIN
+                            UPDATE fact_index
+                               SET tag = %s
+                             WHERE docid IN (SELECT fact_id FROM fact_tags WHERE tag_id = new.id);
+                        END""" % (fact_tags % "fact_index.docid"))
+
+        self.execute("""CREATE TRIGGER trg_facts_span_insert AFTER INSERT ON facts
+                        BEGIN
+                            INSERT INTO fact_spans (id, start_time, end_time)
+                                 VALUES (new.id, %(start)s, %(end)s);
+                        END""" % FACT_SPAN % {"row": "new."})
+        self.execute("""CREATE TRIGGER trg_facts_span_update AFTER UPDATE OF start_time, end_time ON facts
+                        BEGIN
+                            UPDATE fact_spans
+                               SET start_time = %(start)s, end_time = %(end)s
+                             WHERE id = new.id;
+                        END""" % FACT_SPAN % {"row": "new."})
+        self.execute("""CREATE TRIGGER trg_facts_span_delete AFTER DELETE ON facts
+                        BEGIN
+                            DELETE FROM fact_spans WHERE id = old.id;
+                        END""")
+
+        # start of the last fact of each activity, for autocomplete. when
+        # the last one moves away, the one before it is looked up
+        last_used = {"new": """UPDATE activities
+                                  SET last_used = new.start_time
+                                WHERE id = new.activity_id
+                                  AND coalesce(last_used, 0) < new.start_time;""",
+                     "old": """UPDATE activities
+                                  SET last_used = (SELECT max(start_time)
+                                                     FROM facts
+                                                    WHERE activity_id = old.activity_id)
+                                WHERE id = old.activity_id
+                                  AND last_used <= old.start_time;"""}
+        self.execute("""CREATE TRIGGER trg_facts_last_used_insert AFTER INSERT ON facts
+                        BEGIN %(new)s END""" % last_used)
+        self.execute("""CREATE TRIGGER trg_facts_last_used_update
+                         AFTER UPDATE OF activity_id, start_time ON facts
+                        BEGIN %(old)s %(new)s END""" % last_used)
+        self.execute("""CREATE TRIGGER trg_facts_last_used_delete AFTER DELETE ON facts
+                        BEGIN %(old)s END""" % last_used)
+
+        # number of facts each tag is on
+        for event, row, sign in (("INSERT", "new", "+"), ("DELETE", "old", "-")):
+            self.execute("""CREATE TRIGGER trg_fact_tags_uses_%(event)s AFTER %(event)s ON fact_tags
+                            BEGIN
+                                UPDATE tags SET uses = uses %(sign)s 1 WHERE id = %(row)s.tag_id;
+                            END""" % {"event": event.lower(), "row": row, "sign": sign})
+
+        update_date = """UPDATE facts
+                            SET fact_date = %s
+                          WHERE id = new.id;""" % FACT_DATE % {"prefix": "new."}
+        self.execute("""CREATE TRIGGER trg_facts_date_insert AFTER INSERT ON facts
+                        BEGIN %s END""" % update_date)
+        self.execute("""CREATE TRIGGER trg_facts_date_update AFTER UPDATE OF start_time, end_time ON facts
+                        BEGIN %s END""" % update_date)
+
+        # rollups. the fact date is set by a trigger after the insert, so
+        # most of the work happens on update
+        def rollup_fact(row, sign):
+            statements = []
+            for suffix, column, period in ROLLUP_PERIODS:
+                statements.append("""
+                    INSERT OR IGNORE INTO activity_%(suffix)s (%(column)s, activity_id, duration, facts)
+                         SELECT %(period)s, %(row)s.activity_id, 0, 0
+                          WHERE %(row)s.end_time IS NOT NULL AND %(row)s.fact_date IS NOT NULL;
+                    UPDATE activity_%(suffix)s
+                       SET duration = duration %(sign)s (%(row)s.end_time - %(row)s.start_time),
+                           facts = facts %(sign)s 1
+                     WHERE %(column)s = %(period)s
+                       AND activity_id = %(row)s.activity_id
+                       AND %(row)s.end_time IS NOT NULL;
+
+                    INSERT OR IGNORE INTO tag_%(suffix)s (%(column)s, tag_id, duration, facts)
+                         SELECT %(period)s, tag_id, 0, 0
+                           FROM fact_tags
+                          WHERE fact_id = %(row)s.id
+                            AND %(row)s.end_time IS NOT NULL AND %(row)s.fact_date IS NOT NULL;
+                    UPDATE tag_%(suffix)s
+                       SET duration = duration %(sign)s (%(row)s.end_time - %(row)s.start_time),
+                           facts = facts %(sign)s 1
+                     WHERE %(column)s = %(period)s
+                       AND tag_id IN (SELECT tag_id FROM fact_tags WHERE fact_id = %(row)s.id)
+                       AND %(row)s.end_time IS NOT NULL;""" % {"suffix": suffix, "column": column,
+                                                               "period": period % (row + ".fact_date"),
+                                                               "row": row, "sign": sign})
+            return "".join(statements)
+
+        def rollup_cleanup(condition):
+            statements = []
+            for suffix, column, period in ROLLUP_PERIODS:
+                for table in ("activity", "tag"):
+                    statements.append("DELETE FROM %s_%s WHERE %s AND facts = 0;" % \
+                                          (table, suffix, condition % {"column": column,
+                                                                       "period": period % "old.fact_date"}))
+            return "\n".join(statements)
+
+        self.execute("""CREATE TRIGGER trg_facts_rollup_insert AFTER INSERT ON facts
+                         WHEN new.end_time IS NOT NULL
+                        BEGIN %s END""" % rollup_fact("new", "+"))
+        self.execute("""CREATE TRIGGER trg_facts_rollup_update
+                         AFTER UPDATE OF activity_id, start_time, end_time, fact_date ON facts
+                         WHEN old.end_time IS NOT NULL OR new.end_time IS NOT NULL
+                        BEGIN %s %s %s END""" % (rollup_fact("old", "-"),
+                                                 rollup_cleanup("%(column)s = %(period)s"),
+                                                 rollup_fact("new", "+")))
+        self.execute("""CREATE TRIGGER trg_facts_rollup_delete AFTER DELETE ON facts
+                         WHEN old.end_time IS NOT NULL
+                        BEGIN %s %s END""" % (rollup_fact("old", "-"),
+                                              rollup_cleanup("%(column)s = %(period)s")))
+
+        def rollup_tag(row, sign):
+            statements = []
+            for suffix, column, period in ROLLUP_PERIODS:
+                statements.append("""
+                    INSERT OR IGNORE INTO tag_%(suffix)s (%(column)s, tag_id, duration, facts)
+                         SELECT %(period)s, %(row)s.tag_id, 0, 0
+                           FROM facts
+                          WHERE id = %(row)s.fact_id
+                            AND end_time IS NOT NULL AND fact_date IS NOT NULL;
+                    UPDATE tag_%(suffix)s
+                       SET duration = duration %(sign)s (SELECT end_time - start_time
+                                                           FROM facts
+                                                          WHERE id = %(row)s.fact_id),
+                           facts = facts %(sign)s 1
+                     WHERE tag_id = %(row)s.tag_id
+                       AND %(column)s = (SELECT %(period)s
+                                           FROM facts
+                                          WHERE id = %(row)s.fact_id AND end_time IS NOT NULL);""" % \
+                                  {"suffix": suffix, "column": column, "period": period % "fact_date",
+                                   "row": row, "sign": sign})
+            return "".join(statements)
+
+        self.execute("""CREATE TRIGGER trg_fact_tags_rollup_insert AFTER INSERT ON fact_tags
+                        BEGIN %s END""" % rollup_tag("new", "+"))
+        cleanup = ["""DELETE FROM tag_%s
+                       WHERE %s = (SELECT %s FROM facts WHERE id = old.fact_id)
+                         AND tag_id = old.tag_id AND facts = 0;""" % (suffix, column, period % "fact_date")
+                                                for suffix, column, period in ROLLUP_PERIODS]
+        self.execute("""CREATE TRIGGER trg_fact_tags_rollup_delete AFTER DELETE ON fact_tags
+                        BEGIN
+                            %s
+                            %s
+                        END""" % (rollup_tag("old", "-"), "\n".join(cleanup)))
+
+        # change log. facts get their date by the trigger above, so inserts
+        # are mostly logged on that update
+        log_fact = """INSERT INTO changes (kind, item_id, start_date, end_date)
+                           VALUES ('fact', %(row)s.id, %(start)s, %(end)s);"""
+        self.execute("""CREATE TRIGGER trg_facts_log_insert AFTER INSERT ON facts
+                         WHEN new.fact_date IS NOT NULL
+                        BEGIN %s END""" % log_fact % {"row": "new",
+                                                      "start": "new.fact_date",
+                                                      "end": "new.fact_date"})
+        self.execute("""CREATE TRIGGER trg_facts_log_update AFTER UPDATE ON facts
+                        BEGIN %s END""" % log_fact % {
+                            "row": "new",
+                            "start": "min(coalesce(old.fact_date, new.fact_date), coalesce(new.fact_date, old.fact_date))",
+                            "end": "max(coalesce(old.fact_date, new.fact_date), coalesce(new.fact_date, old.fact_date))"})
+        self.execute("""CREATE TRIGGER trg_facts_log_delete AFTER DELETE ON facts
+                        BEGIN %s END""" % log_fact % {"row": "old",
+                                                      "start": "old.fact_date",
+                                                      "end": "old.fact_date"})
+
+        for event, row in (("INSERT", "new"), ("DELETE", "old")):
+            self.execute("""CREATE TRIGGER trg_fact_tags_log_%(event)s AFTER %(event)s ON fact_tags
+                            BEGIN
+                                INSERT INTO changes (kind, item_id, start_date, end_date)
+                                     SELECT 'fact', id, fact_date, fact_date
+                                       FROM facts
+                                      WHERE id = %(row)s.fact_id;
+                            END""" % {"event": event.lower(), "row": row})
+
+        # last_used of an activity moves with its facts, the activity itself
+        # stays the same
+        for kind, table, columns in (("activity", "activities", " OF name, search_name, category_id, deleted"),
+                                     ("category", "categories", ""),
+                                     ("tag", "tags", "")):
+            for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+                self.execute("""CREATE TRIGGER trg_%(table)s_log_%(trigger)s AFTER %(event)s ON %(table)s
+                                BEGIN
+                                    INSERT INTO changes (kind, item_id) VALUES ('%(kind)s', %(row)s.id);
+                                END""" % {"table": table, "trigger": event.lower(),
+                                          "event": event + columns if event == "UPDATE" else event,
+                                          "kind": kind, "row": row})
+
+        self.execute("""CREATE TRIGGER trg_changes_prune AFTER INSERT ON changes
+                         WHEN new.id %% 1000 = 0
+                        BEGIN
+                            DELETE FROM changes WHERE id <= new.id - %d;
+                        END""" % CHANGES_KEPT)
+
 
     def run_fixtures(self):
         self.start_transaction()
@@ -960,7 +2263,13 @@ class Storage(storage.Storage):
 
         """upgrade DB to hamster version"""
         version = self.fetchone("SELECT version FROM version")["version"]
-        current_version = 9
+        current_version = 19
+
+        if version < current_version:
+            # triggers get in the way of the migration. they are set up
+            # anew once the tables are in shape
+            for trigger in self.fetchall("SELECT name FROM sqlite_master WHERE type = 'trigger'"):
+                self.execute("DROP TRIGGER %s" % trigger["name"])
 
         if version < 2:
             """moving from fact_date, fact_time to start_time, end_time"""
@@ -1174,9 +2483,139 @@ class Storage(storage.Storage):
             self.execute("""CREATE VIRTUAL TABLE fact_index
                                            USING fts3(id, name, category, description, tag)""")
 
+        if version < 10:
+            # the full text index is maintained by triggers. fact id doubles
+            # as the docid, so the index rows can be looked up directly
+            self.execute("DROP TABLE fact_index")
+            self.execute("""CREATE VIRTUAL TABLE fact_index
+                                           USING fts3(id, name, category, description, tag)""")
+
+            self.execute("""INSERT INTO fact_index (docid, id, name, category, description, tag)
+                                 %s""" % FACT_INDEX_ROWS)
+
+        if version < 11:
+            # the hamster day of each fact is stored, so that date ranges can
+            # be looked up in the index. hamster midnight is kept in the
+            # settings table for the triggers to see
+            self.execute("CREATE TABLE settings (name varchar2 PRIMARY KEY, value)")
+            self.execute("INSERT INTO settings (name, value) VALUES ('day_start_minutes', ?)",
+                         (5 * 60 + 30,))
+
+            self.execute("ALTER TABLE facts ADD COLUMN fact_date date")
+            self.execute("CREATE INDEX idx_facts_date ON facts(fact_date)")
+
+        if version < 12:
+            # store times and dates in seconds since epoch of the local time,
+            # same as what we send over d-bus. saves on parsing them back
+            self.execute("""CREATE TABLE facts_new (id integer primary key autoincrement,
+                                                    activity_id integer,
+                                                    start_time integer,
+                                                    end_time integer,
+                                                    description varchar2,
+                                                    fact_date integer)""")
+            self.execute("""INSERT INTO facts_new(id, activity_id, start_time, end_time, description)
+                                 SELECT id, activity_id,
+                                        strftime('%s', start_time), strftime('%s', end_time),
+                                        description
+                                   FROM facts""")
+            self.execute("DROP TABLE facts")
+            self.execute("ALTER TABLE facts_new RENAME TO facts")
+
+            self.execute("UPDATE facts SET fact_date = %s" % FACT_DATE % {"prefix": ""})
+
+            self.execute("CREATE INDEX idx_facts_start_end ON facts(start_time, end_time)")
+            self.execute("CREATE INDEX idx_facts_start_end_activity ON facts(start_time, end_time, activity_id)")
+            self.execute("CREATE INDEX idx_facts_date ON facts(fact_date)")
+
+        if version < 13:
+            # per day and month durations, so that totals of long ranges do
+            # not have to go through all the facts
+            for suffix, column, period in ROLLUP_PERIODS:
+                self.execute("""CREATE TABLE activity_%s (%s integer,
+                                                          activity_id integer,
+                                                          duration integer,
+                                                          facts integer,
+                                                          PRIMARY KEY (%s, activity_id))""" % (suffix, column, column))
+                self.execute("""CREATE TABLE tag_%s (%s integer,
+                                                     tag_id integer,
+                                                     duration integer,
+                                                     facts integer,
+                                                     PRIMARY KEY (%s, tag_id))""" % (suffix, column, column))
+            self.__rebuild_rollups()
+
+            # ongoing facts are looked up separately
+            self.execute("CREATE INDEX idx_facts_ongoing ON facts(fact_date) WHERE end_time IS NULL")
+
+        if version < 14:
+            # log of what has changed, filled by triggers. kind is one of
+            # fact, activity, category and tag; dates are set for facts only
+            self.execute("""CREATE TABLE changes (id integer primary key autoincrement,
+                                                  kind varchar2,
+                                                  item_id integer,
+                                                  start_date integer,
+                                                  end_date integer)""")
+
+        if version < 15:
+            # overlapping facts are looked up by their span
+            self.execute("CREATE VIRTUAL TABLE fact_spans USING rtree(id, start_time, end_time)")
+            self.execute("""INSERT INTO fact_spans (id, start_time, end_time)
+                                 SELECT id, %(start)s, %(end)s
+                                   FROM facts""" % FACT_SPAN % {"row": ""})
+
+        if version < 16:
+            # autocomplete ranks activities by their last use
+            self.execute("CREATE INDEX idx_facts_activity ON facts(activity_id, start_time)")
+            self.execute("ALTER TABLE activities ADD COLUMN last_used integer")
+            self.execute("""UPDATE activities
+                               SET last_used = (SELECT max(start_time)
+                                                  FROM facts
+                                                 WHERE activity_id = activities.id)""")
+
+        if version < 17:
+            # tags are logged as changed also when put on a fact or taken off
+            # one, so that clients can keep their usage counts - since 18 by
+            # the update of tags.uses that the fact_tags triggers make.
+            # nothing to convert, the triggers are made anew below
+            pass
+
+        if version < 18:
+            # tags are added with INSERT OR IGNORE, which needs the names to
+            # be unique. facts of a duplicate go to the first tag of the name
+            duplicates = self.fetchone("SELECT count(*) - count(DISTINCT name) FROM tags")[0]
+            if duplicates:
+                self.execute("""UPDATE fact_tags
+                                   SET tag_id = (SELECT min(b.id)
+                                                   FROM tags a
+                                                   JOIN tags b ON b.name = a.name
+                                                  WHERE a.id = fact_tags.tag_id)""")
+                self.execute("""DELETE FROM fact_tags
+                                 WHERE rowid NOT IN (SELECT min(rowid)
+                                                       FROM fact_tags
+                                                   GROUP BY fact_id, tag_id)""")
+                self.execute("DELETE FROM tags WHERE id NOT IN (SELECT min(id) FROM tags GROUP BY name)")
+                self.__rebuild_rollups()
+            self.execute("DROP INDEX idx_tags_name")
+            self.execute("CREATE UNIQUE INDEX idx_tags_name ON tags(name)")
+
+            # the number of facts each tag is on, kept by triggers
+            self.execute("ALTER TABLE tags ADD COLUMN uses integer DEFAULT 0")
+            self.execute("""UPDATE tags
+                               SET uses = (SELECT count(*)
+                                             FROM fact_tags
+                                            WHERE tag_id = tags.id)""")
+
+        if version < 19:
+            # start, end and activity of the imported records, as they were
+            # before the overlaps got sorted out, to skip them on import again
+            self.execute("""CREATE TABLE imported_facts (start_time integer,
+                                                         end_time integer,
+                                                         activity_id integer,
+                                                         PRIMARY KEY (start_time, end_time, activity_id))""")
 
         # at the happy end, update version number
         if version < current_version:
+            self.__create_triggers()
+
             #lock down current version
             self.execute("UPDATE version SET version = %d" % current_version)
             print "updated database from version %d to %d" % (version, current_version)
@@ -1185,6 +2624,11 @@ class Storage(storage.Storage):
             trophies.unlock("oldtimer")
 
 
+        # hamster midnight might have been changed while we were away
+        from configuration import conf
+        self.__set_day_start(conf.get("day_start_minutes"))
+
+
         """we start with an empty database and then populate with default
            values. This way defaults can be localized!"""
 
@@ -1199,5 +2643,7 @@ class Storage(storage.Storage):
             for entry in nonwork_category["entries"]:
                 self.__add_activity(entry, nonwork_cat_id)
 
+        # nobody is listening yet
+        self.__last_change = self.__get_last_change()
 
         self.end_transaction()
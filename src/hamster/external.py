@@ -18,7 +18,7 @@
 # You should have received a copy of the GNU General Public License
 # along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
 
-import logging
+import logging, threading, time, bisect
 from configuration import conf
 import gobject
 import dbus, dbus.mainloop.glib
@@ -30,50 +30,135 @@ except:
     evolution = None
 
 class ActivitiesSource(gobject.GObject):
+    """to-do items of the task manager picked in preferences. they are
+       fetched in the background and kept for activities_source_seconds,
+       so looking them up never waits for the task manager"""
+    __gsignals__ = {
+        "activities-changed": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+    }
+
     def __init__(self):
         gobject.GObject.__init__(self)
-        self.source = conf.get("activities_source")
+        self.source = None
+        self.fetch = None
+        self.__keys, self.__activities = [], [] # sorted by lowercase name
+        self.__fetched = None # when the tasks were last asked for
+        self.__fetching = False
+        self.__generation = 0 # bumped when the tasks we have are no good
+
         self.__gtg_connection = None
+        self.__gtg_watch = None
 
-        if self.source == "evo" and not evolution:
-            self.source == "" # on failure pretend that there is no evolution
-        elif self.source == "gtg":
-            gobject.GObject.__init__(self)
+        self.set_source(conf.get("activities_source"))
+        conf.connect("conf-changed", self.on_conf_changed)
+
+    def set_source(self, source):
+        if self.__gtg_watch:
+            self.__gtg_watch.cancel()
+            self.__gtg_watch = None
+        self.__gtg_connection = None
+
+        self.source, self.fetch = source, None
+        if source == "evo" and evolution:
+            self.fetch = fetch_eds_tasks
+        elif source == "gtg":
             dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+            # gtg coming and going is the only change we get to hear of
+            self.__gtg_watch = dbus.SessionBus().watch_name_owner("org.GTG", self.on_gtg_owner_changed)
+            self.fetch = self.__fetch_gtg_tasks
+        elif source == "mock":
+            self.fetch = MockTasks().fetch
 
-    def get_activities(self, query = None):
-        if not self.source:
-            return []
+        if not self.fetch:
+            self.source = "" # on failure pretend that there is no source
 
-        if self.source == "evo":
-            return [activity for activity in get_eds_tasks()
-                         if query is None or activity['name'].startswith(query)]
+        self.invalidate()
 
-        elif self.source == "gtg":
-            conn = self.__get_gtg_connection()
-            if not conn:
-                return []
+    def on_conf_changed(self, conf, key, value):
+        if key == "activities_source" and value != self.source:
+            self.set_source(value)
 
-            activities = []
+    def on_gtg_owner_changed(self, owner):
+        self.__gtg_connection = None
+        self.invalidate()
 
-            tasks = []
-            try:
-                tasks = conn.get_tasks()
-            except dbus.exceptions.DBusException:  #TODO too lame to figure out how to connect to the disconnect signal
-                self.__gtg_connection = None
-                return self.get_activities(query) # reconnect
+    def invalidate(self):
+        """forget the tasks we have and fetch them again"""
+        self.__generation += 1
+        self.__fetched = None
+        if self.__activities:
+            self.__keys, self.__activities = [], []
+            self.emit("activities-changed")
 
+    def get_activities(self, query = None):
+        """the tasks starting with query, from what has been fetched so far.
+           when they are older than activities_source_seconds they are
+           fetched again in the background and activities-changed is emitted
+           if anything differs"""
+        if not self.source:
+            return []
 
+        if self.__fetched is None or \
+           time.time() - self.__fetched > conf.get("activities_source_seconds"):
+            self.refresh()
+
+        query = (query or "").lower()
+        start = bisect.bisect_left(self.__keys, query)
+        end = start
+        while end < len(self.__keys) and self.__keys[end].startswith(query):
+            end += 1
+        return self.__activities[start:end]
+
+    def refresh(self):
+        """fetches the tasks in the background, one fetch at a time"""
+        if self.__fetching or not self.fetch:
+            return
+        self.__fetching = True
+        self.__fetched = time.time()
+        generation = self.__generation
+
+        def on_tasks(activities):
+            self.__fetching = False
+            if generation != self.__generation:
+                # source switched or tasks changed while we were waiting
+                self.refresh()
+                return
+
+            activities = sorted(activities, key = lambda activity: activity['name'].lower())
+            if activities != self.__activities:
+                self.__keys = [activity['name'].lower() for activity in activities]
+                self.__activities = activities
+                self.emit("activities-changed")
+
+        def on_error(error):
+            # keep what we have, will ask again once it gets old
+            self.__fetching = False
+            logging.warn(error)
+
+        self.fetch(on_tasks, on_error)
+
+    def __fetch_gtg_tasks(self, on_tasks, on_error):
+        conn = self.__get_gtg_connection()
+        if not conn:
+            on_tasks([])
+            return
+
+        def on_gtg_tasks(tasks):
+            activities = []
             for task in tasks:
-                if query is None or task['title'].lower().startswith(query):
-                    name = task['title']
-                    if len(task['tags']):
-                        name = "%s, %s" % (name, " ".join([tag.replace("@", "#") for tag in task['tags']]))
+                name = task['title']
+                if len(task['tags']):
+                    name = "%s, %s" % (name, " ".join([tag.replace("@", "#") for tag in task['tags']]))
+
+                activities.append({"name": name,
+                                   "category": ""})
+            on_tasks(activities)
 
-                    activities.append({"name": name,
-                                       "category": ""})
+        def on_gtg_error(error):
+            self.__gtg_connection = None # reconnect on next fetch
+            on_error(error)
 
-            return activities
+        conn.get_tasks(reply_handler = on_gtg_tasks, error_handler = on_gtg_error)
 
     def __get_gtg_connection(self):
         bus = dbus.SessionBus()
@@ -88,6 +173,52 @@ class ActivitiesSource(gobject.GObject):
             return None
 
 
+_activities_source = None
+def get_activities_source():
+    """the source shared by all the entries, so the tasks are fetched once"""
+    global _activities_source
+    if not _activities_source:
+        _activities_source = ActivitiesSource()
+    return _activities_source
+
+
+def in_thread(func, on_done, on_error):
+    """calls func in a thread of its own and hands the result to on_done,
+       or the exception to on_error, in the main loop"""
+    def run():
+        try:
+            result = func()
+        except Exception, e:
+            gobject.idle_add(on_error, e)
+        else:
+            gobject.idle_add(on_done, result)
+
+    # the front-ends call gobject.threads_init() on startup, before the
+    # main loop is running
+    thread = threading.Thread(target = run)
+    thread.daemon = True
+    thread.start()
+
+
+def fetch_eds_tasks(on_tasks, on_error):
+    # the evolution calls block, so they are made off the main loop
+    in_thread(get_eds_tasks, on_tasks, on_error)
+
+
+class MockTasks(object):
+    """made up tasks that take their time to arrive, to see how a slow task
+       manager feels without one. picked by setting activities_source to
+       "mock" """
+    def __init__(self, count = 1000, delay = 2):
+        self.count, self.delay = count, delay
+
+    def get_tasks(self):
+        time.sleep(self.delay)
+        return [{'name': "Task %d" % i, 'category': "Mock"} for i in range(self.count)]
+
+    def fetch(self, on_tasks, on_error):
+        in_thread(self.get_tasks, on_tasks, on_error)
+
 
 def get_eds_tasks():
     try:
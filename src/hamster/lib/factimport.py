@@ -0,0 +1,152 @@
+# - coding: utf-8 -
+
+# This file is part of Project Hamster.
+
+# Project Hamster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Project Hamster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Readers for the TSV, XML and iCal exports written by reports.py.
+
+   The readers go through the file as it is read and yield one record per
+   fact: (activity, category, description, tags, start_time, end_time), with
+   the strings in unicode, tags as a list and the times as naive datetimes.
+   Times that can not be read come out as None, and it is up to the caller
+   to skip such records.
+"""
+import csv, re
+import datetime as dt
+from calendar import timegm
+from xml.etree import cElementTree
+
+FORMATS = ("tsv", "xml", "ical")
+
+EXTENSIONS = {".tsv": "tsv", ".csv": "tsv", ".txt": "tsv",
+              ".xml": "xml",
+              ".ics": "ical", ".ical": "ical"}
+
+
+def guess_format(path):
+    """format of the file judging by its extension, None if unknown"""
+    for extension, format in EXTENSIONS.iteritems():
+        if path.lower().endswith(extension):
+            return format
+    return None
+
+
+def read(file, format):
+    """records of the given file object in the given format"""
+    readers = {"tsv": read_tsv, "xml": read_xml, "ical": read_ical}
+    if format not in readers:
+        raise ValueError("Unknown import format %s" % format)
+    return readers[format](file)
+
+
+# strptime is slow enough to show when there are hundreds of thousands
+TIME = re.compile(r"(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d)(?::(\d\d))?$")
+ICAL_TIME = re.compile(r"(\d{4})(\d\d)(\d\d)T(\d\d)(\d\d)(\d\d)?$")
+
+def parse_time(value, pattern = TIME):
+    match = pattern.match(value.strip())
+    if not match:
+        return None
+    try:
+        return dt.datetime(*[int(part or 0) for part in match.groups()])
+    except ValueError:
+        return None
+
+def split_tags(tags):
+    return [tag.strip() for tag in tags.split(",") if tag.strip()]
+
+
+def read_tsv(file):
+    # activity, start time, end time, duration minutes, category,
+    # description, tags. the header row is translated, so we go by position
+    rows = csv.reader(file, dialect = 'excel-tab')
+    for row in rows:
+        if rows.line_num == 1 or not row:
+            continue
+
+        row = [column.decode("utf-8") for column in row] + [u""] * (7 - len(row))
+        activity, start_time, end_time, duration, category, description, tags = row[:7]
+        yield (activity.strip(), category.strip(), description, split_tags(tags),
+               parse_time(start_time), parse_time(end_time))
+
+
+def read_xml(file):
+    for event, element in cElementTree.iterparse(file):
+        if element.tag != "activity":
+            continue
+
+        attribute = lambda name: unicode(element.get(name) or u"")
+        yield (attribute("name").strip(), attribute("category").strip(),
+               attribute("description"), split_tags(attribute("tags")),
+               parse_time(attribute("start_time")), parse_time(attribute("end_time")))
+        element.clear()
+
+
+def parse_ical_time(value):
+    """local time of a DTSTART / DTEND value. UTC times, the ones ending
+       in Z, get converted"""
+    if value.endswith("Z"):
+        time = parse_time(value[:-1], ICAL_TIME)
+        if time:
+            time = dt.datetime.fromtimestamp(timegm(time.timetuple()))
+        return time
+    return parse_time(value, ICAL_TIME)
+
+def unescape_ical(value):
+    """undoes the backslash escapes of rfc 5545 text values"""
+    escapes = {"n": "\n", "N": "\n", ",": ",", ";": ";", "\\": "\\"}
+    res, chars = [], iter(value)
+    for char in chars:
+        if char == "\\":
+            char = next(chars, "")
+            res.append(escapes.get(char, "\\" + char))
+        else:
+            res.append(char)
+    return "".join(res)
+
+def read_ical(file):
+    # hamster writes descriptions as they are, so a line that does not look
+    # like a property carries on the previous one. the standard way of
+    # continuing, with leading whitespace, is understood too
+    event, name = None, None
+    for line in file:
+        line = line.decode("utf-8").rstrip("\r\n")
+
+        if line[:1] in (" ", "\t") and event is not None and name:
+            event[name] += line[1:]
+            continue
+
+        property, separator, value = line.partition(":")
+        property = property.split(";")[0] # drop parameters like TZID
+
+        if property == "BEGIN" and value.strip().upper() == "VEVENT":
+            event, name = {}, None
+        elif event is None:
+            continue
+        elif property == "END" and value.strip().upper() == "VEVENT":
+            category = unescape_ical(event.get("CATEGORIES", u"")).strip()
+            if category == "None":
+                category = u"" # older versions wrote that for no category
+
+            yield (unescape_ical(event.get("SUMMARY", u"")).strip(), category,
+                   unescape_ical(event.get("DESCRIPTION", u"")), [],
+                   parse_ical_time(event.get("DTSTART", u"")),
+                   parse_ical_time(event.get("DTEND", u"")))
+            event, name = None, None
+        elif separator and property.replace("-", "").isalpha() and property.isupper():
+            name = property
+            event[name] = value
+        elif name:
+            event[name] += "\n" + line
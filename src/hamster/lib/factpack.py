@@ -0,0 +1,129 @@
+# - coding: utf-8 -
+
+# This file is part of Project Hamster.
+
+# Project Hamster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Project Hamster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Packed fact listings, for handing large amounts of facts over a file
+   descriptor instead of marshalling them one by one in d-bus structs.
+
+   Facts go in and come out as tuples in the GetFacts layout. The pack is
+   made of a header, string offsets, fixed size fact records, tag references
+   and the strings themselves, utf-8 encoded. Names, categories, tags and
+   descriptions are stored once and referred to by index. Both ends live on
+   the same machine, so numbers are in native byte order.
+"""
+import struct
+from array import array
+
+MAGIC = "HMFP"
+VERSION = 1
+
+# magic, version, number of facts, strings and tag references
+HEADER = struct.Struct("=4sHIII")
+
+# id, start_time, end_time, description, activity, activity_id, category,
+# date, delta, first tag reference, number of tags
+FACT = struct.Struct("=11i")
+
+OFFSET = struct.Struct("=II")
+
+
+def pack(facts, out):
+    """writes facts to the given file object"""
+    strings, string_refs = [], {}
+    def ref(string):
+        if string not in string_refs:
+            string_refs[string] = len(strings)
+            if isinstance(string, unicode):
+                strings.append(string.encode("utf-8"))
+            else:
+                strings.append(string)
+        return string_refs[string]
+
+    records, tag_refs = array("i"), array("i")
+    for id, start_time, end_time, description, name, activity_id, category, tags, date, delta in facts:
+        records.extend((id, start_time, end_time, ref(description), ref(name),
+                        activity_id, ref(category), date, delta,
+                        len(tag_refs), len(tags)))
+        tag_refs.extend([ref(tag) for tag in tags])
+
+    offsets = array("I", [0])
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+
+    out.write(HEADER.pack(MAGIC, VERSION, len(records) / 11, len(strings), len(tag_refs)))
+    out.write(offsets.tostring())
+    out.write(records.tostring())
+    out.write(tag_refs.tostring())
+    out.write("".join(strings))
+
+
+class FactReader(object):
+    """Sequence of the facts in a pack. Works on anything that can be sliced,
+       like a memory map. Facts are decoded as they are accessed and passed
+       through factory, if given"""
+    def __init__(self, buf, factory = None):
+        magic, version, count, strings, tag_refs = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a fact pack of version %d" % VERSION)
+
+        self.buf = buf
+        self.factory = factory
+        self.count = count
+
+        self.offsets_start = HEADER.size
+        self.facts_start = self.offsets_start + (strings + 1) * 4
+        self.tags_start = self.facts_start + count * FACT.size
+        self.strings_start = self.tags_start + tag_refs * 4
+        self.strings = {}
+
+        # tag references are few, read them in one go
+        self.tag_refs = array("i")
+        self.tag_refs.fromstring(buf[self.tags_start:self.strings_start])
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("fact index out of range")
+
+        (id, start_time, end_time, description, name, activity_id, category,
+         date, delta, first_tag, tag_count) = FACT.unpack_from(self.buf, self.facts_start + i * FACT.size)
+
+        string = self.string
+        fact = (id, start_time, end_time, string(description), string(name),
+                activity_id, string(category),
+                [string(tag) for tag in self.tag_refs[first_tag:first_tag + tag_count]],
+                date, delta)
+
+        if self.factory:
+            return self.factory(fact)
+        return fact
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+    def string(self, ref):
+        try:
+            return self.strings[ref]
+        except KeyError:
+            start, end = OFFSET.unpack_from(self.buf, self.offsets_start + ref * 4)
+            string = self.buf[self.strings_start + start:self.strings_start + end].decode("utf-8")
+            self.strings[ref] = string
+            return string
@@ -0,0 +1,113 @@
+# - coding: utf-8 -
+
+# This file is part of Project Hamster.
+
+# Project Hamster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Project Hamster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Fuzzy matching of names by the three letter sequences they share.
+
+   Names are indexed by their trigrams, so a search only looks at the names
+   that have the rarer of its trigrams, and at no more than a thousand of
+   them, no matter how many names there are. Words are padded at the front
+   only - what is typed is often the beginning of a word, and a name should
+   not lose points for going on.
+
+   Matches are scored by how much of the search the name covers, with a
+   smaller part for how well the name as a whole fits, and the rest for how
+   often and how recently the name has been used.
+"""
+import heapq, math
+
+# parts of the score
+COVERAGE, FIT, USAGE = 0.6, 0.2, 0.2
+
+# names covering less of the search than this are not matches
+MIN_COVERAGE = 0.25
+
+# a name used this many days ago counts half as recent as one used today
+RECENCY_DAYS = 30
+
+# names looked at per search at most
+MAX_CANDIDATES = 1000
+
+
+def trigrams(text):
+    """set of trigrams of the lowercase words of text"""
+    grams = set()
+    for word in text.lower().split():
+        word = u"  " + word
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+class TrigramIndex(object):
+    def __init__(self, entries, now):
+        """entries are (key, name, uses, last used), where uses is the
+           number of times the name has been used and last used is in
+           seconds since epoch, or None. keys are what find gives back.
+           recency is counted till now, the index is meant to be rebuilt
+           well before that is off by much"""
+        self.keys, self.grams, self.usage = [], [], []
+        self.postings = {} # trigram -> positions of the names that have it
+
+        entries = list(entries)
+        max_uses = max([uses for key, name, uses, last_used in entries] + [1])
+        for key, name, uses, last_used in entries:
+            grams = trigrams(name)
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(len(self.keys))
+
+            frequency = math.log(1 + uses) / math.log(1 + max_uses)
+            recency = 0
+            if last_used is not None:
+                recency = 1.0 / (1 + max(now - last_used, 0) / 86400.0 / RECENCY_DAYS)
+
+            self.keys.append(key)
+            self.grams.append(frozenset(grams))
+            self.usage.append(USAGE * (frequency + recency) / 2)
+
+        # the more used names first, they are the ones looked at when a
+        # trigram is in too many names
+        for postings in self.postings.itervalues():
+            postings.sort(key = self.usage.__getitem__, reverse = True)
+
+    def find(self, search, limit):
+        """keys of the best matching names as (score, key), best first.
+           scores are between 0 and 1"""
+        search = trigrams(search)
+        if not search:
+            return []
+
+        # a match has at least this many of the trigrams, so it is bound to
+        # have one of the rarest ones. the common ones are not gone through,
+        # and of the names with rare enough trigrams only so many are
+        needed = max(int(math.ceil(MIN_COVERAGE * len(search))), 1)
+        rarest = sorted(search, key = lambda gram: len(self.postings.get(gram, ())))
+        candidates = set()
+        for gram in rarest[:len(search) - needed + 1]:
+            candidates.update(self.postings.get(gram, ())[:MAX_CANDIDATES - len(candidates)])
+            if len(candidates) >= MAX_CANDIDATES:
+                break
+
+        matches = []
+        grams, usage, size = self.grams, self.usage, float(len(search))
+        for position in candidates:
+            count = len(grams[position] & search)
+            if count >= needed:
+                score = COVERAGE * count / size \
+                        + FIT * 2 * count / (size + len(grams[position])) \
+                        + usage[position]
+                matches.append((score, position))
+
+        return [(score, self.keys[position]) for score, position in heapq.nlargest(limit, matches)]
@@ -49,6 +49,7 @@ class Overview(gtk.Object):
         self.parent = parent# determine if app should shut down on close
         self._gui = load_ui_file("overview.ui")
         self.report_chooser = None
+        self._facts_request, self._chart_request = None, None # storage calls on their way
         self.window = self.get_widget("tabs_window")
         self.window.connect("delete_event", self.on_delete_window)
 
@@ -75,7 +76,7 @@ class Overview(gtk.Object):
 
         self.external_listeners = [
             (runtime.storage, runtime.storage.connect('activities-changed',self.after_activity_update)),
-            (runtime.storage, runtime.storage.connect('facts-changed',self.after_activity_update)),
+            (runtime.storage, runtime.storage.connect('fact-changes',self.after_fact_changes)),
             (conf, conf.connect('conf-changed', self.on_conf_change))
         ]
         self.show()
@@ -159,24 +160,67 @@ class Overview(gtk.Object):
         if self.start_date > self.end_date: # make sure the end is always after beginning
             self.start_date, self.end_date = self.end_date, self.start_date
 
-        search_terms = self.get_widget("search").get_text().decode("utf8", "replace")
-        self.facts = runtime.storage.get_facts(self.start_date, self.end_date, search_terms)
-
-        self.get_widget("export").set_sensitive(len(self.facts) > 0)
+        self.search_terms = self.get_widget("search").get_text().decode("utf8", "replace")
 
         self.set_title()
 
         self.range_pick.set_range(self.start_date, self.end_date, self.view_date)
 
-        durations = [(fact.start_time, fact.delta) for fact in self.facts]
-        self.timechart.draw(durations, self.start_date, self.end_date)
-
+        # the totals tab gets its numbers summed up by the storage, so the
+        # facts are fetched only when the list is in view. everything comes
+        # in the background, superseding whatever the previous search asked
+        self.cancel_requests()
+        self.facts = None
         if self.get_widget("window_tabs").get_current_page() == 0:
-            self.overview.search(self.start_date, self.end_date, self.facts)
-            self.reports.search(self.start_date, self.end_date, self.facts)
+            self.load_facts(self.show_facts)
+            self.reports.search(self.start_date, self.end_date, self.search_terms)
         else:
-            self.reports.search(self.start_date, self.end_date, self.facts)
-            self.overview.search(self.start_date, self.end_date, self.facts)
+            def on_totals():
+                self.get_widget("export").set_sensitive(bool(self.reports.totals))
+            self.reports.search(self.start_date, self.end_date, self.search_terms, on_totals)
+
+            if self.start_date == self.end_date:
+                self.load_facts(lambda: self.timechart.draw(self.get_facts_durations(),
+                                                            self.start_date, self.end_date))
+            else:
+                def on_durations(durations):
+                    self._chart_request = None
+                    self.timechart.draw([(day, stuff.duration_minutes(duration)) for day, duration, count in durations],
+                                        self.start_date, self.end_date)
+                self._chart_request = runtime.storage.get_totals_async(on_durations,
+                                                                       self.start_date, self.end_date,
+                                                                       "day", self.search_terms)
+
+    def load_facts(self, on_loaded):
+        """fetches facts of the range in the background and calls on_loaded
+           once they are in"""
+        if self._facts_request:
+            self._facts_request.cancel()
+
+        def on_facts(facts):
+            self._facts_request = None
+            self.facts = facts
+            on_loaded()
+
+        self._facts_request = runtime.storage.get_facts_async(on_facts, self.start_date,
+                                                              self.end_date, self.search_terms)
+
+    def show_facts(self):
+        self.get_widget("export").set_sensitive(len(self.facts) > 0)
+        self.timechart.draw(self.get_facts_durations(), self.start_date, self.end_date)
+        self.overview.search(self.start_date, self.end_date, self.facts)
+
+    def cancel_requests(self):
+        for request in (self._facts_request, self._chart_request):
+            if request:
+                request.cancel()
+        self._facts_request, self._chart_request = None, None
+        self.reports.cancel_requests()
+
+    def get_facts_durations(self):
+        if self.facts is None:
+            self.facts = runtime.storage.get_facts(self.start_date, self.end_date, self.search_terms)
+        return [(fact.start_time, fact.delta) for fact in self.facts]
 
     def set_title(self):
         self.title = stuff.format_range(self.start_date, self.end_date)
@@ -202,6 +246,12 @@ class Overview(gtk.Object):
     def after_activity_update(self, widget):
         self.search()
 
+    def after_fact_changes(self, storage, sequence, fact_ids, start_date, end_date):
+        # changes outside the range we are looking at do not concern us
+        if start_date and (end_date < self.start_date or start_date > self.end_date):
+            return
+        self.search()
+
 
     def on_search_icon_press(self, widget, position, data):
         if position == gtk.ENTRY_ICON_SECONDARY:
@@ -219,6 +269,8 @@ class Overview(gtk.Object):
     def on_export_activate(self, widget):
         def on_report_chosen(widget, format, path):
             self.report_chooser = None
+            if self.facts is None:
+                self.facts = runtime.storage.get_facts(self.start_date, self.end_date, self.search_terms)
             reports.simple(self.facts, self.start_date, self.end_date, format, path)
 
             if format == ("html"):
@@ -367,6 +419,8 @@ class Overview(gtk.Object):
 
     def on_window_tabs_switch_page(self, notebook, page, pagenum):
         if pagenum == 0:
+            if self.facts is None:
+                self.load_facts(self.show_facts)
             self.on_fact_selection_changed(self.fact_tree)
         elif pagenum == 1:
             self.get_widget('remove').set_sensitive(False)
@@ -418,6 +472,8 @@ class Overview(gtk.Object):
             w, h = self.window.get_size()
             conf.set("overview_window_box", [x, y, w, h])
 
+        self.cancel_requests()
+
         if not self.parent:
             gtk.main_quit()
         else:
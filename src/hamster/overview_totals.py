@@ -28,7 +28,6 @@ from gettext import ngettext
 
 import os
 import gtk, gobject
-from collections import defaultdict
 
 import widgets, reports
 from configuration import runtime, dialogs, load_ui_file
@@ -43,6 +42,9 @@ class TotalsBox(gtk.VBox):
         self.get_widget("reports_vbox").reparent(self) #mine!
 
         self.start_date, self.end_date = None, None
+        self.search_terms = ""
+        self.totals = None
+        self._requests = [] # storage calls on their way
 
         #graphs
         x_offset = 0.4 # align all graphs to the left edge
@@ -89,7 +91,6 @@ class TotalsBox(gtk.VBox):
             self.selected_categories.append(key)
 
         self.calculate_totals()
-        self.do_charts()
 
     def on_activity_clicked(self, widget, key):
         if key in self.activity_chart.selected_keys:
@@ -99,7 +100,6 @@ class TotalsBox(gtk.VBox):
             self.activity_chart.selected_keys.append(key)
             self.selected_activities.append(key)
         self.calculate_totals()
-        self.do_charts()
 
     def on_tag_clicked(self, widget, key):
         if key in self.tag_chart.selected_keys:
@@ -109,73 +109,88 @@ class TotalsBox(gtk.VBox):
             self.tag_chart.selected_keys.append(key)
             self.selected_tags.append(key)
         self.calculate_totals()
-        self.do_charts()
 
 
-    def search(self, start_date, end_date, facts):
-        self.facts = facts
+    def search(self, start_date, end_date, search_terms = "", on_done = None):
+        """fetches the totals in the background and graphs them. on_done is
+           called once the totals are in"""
         self.category_sums, self.activity_sums, self.tag_sums = [], [], []
         self.selected_categories, self.selected_activities, self.selected_tags = [], [], []
         self.category_chart.selected_keys, self.activity_chart.selected_keys, self.tag_chart.selected_keys = [], [], []
 
         self.start_date = start_date
         self.end_date = end_date
+        self.search_terms = search_terms
 
-        self.do_graph()
+        def on_totals(totals):
+            self._requests = []
+            self.totals = totals
+            self.do_graph()
+            if on_done:
+                on_done()
+
+        self.cancel_requests()
+        self._requests = [runtime.storage.get_totals_async(on_totals, start_date, end_date,
+                                                           search_terms = search_terms)]
+
+    def cancel_requests(self):
+        for request in self._requests:
+            request.cancel()
+        self._requests = []
 
 
     def do_graph(self):
-        if self.facts:
+        if self.totals:
             self.get_widget("no_data_label").hide()
             self.get_widget("charts").show()
             self.get_widget("total_hours").show()
             self.calculate_totals()
-            self.do_charts()
         else:
             self.get_widget("no_data_label").show()
             self.get_widget("charts").hide()
             self.get_widget("total_hours").hide()
 
 
-    def calculate_totals(self):
-        if not self.facts:
-            return
-        facts = self.facts
-
-        category_sums, activity_sums, tag_sums = defaultdict(dt.timedelta), defaultdict(dt.timedelta), defaultdict(dt.timedelta),
+    def get_sums(self, group_by, callback):
+        """fetches hours tracked per key, respecting the selection, and
+           passes them to callback. returns the request"""
+        def on_totals(totals):
+            callback(dict([(key, stuff.duration_minutes(duration) / 60.0) for key, duration, count in totals]))
 
-        for fact in facts:
-            if self.selected_categories and fact.category not in self.selected_categories:
-                continue
-            if self.selected_activities and fact.activity not in self.selected_activities:
-                continue
-            if self.selected_tags and len(set(self.selected_tags) - set(fact.tags)) > 0:
-                continue
+        return runtime.storage.get_totals_async(on_totals, self.start_date, self.end_date, group_by,
+                                                search_terms = self.search_terms,
+                                                categories = self.selected_categories,
+                                                activities = self.selected_activities,
+                                                tags = self.selected_tags)
 
-            category_sums[fact.category] += fact.delta
-            activity_sums[fact.activity] += fact.delta
 
-            for tag in fact.tags:
-                tag_sums[tag] += fact.delta
+    def calculate_totals(self):
+        """fetches the sums of the selection in the background and charts
+           them once all are in"""
+        if not self.totals:
+            return
 
-        total_label = _("%s hours tracked total") % locale.format("%.1f", stuff.duration_minutes([fact.delta for fact in facts]) / 60.0)
+        total_label = _("%s hours tracked total") % locale.format("%.1f", stuff.duration_minutes([duration for key, duration, count in self.totals]) / 60.0)
         self.get_widget("total_hours").set_text(total_label)
 
+        sums = {}
+        def on_sums(group_by, group_sums):
+            sums[group_by] = group_sums
+            if len(sums) == 3:
+                self._requests = []
+                self.set_sums(sums["category"], sums["activity"], sums["tag"])
+                self.do_charts()
 
-        for key in category_sums:
-            category_sums[key] = stuff.duration_minutes(category_sums[key]) / 60.0
-
-        for key in activity_sums:
-            activity_sums[key] = stuff.duration_minutes(activity_sums[key]) / 60.0
-
-        for key in tag_sums:
-            tag_sums[key] = stuff.duration_minutes(tag_sums[key]) / 60.0
+        self.cancel_requests()
+        self._requests = [self.get_sums(group_by, lambda group_sums, group_by = group_by: on_sums(group_by, group_sums))
+                                for group_by in ("category", "activity", "tag")]
 
 
+    def set_sums(self, category_sums, activity_sums, tag_sums):
         #category totals
         if category_sums:
             if self.category_sums:
-                category_sums = [(key, category_sums[key] or 0) for key in self.category_sums[0]]
+                category_sums = [(key, category_sums.get(key, 0)) for key in self.category_sums[0]]
             else:
                 category_sums = sorted(category_sums.items(), key=lambda x:x[1], reverse = True)
 
@@ -183,7 +198,7 @@ class TotalsBox(gtk.VBox):
 
         # activity totals
         if self.activity_sums:
-            activity_sums = [(key, activity_sums[key] or 0) for key in self.activity_sums[0]]
+            activity_sums = [(key, activity_sums.get(key, 0)) for key in self.activity_sums[0]]
         else:
             activity_sums = sorted(activity_sums.items(), key=lambda x:x[1], reverse = True)
 
@@ -193,7 +208,7 @@ class TotalsBox(gtk.VBox):
         # tag totals
         if tag_sums:
             if self.tag_sums:
-                tag_sums = [(key, tag_sums[key] or 0) for key in self.tag_sums[0]]
+                tag_sums = [(key, tag_sums.get(key, 0)) for key in self.tag_sums[0]]
             else:
                 tag_sums = sorted(tag_sums.items(), key=lambda x:x[1], reverse = True)
             self.tag_sums = zip(*tag_sums)
@@ -246,8 +261,7 @@ if __name__ == "__main__":
 
     start_date = dt.date.today() - dt.timedelta(days=30)
     end_date = dt.date.today()
-    facts = runtime.storage.get_facts(start_date, end_date)
-    reports.search(start_date, end_date, facts)
+    reports.search(start_date, end_date)
 
 
     gtk.main()
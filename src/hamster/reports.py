@@ -109,7 +109,7 @@ class ICalWriter(ReportWriter):
         if not fact.end_time: return
 
         if fact.category == _("Unsorted"):
-            fact.category = None
+            fact.category = ""
 
         self.file.write("""BEGIN:VEVENT
 CATEGORIES:%(category)s
@@ -118,7 +118,11 @@ DTEND:%(end_time)s
 SUMMARY:%(name)s
 DESCRIPTION:%(description)s
 END:VEVENT
-""" % fact)
+""" % {"category": fact.category,
+       "start_time": fact.start_time,
+       "end_time": fact.end_time,
+       "name": fact.activity,
+       "description": fact.description})
 
     def _finish(self, file, facts):
         self.file.write("END:VCALENDAR\n")
@@ -108,7 +108,7 @@ class Stats(gtk.Object):
 
         self.external_listeners = [
             (runtime.storage, runtime.storage.connect('activities-changed',self.after_fact_update)),
-            (runtime.storage, runtime.storage.connect('facts-changed',self.after_fact_update))
+            (runtime.storage, runtime.storage.connect('fact-changes',self.after_fact_changes))
         ]
 
         self._gui.connect_signals(self)
@@ -116,7 +116,7 @@ class Stats(gtk.Object):
 
     def show(self):
         self.window.show_all()
-        self.stat_facts = None
+        self.year = None
         day_start = conf.get("day_start_minutes")
         day_start = dt.time(day_start / 60, day_start % 60)
         self.timechart.day_start = day_start
@@ -127,15 +127,14 @@ class Stats(gtk.Object):
 
 
     def init_stats(self):
-        self.stat_facts = runtime.storage.get_facts(dt.date(1970, 1, 2), dt.date.today())
+        # the days with facts come summed up by the storage, there is no
+        # need to go through all the facts just for their years
+        days = runtime.storage.get_totals(dt.date(1970, 1, 2), dt.date.today(), "day")
+        years = set(day.year for day, duration, count in days)
 
-        if not self.stat_facts or self.stat_facts[-1].start_time.year == self.stat_facts[0].start_time.year:
+        if len(years) < 2:
             self.get_widget("explore_controls").hide()
         else:
-            by_year = stuff.totals(self.stat_facts,
-                                   lambda fact: fact.start_time.year,
-                                   lambda fact: 1)
-
             year_box = self.get_widget("year_box")
             if len(year_box.get_children()) == 0:
                 class YearButton(gtk.ToggleButton):
@@ -152,74 +151,25 @@ class Stats(gtk.Object):
                 all_button.set_active(True)
                 self.bubbling = False # TODO figure out how to properly work with togglebuttons as radiobuttons
 
-                years = sorted(by_year.keys())
-                for year in years:
+                for year in sorted(years):
                     year_box.pack_start(YearButton(str(year), year, self.on_year_changed))
 
                 year_box.show_all()
 
 
     def stats(self, year = None):
-        facts = self.stat_facts
         if year:
-            facts = filter(lambda fact: fact.start_time.year == year,
-                           facts)
-
-        if not facts or (facts[-1].start_time - facts[0].start_time) < dt.timedelta(days=6):
-            self.get_widget("statistics_box").hide()
-            #self.get_widget("explore_controls").hide()
-            label = self.get_widget("not_enough_records_label")
-
-            if not facts:
-                label.set_text(_("""There is no data to generate statistics yet.
-A week of usage would be nice!"""))
-            else:
-                label.set_text(_(u"Collecting data — check back after a week has passed!"))
-
-            label.show()
-            return
+            start_date, end_date = dt.date(year, 1, 1), dt.date(year, 12, 31)
         else:
-            self.get_widget("statistics_box").show()
-            self.get_widget("explore_controls").show()
-            self.get_widget("not_enough_records_label").hide()
-
-        # All dates in the scope
-        durations = [(fact.start_time, fact.delta) for fact in facts]
-        self.timechart.draw(durations, facts[0].date, facts[-1].date)
-
-
-        # Totals by category
-        categories = stuff.totals(facts,
-                                  lambda fact: fact.category,
-                                  lambda fact: fact.delta.seconds / 60 / 60.0)
-        category_keys = sorted(categories.keys())
-        categories = [categories[key] for key in category_keys]
-        self.chart_category_totals.plot(category_keys, categories)
-
-        # Totals by weekday
-        weekdays = stuff.totals(facts,
-                                lambda fact: (fact.start_time.weekday(),
-                                              fact.start_time.strftime("%a")),
-                                lambda fact: fact.delta.seconds / 60 / 60.0)
-
-        weekday_keys = sorted(weekdays.keys(), key = lambda x: x[0]) #sort
-        weekdays = [weekdays[key] for key in weekday_keys] #get values in the order
-        weekday_keys = [key[1] for key in weekday_keys] #now remove the weekday and keep just the abbreviated one
-        self.chart_weekday_totals.plot(weekday_keys, weekdays)
-
+            start_date, end_date = dt.date(1970, 1, 2), dt.date.today()
 
         split_minutes = 5 * 60 + 30 #the mystical hamster midnight
 
-        # starts and ends by weekday
-        by_weekday = {}
-        for date, date_facts in groupby(facts, lambda fact: fact.start_time.date()):
-            date_facts = list(date_facts)
-            weekday = (date_facts[0].start_time.weekday(),
-                       date_facts[0].start_time.strftime("%a"))
-            by_weekday.setdefault(weekday, [])
-
+        def day_span(facts):
+            """earliest start and latest end of the finished facts of a day,
+               in minutes from midnight of the day"""
             start_times, end_times = [], []
-            for fact in date_facts:
+            for fact in facts:
                 start_time = fact.start_time.time()
                 start_time = start_time.hour * 60 + start_time.minute
                 if fact.end_time:
@@ -234,73 +184,123 @@ A week of usage would be nice!"""))
                     start_times.append(start_time)
                     end_times.append(end_time)
             if start_times and end_times:
-                by_weekday[weekday].append((min(start_times), max(end_times)))
-
-
-        for day in by_weekday:
-            n = len(by_weekday[day])
-            # calculate mean and variance for starts and ends
-            means = (sum([fact[0] for fact in by_weekday[day]]) / n,
-                     sum([fact[1] for fact in by_weekday[day]]) / n)
-            variances = (sum([(fact[0] - means[0]) ** 2 for fact in by_weekday[day]]) / n,
-                         sum([(fact[1] - means[1]) ** 2 for fact in by_weekday[day]]) / n)
-
+                return min(start_times), max(end_times)
+            return None
+
+        def add_span(spans, key, span):
+            # count and sums of the starts and ends and of their squares, so
+            # the days need not be kept around for the mean and variance
+            if span:
+                sums = spans.setdefault(key, [0, 0, 0, 0, 0])
+                sums[0] += 1
+                sums[1] += span[0]
+                sums[2] += span[0] ** 2
+                sums[3] += span[1]
+                sums[4] += span[1] ** 2
+
+        def spread(sums):
             # In the normal distribution, the range from
             # (mean - standard deviation) to infinit, or from
             # -infinit to (mean + standard deviation),  has an accumulated
             # probability of 84.1%. Meaning we are using the place where if we
             # picked a random start(or end), 84.1% of the times it will be
             # inside the range.
-            by_weekday[day] = (int(means[0] - math.sqrt(variances[0])),
-                               int(means[1] + math.sqrt(variances[1])))
-
-        min_weekday = min([by_weekday[day][0] for day in by_weekday])
-        max_weekday = max([by_weekday[day][1] for day in by_weekday])
+            n, starts, start_squares, ends, end_squares = sums
+            means = (starts / n, ends / n)
+            variances = ((start_squares - 2 * means[0] * starts + n * means[0] ** 2) / n,
+                         (end_squares - 2 * means[1] * ends + n * means[1] ** 2) / n)
+            return (int(means[0] - math.sqrt(variances[0])),
+                    int(means[1] + math.sqrt(variances[1])))
 
 
-        weekday_keys = sorted(by_weekday.keys(), key = lambda x: x[0])
-        weekdays = [by_weekday[key] for key in weekday_keys]
-        weekday_keys = [key[1] for key in weekday_keys] # get rid of the weekday number as int
+        early_start, early_end = dt.time(5,0), dt.time(9,0)
+        late_start, late_end = dt.time(20,0), dt.time(5,0)
 
+        # one pass over the facts, a day at a time
+        first_fact, last_fact, max_fact = None, None, None
+        fact_count, total_delta = 0, dt.timedelta(days=0)
+        early_count, late_count, short_count = 0, 0, 0
+        by_weekday, by_category = {}, {}
 
-        # starts and ends by category
-        by_category = {}
+        facts = runtime.storage.iter_facts(start_date, end_date)
         for date, date_facts in groupby(facts, lambda fact: fact.start_time.date()):
-            date_facts = sorted(list(date_facts), key = lambda x: x.category)
+            date_facts = list(date_facts)
 
+            for fact in date_facts:
+                first_fact = first_fact or fact
+                last_fact = fact
+                fact_count += 1
+                total_delta += fact.delta
+                if not max_fact or fact.delta > max_fact.delta:
+                    max_fact = fact
+
+                if early_start < fact.start_time.time() < early_end:
+                    early_count += 1
+                if fact.start_time.time() > late_start or fact.start_time.time() < late_end:
+                    late_count += 1
+                if fact.delta <= dt.timedelta(seconds = 60 * 15):
+                    short_count += 1
+
+            # starts and ends by weekday
+            weekday = (date_facts[0].start_time.weekday(),
+                       date_facts[0].start_time.strftime("%a"))
+            add_span(by_weekday, weekday, day_span(date_facts))
+
+            # starts and ends by category
+            date_facts = sorted(date_facts, key = lambda x: x.category)
             for category, category_facts in groupby(date_facts, lambda x: x.category):
-                category_facts = list(category_facts)
-                by_category.setdefault(category, [])
+                add_span(by_category, category, day_span(category_facts))
 
-                start_times, end_times = [], []
-                for fact in category_facts:
-                    start_time = fact.start_time
-                    start_time = start_time.hour * 60 + start_time.minute
-                    if fact.end_time:
-                        end_time = fact.end_time.time()
-                        end_time = end_time.hour * 60 + end_time.minute
 
-                        if start_time < split_minutes:
-                            start_time += 24 * 60
-                        if end_time < start_time:
-                            end_time += 24 * 60
+        if not first_fact or (last_fact.start_time - first_fact.start_time) < dt.timedelta(days=6):
+            self.get_widget("statistics_box").hide()
+            #self.get_widget("explore_controls").hide()
+            label = self.get_widget("not_enough_records_label")
+
+            if not first_fact:
+                label.set_text(_("""There is no data to generate statistics yet.
+A week of usage would be nice!"""))
+            else:
+                label.set_text(_(u"Collecting data — check back after a week has passed!"))
+
+            label.show()
+            return
+        else:
+            self.get_widget("statistics_box").show()
+            self.get_widget("explore_controls").show()
+            self.get_widget("not_enough_records_label").hide()
 
-                        start_times.append(start_time)
-                        end_times.append(end_time)
+        # Totals by day, category and weekday are summed up by the storage
+        durations = runtime.storage.get_totals(start_date, end_date, "day")
+        self.timechart.draw([(day, stuff.duration_minutes(duration)) for day, duration, count in durations],
+                            first_fact.date, last_fact.date)
 
-                if start_times and end_times:
-                    by_category[category].append((min(start_times), max(end_times)))
+        categories = runtime.storage.get_totals(start_date, end_date, "category")
+        category_keys = [key for key, duration, count in categories]
+        categories = [stuff.duration_minutes(duration) / 60.0 for key, duration, count in categories]
+        self.chart_category_totals.plot(category_keys, categories)
 
-        for cat in by_category:
-            # For explanation see the comments in the starts and ends by day
-            n = len(by_category[cat])
-            means = (sum([fact[0] for fact in by_category[cat]]) / n,
-                     sum([fact[1] for fact in by_category[cat]]) / n)
-            variances = (sum([(fact[0] - means[0]) ** 2 for fact in by_category[cat]]) / n,
-                         sum([(fact[1] - means[1]) ** 2 for fact in by_category[cat]]) / n)
+        weekdays = runtime.storage.get_totals(start_date, end_date, "weekday")
+        weekdays = sorted(weekdays, key = lambda x: x[0])
+        weekday_keys = [calendar.day_abbr[key] for key, duration, count in weekdays]
+        weekdays = [stuff.duration_minutes(duration) / 60.0 for key, duration, count in weekdays]
+        self.chart_weekday_totals.plot(weekday_keys, weekdays)
 
-            by_category[cat] = (int(means[0] - math.sqrt(variances[0])),
-                                int(means[1] + math.sqrt(variances[1])))
+
+        for day in by_weekday:
+            by_weekday[day] = spread(by_weekday[day])
+
+        min_weekday = min([by_weekday[day][0] for day in by_weekday])
+        max_weekday = max([by_weekday[day][1] for day in by_weekday])
+
+
+        weekday_keys = sorted(by_weekday.keys(), key = lambda x: x[0])
+        weekdays = [by_weekday[key] for key in weekday_keys]
+        weekday_keys = [key[1] for key in weekday_keys] # get rid of the weekday number as int
+
+
+        for cat in by_category:
+            by_category[cat] = spread(by_category[cat])
 
         min_category = min([by_category[day][0] for day in by_category])
         max_category = max([by_category[day][1] for day in by_category])
@@ -325,21 +325,17 @@ A week of usage would be nice!"""))
             # date format for the first record if the year has not been selected
             # Using python datetime formatting syntax. See:
             # http://docs.python.org/library/time.html#time.strftime
-            first_date = facts[0].start_time.strftime(C_("first record", "%b %d, %Y"))
+            first_date = first_fact.start_time.strftime(C_("first record", "%b %d, %Y"))
         else:
             # date of first record when year has been selected
             # Using python datetime formatting syntax. See:
             # http://docs.python.org/library/time.html#time.strftime
-            first_date = facts[0].start_time.strftime(C_("first record", "%b %d"))
+            first_date = first_fact.start_time.strftime(C_("first record", "%b %d"))
 
         summary += _("First activity was recorded on %s.") % \
                                                      ("<b>%s</b>" % first_date)
 
         # total time tracked
-        total_delta = dt.timedelta(days=0)
-        for fact in facts:
-            total_delta += fact.delta
-
         if total_delta.days > 1:
             human_years_str = ngettext("%(num)s year",
                                        "%(num)s years",
@@ -359,11 +355,6 @@ A week of usage would be nice!"""))
 
 
         # longest fact
-        max_fact = None
-        for fact in facts:
-            if not max_fact or fact.delta > max_fact.delta:
-                max_fact = fact
-
         longest_date = max_fact.start_time.strftime(
             # How the date of the longest activity should be displayed in statistics
             # Using python datetime formatting syntax. See:
@@ -383,22 +374,16 @@ A week of usage would be nice!"""))
         # total records (in selected scope)
         summary += " " + ngettext("There is %s record.",
                                   "There are %s records.",
-                                  len(facts)) % ("<b>%d</b>" % len(facts))
-
-
-        early_start, early_end = dt.time(5,0), dt.time(9,0)
-        late_start, late_end = dt.time(20,0), dt.time(5,0)
+                                  fact_count) % ("<b>%d</b>" % fact_count)
 
 
-        fact_count = len(facts)
-        def percent(condition):
-            matches = [fact for fact in facts if condition(fact)]
-            return round(len(matches) / float(fact_count) * 100)
+        def percent(count):
+            return round(count / float(fact_count) * 100)
 
 
-        early_percent = percent(lambda fact: early_start < fact.start_time.time() < early_end)
-        late_percent = percent(lambda fact: fact.start_time.time() > late_start or fact.start_time.time() < late_end)
-        short_percent = percent(lambda fact: fact.delta <= dt.timedelta(seconds = 60 * 15))
+        early_percent = percent(early_count)
+        late_percent = percent(late_count)
+        short_percent = percent(short_count)
 
         if fact_count < 100:
             summary += "\n\n" + _("Hamster would like to observe you some more!")
@@ -425,12 +410,19 @@ than 15 minutes, you seem to be a busy bee.") % ("<b>%d</b>" % short_percent)
                 child.set_active(False)
                 self.bubbling = False
 
-        self.stats(button.year)
+        self.year = button.year
+        self.stats(self.year)
 
 
     def after_fact_update(self, event):
-        self.stat_facts = runtime.storage.get_facts(dt.date(1970, 1, 1), dt.date.today())
-        self.stats()
+        self.stats(self.year)
+
+    def after_fact_changes(self, storage, sequence, fact_ids, start_date, end_date):
+        # changes outside the year we are looking at do not concern us
+        if self.year and start_date and \
+           (end_date.year < self.year or start_date.year > self.year):
+            return
+        self.after_fact_update(None)
 
     def get_widget(self, name):
         """ skip one variable (huh) """
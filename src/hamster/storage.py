@@ -18,11 +18,22 @@
 # You should have received a copy of the GNU General Public License
 # along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
 
-import dbus, dbus.service
+import dbus, dbus.service, dbus.exceptions
 import datetime as dt
 from calendar import timegm
-import gio
-from lib import stuff
+import tempfile
+import gio, gobject
+from lib import stuff, factpack, factimport
+
+# methods that can go in a batch, and what stands for their result when they
+# give none. the ones that return nothing by design give true, the lookups
+# give what they return over D-Bus when nothing is found
+BATCH_METHODS = {"AddFact": 0, "UpdateFact": 0, "RemoveFact": True, "StopTracking": True,
+                 "AddCategory": 0, "UpdateCategory": True, "RemoveCategory": True,
+                 "AddActivity": 0, "UpdateActivity": True, "RemoveActivity": True,
+                 "ChangeCategory": False,
+                 "GetCategoryId": 0, "GetActivityByName": {},
+                 "GetTagIds": [], "SetTagsAutocomplete": True}
 
 def to_dbus_fact(fact):
     """Perform the conversion between fact database query and
@@ -48,6 +59,12 @@ class Storage(dbus.service.Object):
         bus_name = dbus.service.BusName("org.gnome.Hamster", bus=self.bus)
         dbus.service.Object.__init__(self, bus_name, self.__dbus_object_path__)
         self.mainloop = loop
+        self.__held_signals = None # change signals held back during a batch
+
+        # change signals raised in a short while go out once, see emit_changed
+        self.__pending_signals = []
+        self.__signal_source = None
+        self.__signal_counts = {} # signal name -> [raised, sent]
 
         self.__file = gio.File(__file__)
         self.__monitor = self.__file.monitor_file()
@@ -75,10 +92,64 @@ class Storage(dbus.service.Object):
     @dbus.service.signal("org.gnome.Hamster")
     def ToggleCalled(self): pass
 
-    def dispatch_overwrite(self):
-        self.TagsChanged()
-        self.FactsChanged()
-        self.ActivitiesChanged()
+    # detailed versions of the above. each carries the change sequence
+    # number, for GetChangesSince. empty id lists with no date range mean
+    # that there is no telling what has changed, and all should be reloaded
+    @dbus.service.signal("org.gnome.Hamster", signature='taiuu')
+    def FactChanges(self, sequence, fact_ids, start_date, end_date): pass
+
+    @dbus.service.signal("org.gnome.Hamster", signature='taiai')
+    def ActivityChanges(self, sequence, activity_ids, category_ids): pass
+
+    @dbus.service.signal("org.gnome.Hamster", signature='tai')
+    def TagChanges(self, sequence, tag_ids): pass
+
+    def emit_changed(self, signal):
+        """sends out the change signal, or holds it back till the end of the
+           batch, if one is running. every signal makes the clients reload,
+           so the ones raised within change_signal_milliseconds of each other
+           go out once per kind"""
+        self.__signal_counts.setdefault(signal.__name__, [0, 0])[0] += 1
+        if self.__held_signals is None:
+            self.__queue_signal(signal)
+        elif signal not in self.__held_signals:
+            self.__held_signals.append(signal)
+
+    def __queue_signal(self, signal):
+        if signal not in self.__pending_signals:
+            self.__pending_signals.append(signal)
+
+        if self.__signal_source is None:
+            from configuration import conf
+            delay = conf.get("change_signal_milliseconds")
+            if delay > 0:
+                self.__signal_source = gobject.timeout_add(delay, self.flush_signals)
+            else:
+                # still once per main loop iteration - a call at a time
+                self.__signal_source = gobject.idle_add(self.flush_signals)
+
+    def flush_signals(self):
+        """sends out the change signals gathered so far"""
+        if self.__signal_source is not None:
+            gobject.source_remove(self.__signal_source)
+            self.__signal_source = None
+
+        signals, self.__pending_signals = self.__pending_signals, []
+        for signal in signals:
+            self.__signal_counts[signal.__name__][1] += 1
+            signal()
+        return False
+
+    def dispatch_overwrite(self, sequence = 0):
+        # detailed ones go first, so that client caches are cleared by the
+        # time the plain ones arrive
+        self.TagChanges(sequence, [])
+        self.FactChanges(sequence, [], 0, 0)
+        self.ActivityChanges(sequence, [], [])
+
+        self.emit_changed(self.TagsChanged)
+        self.emit_changed(self.FactsChanged)
+        self.emit_changed(self.ActivitiesChanged)
 
 
 
@@ -93,6 +164,7 @@ class Storage(dbus.service.Object):
             service.Quit()
         """
         #log.logger.info("Hamster Service is being shutdown")
+        self.flush_signals()
         self.mainloop.quit()
 
 
@@ -104,6 +176,105 @@ class Storage(dbus.service.Object):
         #log.logger.info("Hamster Service is being shutdown")
         self.ToggleCalled()
 
+    @dbus.service.method("org.gnome.Hamster", in_signature='a(sav)', out_signature='av')
+    def Batch(self, operations):
+        """Runs a list of (method name, arguments) operations in one
+           transaction and returns the list of their results. Methods and
+           arguments are the same as when called one by one. The ones that
+           return nothing give true, lookups that find nothing give 0 or an
+           empty dict. If any of the operations fails, none of them gets
+           applied. Change signals are sent once, at the end.
+           example:
+               service.Batch([("AddCategory", ["Travel"]),
+                              ("AddFact", ["flying@Travel", start, end, False])])
+        """
+        for name, args in operations:
+            if name not in BATCH_METHODS:
+                raise dbus.exceptions.DBusException("%s can not be batched" % name)
+
+        self.__held_signals = []
+        self.start_batch()
+        try:
+            results = []
+            for name, args in operations:
+                result = getattr(self, name)(*args)
+                results.append(BATCH_METHODS[name] if result is None else result)
+        except:
+            self.cancel_batch()
+            self.__held_signals = None
+            raise
+        self.end_batch()
+
+        signals, self.__held_signals = self.__held_signals, None
+        for signal in signals:
+            self.__queue_signal(signal)
+        return results
+
+    @dbus.service.method("org.gnome.Hamster", in_signature='ss', out_signature='uu')
+    def ImportFacts(self, path, format):
+        """Imports facts from a TSV, XML or iCal export, as written by the
+           reports. The format is one of "tsv", "xml" and "ical", when
+           empty it is guessed from the extension. Overlapping facts are
+           sorted out like when adding them one by one and facts that are
+           there already are skipped. Returns the number of imported and
+           skipped facts.
+           example:
+               service.ImportFacts("/home/me/hamster.tsv", "")
+        """
+        format = format or factimport.guess_format(path)
+        if format not in factimport.FORMATS:
+            raise dbus.exceptions.DBusException("Can not tell the format of %s" % path)
+
+        with open(path) as file:
+            imported, skipped = self.__import_facts(factimport.read(file, format))
+
+        if imported:
+            self.emit_changed(self.TagsChanged)
+            self.emit_changed(self.FactsChanged)
+            self.emit_changed(self.ActivitiesChanged)
+        return imported, skipped
+
+    @dbus.service.method("org.gnome.Hamster", out_signature='u')
+    def RepairOverlaps(self):
+        """Goes through all the facts and sorts out the overlapping ones in
+           one pass, the later added facts pushing the earlier ones aside.
+           Facts that fit completely in a later one are left alone. Returns
+           the number of overlaps found."""
+        self.start_transaction()
+        result = self.__repair_overlaps()
+        self.end_transaction()
+
+        if result:
+            self.emit_changed(self.FactsChanged)
+        return result
+
+    @dbus.service.method("org.gnome.Hamster", out_signature='a{sv}')
+    def GetCacheStats(self):
+        """Returns sizes, hit and miss counts and hit rates of the storage
+           caches. The statement cache numbers are estimated, as sqlite
+           does not expose its own"""
+        return self.__get_cache_stats()
+
+    @dbus.service.method("org.gnome.Hamster", out_signature='a{s(uu)}')
+    def GetSignalStats(self):
+        """Returns how many times each of the change signals has been raised
+           and how many times it has actually been sent out. The difference
+           is the number of reloads the clients have been spared"""
+        return dict((name, tuple(counts))
+                        for name, counts in self.__signal_counts.iteritems())
+
+    @dbus.service.method("org.gnome.Hamster", in_signature='t', out_signature='tbaiuuaiaiai')
+    def GetChangesSince(self, sequence):
+        """Returns what has changed after the given change sequence number:
+           (current sequence, complete, fact ids, start date, end date,
+           activity ids, category ids, tag ids). Dates are the hamster days
+           of the changed facts. The fact id list is left empty when there
+           are too many to list, reload the date range then.
+           complete is false when the changes are not known that far back,
+           in which case everything should be reloaded.
+        """
+        return self.__get_changes_since(sequence)
+
     # facts
     @dbus.service.method("org.gnome.Hamster", in_signature='siib', out_signature='i')
     def AddFact(self, fact, start_time, end_time, temporary = False):
@@ -118,7 +289,7 @@ class Storage(dbus.service.Object):
         self.end_transaction()
 
         if result:
-            self.FactsChanged()
+            self.emit_changed(self.FactsChanged)
         return result or 0
 
 
@@ -126,7 +297,6 @@ class Storage(dbus.service.Object):
     def GetFact(self, fact_id):
         """Get fact by id. For output format see GetFacts"""
         fact = dict(self.__get_fact(fact_id))
-        fact['date'] = fact['start_time'].date()
         fact['delta'] = dt.timedelta()
         return to_dbus_fact(fact)
 
@@ -150,7 +320,7 @@ class Storage(dbus.service.Object):
         self.end_transaction()
 
         if result:
-            self.FactsChanged()
+            self.emit_changed(self.FactsChanged)
         return result
 
 
@@ -162,7 +332,7 @@ class Storage(dbus.service.Object):
         facts = self.__get_todays_facts()
         if facts:
             self.__touch_fact(facts[-1], end_time)
-            self.FactsChanged()
+            self.emit_changed(self.FactsChanged)
 
 
     @dbus.service.method("org.gnome.Hamster", in_signature='i')
@@ -172,12 +342,16 @@ class Storage(dbus.service.Object):
         fact = self.__get_fact(fact_id)
         if fact:
             self.__remove_fact(fact_id)
-            self.FactsChanged()
         self.end_transaction()
 
+        if fact:
+            self.emit_changed(self.FactsChanged)
+
 
-    @dbus.service.method("org.gnome.Hamster", in_signature='uus', out_signature='a(iiissisasii)')
-    def GetFacts(self, start_date, end_date, search_terms):
+    @dbus.service.method("org.gnome.Hamster", in_signature='uus', out_signature='a(iiissisasii)',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def GetFacts(self, start_date, end_date, search_terms,
+                 reply_handler = None, error_handler = None):
         """Gets facts between the day of start_date and the day of end_date.
         Parameters:
         i start_date: Seconds since epoch (timestamp). Use 0 for today
@@ -204,14 +378,132 @@ class Storage(dbus.service.Object):
         if end_date:
             end = dt.datetime.utcfromtimestamp(end_date).date()
 
-        return [to_dbus_fact(fact) for fact in self.__get_facts(start, end, search_terms)]
+        return self.__read(self.__get_fact_rows, (start, end, search_terms),
+                           reply_handler, error_handler)
+
+
+    @dbus.service.method("org.gnome.Hamster", in_signature='uus', out_signature='h',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def GetFactsFd(self, start_date, end_date, search_terms,
+                   reply_handler = None, error_handler = None):
+        """Gets facts same as GetFacts, packed in a file rather than in the
+        message. For large amounts of facts, where marshalling gets costly.
+        Parameters:
+        i start_date: Seconds since epoch (timestamp). Use 0 for today
+        i end_date: Seconds since epoch (timestamp). Use 0 for today
+        s search_terms: Same as in GetFacts
+        Returns file descriptor of an unlinked file holding the facts in the
+        format of lib.factpack
+        """
+        start = dt.date.today()
+        if start_date:
+            start = dt.datetime.utcfromtimestamp(start_date).date()
+
+        end = None
+        if end_date:
+            end = dt.datetime.utcfromtimestamp(end_date).date()
+
+        def pack():
+            packed = tempfile.TemporaryFile(prefix = "hamster-facts-")
+            factpack.pack(self.__get_fact_rows(start, end, search_terms), packed)
+            packed.flush()
+
+            # the descriptor gets duplicated, the file goes away once the
+            # client is done with it
+            fd = dbus.types.UnixFd(packed)
+            packed.close()
+            return fd
+
+        return self.__read(pack, (), reply_handler, error_handler)
 
 
-    @dbus.service.method("org.gnome.Hamster", out_signature='a(iiissisasii)')
-    def GetTodaysFacts(self):
+    @dbus.service.method("org.gnome.Hamster", in_signature='uussu', out_signature='a(iiissisasii)s',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def GetFactsPage(self, start_date, end_date, search_terms, cursor, limit,
+                     reply_handler = None, error_handler = None):
+        """Gets facts same as GetFacts, a page at a time.
+        Parameters:
+        i start_date: Seconds since epoch (timestamp). Use 0 for today
+        i end_date: Seconds since epoch (timestamp). Use 0 for today
+        s search_terms: Same as in GetFacts
+        s cursor: Empty for the first page, otherwise the one returned with
+                  the previous page
+        u limit: Page size
+        Returns array of facts, as in GetFacts, and cursor of the next
+        page. The cursor is empty after the last page
+        """
+        start = dt.date.today()
+        if start_date:
+            start = dt.datetime.utcfromtimestamp(start_date).date()
+
+        end = None
+        if end_date:
+            end = dt.datetime.utcfromtimestamp(end_date).date()
+
+        if reply_handler:
+            # two return values, the facts and the cursor
+            reply = lambda res: reply_handler(*res)
+        else:
+            reply = None
+
+        return self.__read(self.__get_fact_page,
+                           (start, end, search_terms, cursor, limit),
+                           reply, error_handler)
+
+
+    @dbus.service.method("org.gnome.Hamster", out_signature='a(iiissisasii)',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def GetTodaysFacts(self, reply_handler = None, error_handler = None):
         """Gets facts of today, respecting hamster midnight. See GetFacts for
         return info"""
-        return [to_dbus_fact(fact) for fact in self.__get_todays_facts()]
+        return self.__read(self.__get_fact_rows, (self.__get_hamster_today(),),
+                           reply_handler, error_handler)
+
+
+    @dbus.service.method("org.gnome.Hamster", in_signature='uussasasas', out_signature='a(sii)',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def GetTotals(self, start_date, end_date, group_by, search_terms,
+                  categories, activities, tags,
+                  reply_handler = None, error_handler = None):
+        """Gets time spent between the day of start_date and the day of end_date,
+        summed up in the database.
+        Parameters:
+        i start_date: Seconds since epoch (timestamp). Use 0 for today
+        i end_date: Seconds since epoch (timestamp). Use 0 for today
+        s group_by: category, activity, tag, day or weekday
+        s search_terms: Same as in GetFacts
+        as categories: Limit to facts in these categories. Empty for all
+        as activities: Limit to facts of these activities. Empty for all
+        as tags: Limit to facts that have all of these tags. Empty for all
+        Returns Array of totals where total is struct of:
+            s  key - name, day as YYYY-MM-DD or weekday (0 is sunday)
+            i  duration in seconds
+            i  number of facts
+        """
+        start = dt.date.today()
+        if start_date:
+            start = dt.datetime.utcfromtimestamp(start_date).date()
+
+        end = None
+        if end_date:
+            end = dt.datetime.utcfromtimestamp(end_date).date()
+
+        return self.__read(self.__get_totals,
+                           (start, end, group_by, search_terms,
+                            categories, activities, tags),
+                           reply_handler, error_handler)
+
+    @dbus.service.method("org.gnome.Hamster", in_signature='b', out_signature='i')
+    def CheckRollups(self, repair):
+        """Compares the daily totals kept for GetTotals with the facts.
+        Parameters:
+        b repair: Rebuild the totals if they are off
+        Returns number of rows that differ
+        """
+        self.start_transaction()
+        mismatches = self.__check_rollups(repair)
+        self.end_transaction()
+        return mismatches
 
 
     # categories
@@ -219,7 +511,7 @@ class Storage(dbus.service.Object):
     @dbus.service.method("org.gnome.Hamster", in_signature='s', out_signature = 'i')
     def AddCategory(self, name):
         res = self.__add_category(name)
-        self.ActivitiesChanged()
+        self.emit_changed(self.ActivitiesChanged)
         return res
 
     @dbus.service.method("org.gnome.Hamster", in_signature='s', out_signature='i')
@@ -229,13 +521,13 @@ class Storage(dbus.service.Object):
     @dbus.service.method("org.gnome.Hamster", in_signature='is')
     def UpdateCategory(self, id, name):
         self.__update_category(id, name)
-        self.ActivitiesChanged()
+        self.emit_changed(self.ActivitiesChanged)
 
 
     @dbus.service.method("org.gnome.Hamster", in_signature='i')
     def RemoveCategory(self, id):
         self.__remove_category(id)
-        self.ActivitiesChanged()
+        self.emit_changed(self.ActivitiesChanged)
 
 
     @dbus.service.method("org.gnome.Hamster", out_signature='a(is)')
@@ -248,21 +540,21 @@ class Storage(dbus.service.Object):
     @dbus.service.method("org.gnome.Hamster", in_signature='si', out_signature = 'i')
     def AddActivity(self, name, category_id = -1):
         new_id = self.__add_activity(name, category_id)
-        self.ActivitiesChanged()
+        self.emit_changed(self.ActivitiesChanged)
         return new_id
 
 
     @dbus.service.method("org.gnome.Hamster", in_signature='isi')
     def UpdateActivity(self, id, name, category_id):
         self.__update_activity(id, name, category_id)
-        self.ActivitiesChanged()
+        self.emit_changed(self.ActivitiesChanged)
 
 
 
     @dbus.service.method("org.gnome.Hamster", in_signature='i')
     def RemoveActivity(self, id):
         result = self.__remove_activity(id)
-        self.ActivitiesChanged()
+        self.emit_changed(self.ActivitiesChanged)
         return result
 
     @dbus.service.method("org.gnome.Hamster", in_signature='i', out_signature='a(isis)')
@@ -280,11 +572,29 @@ class Storage(dbus.service.Object):
         return [(row['name'], row['category'] or '') for row in self.__get_activities(search)]
 
 
+    @dbus.service.method("org.gnome.Hamster", in_signature='ssu', out_signature='a(sssd)')
+    def GetMatches(self, search, kind, limit):
+        """Finds activities and categories with names like the search, also
+        when only partly typed or misspelt, the more used and the more
+        recently used first among similar ones.
+        Parameters:
+        s search: What has been typed
+        s kind: "activity" or "category" to look for just these, empty for both
+        u limit: How many to return
+        Returns Array of matches, best first, where match is struct of:
+            s  kind - activity or category
+            s  activity name, empty for categories
+            s  category name, empty for unsorted activities
+            d  score between 0 and 1
+        """
+        return self.__get_matches(search, kind, limit)
+
+
     @dbus.service.method("org.gnome.Hamster", in_signature='ii', out_signature = 'b')
     def ChangeCategory(self, id, category_id):
         changed = self.__change_category(id, category_id)
         if changed:
-            self.ActivitiesChanged()
+            self.emit_changed(self.ActivitiesChanged)
         return changed
 
 
@@ -303,16 +613,29 @@ class Storage(dbus.service.Object):
         return [(tag['id'], tag['name'], tag['autocomplete']) for tag in self.__get_tags(only_autocomplete)]
 
 
+    @dbus.service.method("org.gnome.Hamster", in_signature='ai', out_signature='a(isbu)')
+    def GetTagUsage(self, tag_ids):
+        """Returns (id, name, autocomplete, number of facts) of the given
+           tags, or of all the tags if none are given. Tags that are gone
+           are left out.
+        """
+        return self.__get_tag_usage(tag_ids)
+
+
     @dbus.service.method("org.gnome.Hamster", in_signature='as', out_signature='a(isb)')
     def GetTagIds(self, tags):
+        self.start_transaction()
         tags, new_added = self.__get_tag_ids(tags)
+        self.end_transaction()
         if new_added:
-            self.TagsChanged()
+            self.emit_changed(self.TagsChanged)
         return [(tag['id'], tag['name'], tag['autocomplete']) for tag in tags]
 
 
     @dbus.service.method("org.gnome.Hamster", in_signature='s')
     def SetTagsAutocomplete(self, tags):
+        self.start_transaction()
         changes = self.__update_autocomplete_tags(tags)
+        self.end_transaction()
         if changes:
-            self.TagsChanged()
+            self.emit_changed(self.TagsChanged)
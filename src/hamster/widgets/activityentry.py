@@ -37,8 +37,10 @@ class ActivityEntry(gtk.Entry):
         self.external_activities = [] # suggestions from outer space
         self.categories = None
         self.filter = None
+        self._request, self._on_suggestions = None, None # suggestions on their way
+        self.fuzzy = False # suggestions are alike what was typed, not starting with it
         self.max_results = 10 # limit popup size to 10 results
-        self.external = external.ActivitiesSource()
+        self.external = external.get_activities_source()
 
         self.popup = gtk.Window(type = gtk.WINDOW_POPUP)
 
@@ -97,6 +99,7 @@ class ActivityEntry(gtk.Entry):
 
         self.external_listeners = [
             (runtime.storage, runtime.storage.connect('activities-changed',self.after_activity_update)),
+            (self.external, self.external.connect('activities-changed',self.after_external_update)),
         ]
 
         self.show()
@@ -105,6 +108,9 @@ class ActivityEntry(gtk.Entry):
         self.connect("destroy", self.on_destroy)
 
     def on_destroy(self, window):
+        if self._request:
+            self._request.cancel()
+
         for obj, handler in self.external_listeners:
             obj.disconnect(handler)
 
@@ -192,7 +198,8 @@ class ActivityEntry(gtk.Entry):
         model = self.tree.get_model()
         subject = self.get_text()
 
-        if not subject or model.iter_n_children(None) == 0:
+        # fuzzy matches need not start with what has been typed
+        if self.fuzzy or not subject or model.iter_n_children(None) == 0:
             return
 
         prefix_length = 0
@@ -218,26 +225,83 @@ class ActivityEntry(gtk.Entry):
         # scratch category cache so it gets repopulated on demand
         self.categories = None
 
-    def populate_suggestions(self):
+    def populate_suggestions(self, on_done = None):
+        """fetches suggestions for what has been typed in the background.
+           on_done is called once they are in the list"""
         if self.get_selection_bounds():
             cursor = self.get_selection_bounds()[0]
         else:
             cursor = self.get_position()
 
-        if self.activities and self.categories and self.filter == self.get_text().decode('utf8', 'replace')[:cursor]:
-            return #same thing, no need to repopulate
+        if self.filter == self.get_text().decode('utf8', 'replace')[:cursor]:
+            if self._request:
+                self._on_suggestions = on_done # on their way already
+                return
+
+            if self.activities and self.categories:
+                if on_done:
+                    on_done()
+                return #same thing, no need to repopulate
+
+        # anything still coming is for what was typed before
+        if self._request:
+            self._request.cancel()
 
         self.filter = self.get_text().decode('utf8', 'replace')[:cursor]
         fact = stuff.Fact(self.filter)
+        self._on_suggestions = on_done
+
+        def on_activities(activities):
+            if not activities and fact.activity:
+                # nothing starts like that, might be a typo
+                self._request = runtime.storage.get_matches_async(on_matches, fact.activity, "activity")
+                return
+
+            show_activities(activities)
+
+        def on_matches(matches):
+            show_activities([{"name": match["name"], "category": match["category"]}
+                                                            for match in matches], True)
+
+        def show_activities(activities, fuzzy = False):
+            self._request = None
+
+            # do not cache as ordering and available options change over time
+            self.activities = activities
+            self.external_activities = self.external.get_activities(fact.activity)
+            self.activities.extend(self.external_activities)
+
+            if self.filter.find("@") > 0:
+                # the storage knows best which categories are meant
+                key = self.filter[self.filter.find("@")+1:]
+                if key:
+                    self._request = runtime.storage.get_matches_async(on_category_matches, key, "category")
+                    return
+                show_suggestions([category['name'] for category in self.categories])
+            else:
+                show_suggestions([], fuzzy)
+
+        def on_category_matches(matches):
+            show_suggestions([match["category"] for match in matches], True)
 
-        # do not cache as ordering and available options change over time
-        self.activities = runtime.storage.get_activities(fact.activity)
-        self.external_activities = self.external.get_activities(fact.activity)
-        self.activities.extend(self.external_activities)
+        def show_suggestions(categories, fuzzy = False):
+            self._request = None
+            self.fuzzy = fuzzy
 
-        self.categories = self.categories or runtime.storage.get_categories()
+            self.fill_suggestions(fact, categories)
+            if self._on_suggestions:
+                self._on_suggestions()
 
+        def on_categories(categories):
+            self.categories = categories
+            self._request = runtime.storage.get_activities_async(on_activities, fact.activity)
 
+        if self.categories:
+            on_categories(self.categories)
+        else:
+            self._request = runtime.storage.get_categories_async(on_categories)
+
+    def fill_suggestions(self, fact, categories):
         time = ''
         if fact.start_time:
             time = fact.start_time.strftime("%H:%M")
@@ -252,11 +316,9 @@ class ActivityEntry(gtk.Entry):
         store.clear()
 
         if self.filter.find("@") > 0:
-            key = self.filter[self.filter.find("@")+1:].decode('utf8', 'replace').lower()
-            for category in self.categories:
-                if key in category['name'].decode('utf8', 'replace').lower():
-                    fillable = (self.filter[:self.filter.find("@") + 1] + category['name'])
-                    store.append([fillable, category['name'], fillable, time])
+            for category in categories:
+                fillable = (self.filter[:self.filter.find("@") + 1] + category)
+                store.append([fillable, category, fillable, time])
         else:
             key = fact.activity.decode('utf8', 'replace').lower()
             for activity in self.activities:
@@ -272,6 +334,12 @@ class ActivityEntry(gtk.Entry):
     def after_activity_update(self, widget):
         self.refresh_activities()
 
+    def after_external_update(self, source):
+        # the todo items came in after the suggestions were filled
+        self.filter = None
+        if self.popup.get_property("visible"):
+            self.populate_suggestions(self.show_popup)
+
     def _on_focus_out_event(self, widget, event):
         self.hide_popup()
 
@@ -279,8 +347,7 @@ class ActivityEntry(gtk.Entry):
         self.news = True
 
     def _on_button_press_event(self, button, event):
-        self.populate_suggestions()
-        self.show_popup()
+        self.populate_suggestions(self.show_popup)
 
     def _on_key_release_event(self, entry, event):
         if (event.keyval in (gtk.keysyms.Return, gtk.keysyms.KP_Enter)):
@@ -301,11 +368,12 @@ class ActivityEntry(gtk.Entry):
         elif event.keyval in (gtk.keysyms.Up, gtk.keysyms.Down):
             return False
         else:
-            self.populate_suggestions()
-            self.show_popup()
-
-            if event.keyval not in (gtk.keysyms.Delete, gtk.keysyms.BackSpace):
-                self.complete_inline()
+            complete = event.keyval not in (gtk.keysyms.Delete, gtk.keysyms.BackSpace)
+            def on_suggestions():
+                self.show_popup()
+                if complete:
+                    self.complete_inline()
+            self.populate_suggestions(on_suggestions)
 
 
 
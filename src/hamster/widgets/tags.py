@@ -31,7 +31,7 @@ class TagsEntry(gtk.Entry):
 
     def __init__(self):
         gtk.Entry.__init__(self)
-        self.tags = None
+        self.vocabulary = runtime.storage.get_tag_vocabulary()
         self.filter = None # currently applied filter string
         self.filter_tags = [] #filtered tags
 
@@ -58,23 +58,15 @@ class TagsEntry(gtk.Entry):
 
         self._parent_click_watcher = None # bit lame but works
 
-        self.external_listeners = [
-            (runtime.storage, runtime.storage.connect('tags-changed', self.refresh_tags))
-        ]
         self.show()
         self.populate_suggestions()
         self.connect("destroy", self.on_destroy)
 
     def on_destroy(self, window):
-        for obj, handler in self.external_listeners:
-            obj.disconnect(handler)
         self.popup.destroy()
         self.popup = None
 
 
-    def refresh_tags(self, event):
-        self.tags = None
-
     def get_tags(self):
         # splits the string by comma and filters out blanks
         return [tag.strip() for tag in self.get_text().decode('utf8', 'replace').split(",") if tag.strip()]
@@ -149,8 +141,6 @@ class TagsEntry(gtk.Entry):
         self.categories = None
 
     def populate_suggestions(self):
-        self.tags = self.tags or [tag["name"] for tag in runtime.storage.get_tags(only_autocomplete=True)]
-
         cursor_tag = self.get_cursor_tag()
 
         self.filter = cursor_tag
@@ -158,7 +148,7 @@ class TagsEntry(gtk.Entry):
         entered_tags = self.get_tags()
         self.tag_box.selected_tags = entered_tags
 
-        self.filter_tags = [tag for tag in self.tags if (tag or "").lower().startswith((self.filter or "").lower())]
+        self.filter_tags = self.vocabulary.find(self.filter or "")
 
         self.tag_box.draw(self.filter_tags)
 
@@ -0,0 +1,656 @@
+#!/usr/bin/env python
+# - coding: utf-8 -
+"""Storage benchmarks, run on a generated database.
+
+The storage registers itself on the session bus, so to stay clear of a
+running hamster-service, start the benchmarks on a private bus:
+
+    dbus-launch python tests/db_benchmark.py BENCHMARK [FACTS [DAYS]]
+"""
+import sys, os.path
+# a convoluted line to add hamster module to absolute path
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import tempfile, shutil, random, time, itertools, mmap, csv
+import datetime as dt
+
+# the database goes to a throwaway location. has to be set before the
+# storage is imported as xdg reads it on import
+DATA_HOME = tempfile.mkdtemp(prefix = "hamster-benchmark-")
+os.environ["XDG_DATA_HOME"] = DATA_HOME
+
+from hamster.lib import i18n
+i18n.setup_i18n()
+
+import gobject
+from hamster import db, external
+from hamster.client import from_dbus_fact
+from hamster.lib import factpack
+
+
+def populate(storage, facts, days = None, activities = 200, categories = 20, tags = 50, tags_per_fact = 3):
+    """fill the storage with back-to-back facts of random length that
+       end right about now. facts are spread over the given number of days,
+       by default they come in slots of 80 minutes"""
+    random.seed(1)
+    storage.start_transaction()
+
+    storage.executemany("INSERT INTO categories (name, search_name) VALUES (?, ?)",
+                        [("Category %d" % i, "category %d" % i) for i in range(categories)])
+    category_ids = [row[0] for row in storage.fetchall("SELECT id FROM categories")]
+
+    storage.executemany("INSERT INTO activities (name, search_name, category_id) VALUES (?, ?, ?)",
+                        [("Activity %d" % i, "activity %d" % i, random.choice(category_ids))
+                                                            for i in range(activities)])
+    activity_ids = [row[0] for row in storage.fetchall("SELECT id FROM activities")]
+
+    storage.executemany("INSERT INTO tags (name) VALUES (?)",
+                        [("tag%d" % i,) for i in range(tags)])
+    tag_ids = [row[0] for row in storage.fetchall("SELECT id FROM tags")]
+
+    slot = days * 1440 / facts if days else 80
+
+    fact_rows, tag_rows = [], []
+    start_time = dt.datetime.now().replace(second = 0, microsecond = 0) \
+                                          - dt.timedelta(minutes = slot * facts)
+    first_id = (storage.fetchone("SELECT max(id) FROM facts")[0] or 0) + 1
+    for fact_id in range(first_id, first_id + facts):
+        end_time = start_time + dt.timedelta(minutes = random.randint(max(slot / 16, 1), slot * 3 / 2))
+        fact_rows.append((fact_id, random.choice(activity_ids),
+                          start_time, end_time, "description %d" % fact_id))
+
+        for tag_id in random.sample(tag_ids, random.randint(0, tags_per_fact)):
+            tag_rows.append((fact_id, tag_id))
+
+        start_time = end_time + dt.timedelta(minutes = random.randint(0, slot * 3 / 8))
+
+    storage.executemany("""INSERT INTO facts (id, activity_id, start_time, end_time, description)
+                                VALUES (?, ?, ?, ?, ?)""", fact_rows)
+    storage.executemany("INSERT INTO fact_tags (fact_id, tag_id) VALUES (?, ?)", tag_rows)
+
+    storage.end_transaction()
+
+
+def fact_range(storage):
+    """first and last date of the facts in storage"""
+    res = storage.fetchone("SELECT min(fact_date), max(fact_date) FROM facts")
+    return [db.from_epoch(date).date() for date in res]
+
+
+def measure(label, func, repeat = 3):
+    """prints the best time out of the runs, returns result of the last one"""
+    timings = []
+    for i in range(repeat):
+        started = time.time()
+        res = func()
+        timings.append(time.time() - started)
+
+    print "%-50s %9.3fs" % (label, min(timings))
+    return res
+
+
+
+def bench_tags(storage):
+    """one row per fact and tag, grouped in python, against tags packed
+       with group_concat"""
+    start_date, end_date = fact_range(storage)
+
+    legacy_query = """
+                   SELECT a.id AS id,
+                          a.start_time AS start_time,
+                          a.end_time AS end_time,
+                          a.description as description,
+                          b.name AS name, b.id as activity_id,
+                          coalesce(c.name, ?) as category,
+                          a.fact_date as date,
+                          e.name as tag
+                     FROM facts a
+                LEFT JOIN activities b ON a.activity_id = b.id
+                LEFT JOIN categories c ON b.category_id = c.id
+                LEFT JOIN fact_tags d ON d.fact_id = a.id
+                LEFT JOIN tags e ON e.id = d.tag_id
+                    WHERE a.fact_date BETWEEN ? AND ?
+                 ORDER BY a.start_time, e.name
+    """
+    def row_per_tag():
+        rows = storage.fetchall(legacy_query, (_("Unsorted"), start_date, end_date))
+        keys = ["id", "start_time", "end_time", "description", "name",
+                "activity_id", "category", "date"]
+        facts = []
+        for fact_id, fact_tags in itertools.groupby(rows, lambda f: f["id"]):
+            fact_tags = list(fact_tags)
+            fact = dict([(key, fact_tags[0][key]) for key in keys])
+            fact["tags"] = [ft["tag"] for ft in fact_tags if ft["tag"]]
+            facts.append(fact)
+        return facts
+
+    def packed():
+        return storage._Storage__get_facts(start_date, end_date)
+
+    grouped = measure("row per tag, itertools.groupby", row_per_tag)
+    facts = measure("group_concat, __get_facts", packed)
+    assert len(grouped) == len(facts)
+
+
+def bench_get_facts(storage):
+    """GetFacts over a week, a month and a year of facts"""
+    start_date, end_date = fact_range(storage)
+    end = db.to_epoch(end_date)
+
+    for label, days in (("week", 7), ("month", 30), ("year", 365)):
+        start = db.to_epoch(max(end_date - dt.timedelta(days = days - 1), start_date))
+        facts = measure("GetFacts, one %s" % label,
+                        lambda: storage.GetFacts(start, end, ""))
+        print "%50s %9d facts" % ("", len(facts))
+
+
+def bench_totals(storage):
+    """category totals of a year: summed up from GetFacts against GetTotals"""
+    start_date, end_date = fact_range(storage)
+    start, end = db.to_epoch(start_date), db.to_epoch(end_date)
+
+    def from_facts():
+        totals = {}
+        for fact in storage.GetFacts(start, end, ""):
+            totals[fact[6]] = totals.get(fact[6], 0) + fact[9]
+        return totals
+
+    def get_totals():
+        return storage.GetTotals(start, end, "category", "", [], [], [])
+
+    summed = measure("GetFacts, summed up in python", from_facts)
+    totals = measure("GetTotals", get_totals)
+    assert sorted(summed.items()) == [(key, duration) for key, duration, count in totals]
+
+
+def bench_rollups(storage):
+    """all-time totals by day and by category from the rollups against
+       summing up the facts, then the rollups are checked against the facts"""
+    start_date, end_date = fact_range(storage)
+    start, end = db.to_epoch(start_date), db.to_epoch(end_date)
+
+    by_day = """SELECT fact_date, sum(end_time - start_time), count(*)
+                  FROM facts
+                 WHERE end_time IS NOT NULL
+                   AND fact_date BETWEEN ? AND ?
+              GROUP BY fact_date"""
+    by_category = """SELECT coalesce(c.name, ?), sum(a.end_time - a.start_time), count(*)
+                       FROM facts a
+                  LEFT JOIN activities b ON a.activity_id = b.id
+                  LEFT JOIN categories c ON b.category_id = c.id
+                      WHERE a.end_time IS NOT NULL
+                        AND a.fact_date BETWEEN ? AND ?
+                   GROUP BY 1"""
+
+    measure("daily totals, summing up facts",
+            lambda: storage.fetchall(by_day, (start, end)))
+    measure("daily totals, GetTotals from rollups",
+            lambda: storage.GetTotals(start, end, "day", "", [], [], []))
+    measure("category totals, summing up facts",
+            lambda: storage.fetchall(by_category, (_("Unsorted"), start, end)))
+    measure("category totals, GetTotals from rollups",
+            lambda: storage.GetTotals(start, end, "category", "", [], [], []))
+    measure("checking rollups", lambda: storage.CheckRollups(False), repeat = 1)
+    assert storage.CheckRollups(False) == 0
+
+
+def bench_pages(storage):
+    """all facts in one GetFacts against GetFactsPage a page at a time"""
+    start_date, end_date = fact_range(storage)
+    start, end = db.to_epoch(start_date), db.to_epoch(end_date)
+
+    def pages(page_size):
+        cursor, count, biggest = "", 0, 0
+        while True:
+            facts, cursor = storage.GetFactsPage(start, end, "", cursor, page_size)
+            count += len(facts)
+            biggest = max(biggest, len(facts))
+            if not cursor:
+                return count, biggest
+
+    facts = measure("GetFacts", lambda: storage.GetFacts(start, end, ""))
+    for page_size in (100, 500, 5000):
+        count, biggest = measure("GetFactsPage, %d per page" % page_size,
+                                 lambda: pages(page_size))
+        assert count == len(facts) and biggest <= page_size
+
+
+def bench_fd(storage):
+    """all facts through GetFacts against a pack handed over in a file"""
+    start_date, end_date = fact_range(storage)
+    start, end = db.to_epoch(start_date), db.to_epoch(end_date)
+
+    def get_facts():
+        return [from_dbus_fact(fact) for fact in storage.GetFacts(start, end, "")]
+
+    def get_packed(factory = from_dbus_fact):
+        fd = storage.GetFactsFd(start, end, "").take()
+        try:
+            packed = mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        return factpack.FactReader(packed, factory)
+
+    measure("GetFacts, rows", lambda: storage.GetFacts(start, end, ""))
+    measure("GetFactsFd, rows", lambda: list(get_packed(None)))
+    facts = measure("GetFacts, from_dbus_fact", get_facts)
+    measure("GetFactsFd, first fact", lambda: get_packed()[0])
+    packed = measure("GetFactsFd, all facts", lambda: list(get_packed()))
+    assert [fact.id for fact in facts] == [fact.id for fact in packed]
+
+
+def bench_cache(storage):
+    """clients polling today's facts and the week with an edit now and then,
+       with and without the result cache"""
+    start_date, end_date = fact_range(storage)
+    start, end = db.to_epoch(end_date - dt.timedelta(days = 6)), db.to_epoch(end_date)
+    fact_id = storage.GetFacts(start, end, "")[0][0]
+
+    def poll():
+        for i in range(100):
+            if i % 10 == 0:
+                # edit a fact of the week, and one a couple of weeks back
+                storage.execute("UPDATE facts SET description = ? WHERE id IN (?, ?)",
+                                ("edit %d" % i, fact_id, fact_id - 2000))
+            storage.GetTodaysFacts()
+            storage.GetFacts(start, end, "")
+            storage.GetFacts(start - 365 * 86400, start - 358 * 86400, "")
+
+    cache = storage._Storage__results
+    storage._Storage__results = db.ResultCache(0)
+    measure("100 polls, no cache", poll, repeat = 1)
+
+    storage._Storage__results = cache
+    measure("100 polls, result cache", poll, repeat = 1)
+    stats = storage.GetCacheStats()
+    print "hit rate %.2f, %d invalidations" % (stats["result_hit_rate"], stats["result_invalidations"])
+
+
+def bench_batch(storage):
+    """a thousand facts added one by one against in a single batch"""
+    def facts(days_back):
+        # further back than the populated facts, so the runs don't overlap
+        # anything. facts in the future would get rolled back into today
+        start = db.to_epoch(dt.datetime.now()) - days_back * 86400
+        return [("AddFact", ["Activity %d@Category %d, batched #tag%d" % (i % 200, i % 20, i % 50),
+                             start + i * 600, start + i * 600 + 300, False])
+                                                            for i in range(1000)]
+
+    def one_by_one():
+        for name, args in facts(800):
+            storage.AddFact(*args)
+
+    measure("1000 AddFact", one_by_one, repeat = 1)
+    measure("Batch of 1000 AddFact", lambda: storage.Batch(facts(400)), repeat = 1)
+
+def bench_import(storage):
+    """a hundred thousand facts imported from a TSV export, then the same
+       file again, all of it duplicates"""
+    random.seed(2)
+    path = os.path.join(DATA_HOME, "export.tsv")
+    with open(path, "w") as export:
+        writer = csv.writer(export, dialect = 'excel-tab')
+        writer.writerow(["activity", "start time", "end time", "duration minutes",
+                         "category", "description", "tags"])
+
+        # back to back, before the populated facts
+        start_time = db.from_epoch(storage.fetchone("SELECT min(start_time) FROM facts")[0])
+        start_time -= dt.timedelta(minutes = 60 * 100000)
+        for i in range(100000):
+            end_time = start_time + dt.timedelta(minutes = random.randint(5, 60))
+            writer.writerow(["Imported %d" % random.randint(0, 300),
+                             start_time.strftime("%Y-%m-%d %H:%M:%S"),
+                             end_time.strftime("%Y-%m-%d %H:%M:%S"),
+                             (end_time - start_time).seconds / 60,
+                             "Category %d" % random.randint(0, 30),
+                             "description %d" % i,
+                             ", ".join(random.sample(["tag%d" % t for t in range(80)],
+                                                     random.randint(0, 3)))])
+            start_time = end_time
+
+    for label in ("ImportFacts of 100000 facts", "ImportFacts of 100000 duplicates"):
+        imported, skipped = measure(label, lambda: storage.ImportFacts(path, ""), repeat = 1)
+        print "    %d imported, %d skipped" % (imported, skipped)
+
+def bench_overlaps(storage):
+    """looking up conflicts with range conditions against the span index,
+       adding and editing facts in the middle of the history and repairing
+       a thousand overlaps in one go"""
+    random.seed(3)
+    first, last = storage.fetchone("SELECT min(start_time), max(start_time) FROM facts")
+    intervals = []
+    for i in range(200):
+        start = random.randint(first, last - 86400)
+        intervals.append((start, start + random.randint(600, 4 * 3600)))
+
+    legacy_query = """
+               SELECT a.*, b.name, c.name as category
+                 FROM facts a
+            LEFT JOIN activities b on b.id = a.activity_id
+            LEFT JOIN categories c on b.category_id = c.id
+                WHERE (end_time > ? and end_time < ?)
+                   OR (start_time > ? and start_time < ?)
+                   OR (start_time < ? and end_time > ?)
+             ORDER BY start_time
+    """
+    span_query = """
+               SELECT a.*, b.name, c.name as category
+                 FROM fact_spans s
+                 JOIN facts a ON a.id = s.id
+            LEFT JOIN activities b on b.id = a.activity_id
+            LEFT JOIN categories c on b.category_id = c.id
+                WHERE s.start_time < :end AND s.end_time > :start
+                  AND ((a.end_time > :start and a.end_time < :end)
+                       OR (a.start_time > :start and a.start_time < :end)
+                       OR (a.start_time < :start and a.end_time > :end))
+             ORDER BY a.start_time
+    """
+    def legacy():
+        return [len(storage.fetchall(legacy_query, (start, end) * 3)) for start, end in intervals]
+    def span_index():
+        return [len(storage.fetchall(span_query, {"start": start, "end": end})) for start, end in intervals]
+
+    assert measure("200 conflict lookups, range conditions", legacy, repeat = 1) == \
+           measure("200 conflict lookups, span index", span_index)
+
+    def add():
+        for start, end in intervals[:100]:
+            storage.AddFact("Activity 1@Category 1", start, end, False)
+    measure("100 AddFact in the past", add, repeat = 1)
+
+    def add_ongoing():
+        for start, end in intervals[100:]:
+            storage.AddFact("Activity 2@Category 2", start, 0, False)
+    measure("100 ongoing AddFact in the past", add_ongoing, repeat = 1)
+
+    fact_ids = [row[0] for row in storage.fetchall("SELECT id FROM facts WHERE start_time BETWEEN ? AND ?",
+                                                   (first, last - 86400))]
+    def edit():
+        for fact_id, (start, end) in zip(random.sample(fact_ids, 100), intervals):
+            storage.UpdateFact(fact_id, "Activity 3@Category 3", start + 1800, end + 1800, False)
+    measure("100 UpdateFact", edit, repeat = 1)
+
+    # conflicts put in past the overlap solving
+    activity_ids = [row[0] for row in storage.fetchall("SELECT id FROM activities")]
+    rows = []
+    for i in range(1000):
+        start = random.randint(first, last - 86400)
+        rows.append((random.choice(activity_ids), start, start + random.randint(600, 4 * 3600)))
+    storage.executemany("INSERT INTO facts (activity_id, start_time, end_time) VALUES (?, ?, ?)", rows)
+    overlaps = measure("RepairOverlaps after 1000 conflicting inserts", storage.RepairOverlaps, repeat = 1)
+    print "    %d overlaps, %d remain" % (overlaps, storage.RepairOverlaps())
+
+def bench_contention(storage):
+    """AddFact and StopTracking while clients keep asking for all the facts,
+       with the reads answered on the main loop against in reader threads"""
+    start_date, end_date = fact_range(storage)
+    start, end = db.to_epoch(start_date), db.to_epoch(end_date)
+    context = gobject.main_context_default()
+
+    def fail(error):
+        raise error
+
+    def mixed(threaded):
+        replies, write_times = [], []
+        for i in range(20):
+            if threaded:
+                storage.GetFacts(start, end, "", reply_handler = replies.append,
+                                 error_handler = fail)
+            else:
+                replies.append(storage.GetFacts(start, end, ""))
+
+            started = time.time()
+            now = db.to_epoch(dt.datetime.now())
+            storage.AddFact("Activity %d@Category %d" % (i, i), now, 0, False)
+            storage.StopTracking(now + 60)
+            write_times.append(time.time() - started)
+
+        writes_done = time.time()
+        while len(replies) < 20:
+            context.iteration(True)
+        return writes_done, sorted(write_times)
+
+    for label, threaded in (("reads on the main loop", False), ("reader threads", True)):
+        started = time.time()
+        writes_done, write_times = mixed(threaded)
+        print "%-50s %9.3fs" % ("20 reads and writes, %s" % label, time.time() - started)
+        print "    writes done after %.3fs, median write %.3fs" % (writes_done - started,
+                                                                   write_times[10])
+
+def bench_writes(storage):
+    """single-row writes with the gio etag query that used to follow each of
+       them, against the writes alone, and the data_version check that now
+       runs on file change events"""
+    import gio
+    database_file = gio.File(storage.db_path)
+    random.seed(4)
+    fact_ids = random.sample([row[0] for row in storage.fetchall("SELECT id FROM facts")], 5000)
+
+    def writes(etag):
+        for i, fact_id in enumerate(fact_ids):
+            storage.execute("UPDATE facts SET description = ? WHERE id = ?",
+                            ("write %d" % i, fact_id))
+            if etag:
+                database_file.query_info(gio.FILE_ATTRIBUTE_ETAG_VALUE).get_etag()
+
+    measure("5000 writes, etag query after each", lambda: writes(True), repeat = 1)
+    measure("5000 writes", lambda: writes(False), repeat = 1)
+    measure("5000 data_version checks",
+            lambda: [storage._Storage__changed_externally() for i in range(5000)], repeat = 1)
+
+def bench_merge(storage):
+    """the database file replaced with a copy where a hundred facts differ:
+       what it takes to snapshot the facts and to merge the copy in"""
+    measure("snapshot of all facts", storage._Storage__take_snapshot)
+
+    storage.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    copy = os.path.join(DATA_HOME, "replacement.db")
+    shutil.copy(storage.db_path, copy)
+
+    random.seed(5)
+    fact_ids = random.sample([row[0] for row in storage.fetchall("SELECT id FROM facts")], 200)
+    con = db.sqlite.connect(copy)
+    con.executemany("UPDATE facts SET description = 'synced' WHERE id = ?", [(id,) for id in fact_ids[:100]])
+    con.executemany("DELETE FROM facts WHERE id = ?", [(id,) for id in fact_ids[100:]])
+    con.commit()
+    con.close()
+
+    # what on_db_file_change does when a new file has been put in place
+    os.rename(copy, storage.db_path)
+    storage.con = None
+    measure("merging the replaced file", storage._Storage__merge_replaced, repeat = 1)
+
+def add_activities(storage, count):
+    """adds activities named after a few common words and spreads the facts
+       over them, so that there is usage to rank by. returns the names"""
+    random.seed(6)
+    words = ["meeting", "review", "reading", "research", "writing", "support",
+             "planning", "design", "testing", "travel", "lunch", "email"]
+    names = ["%s %s %d" % (random.choice(words), random.choice(words), i) for i in range(count)]
+    storage.executemany("INSERT INTO activities (name, search_name, category_id) VALUES (?, ?, -1)",
+                        [(name, name.lower()) for name in names])
+
+    activity_ids = [row[0] for row in storage.fetchall("SELECT id FROM activities")]
+    fact_ids = [row[0] for row in storage.fetchall("SELECT id FROM facts")]
+    storage.executemany("UPDATE facts SET activity_id = ? WHERE id = ?",
+                        [(random.choice(activity_ids), fact_id) for fact_id in fact_ids])
+    return names
+
+def latencies(label, lookup, searches):
+    """prints median and 99th percentile of the lookup times"""
+    timings = []
+    for search in searches:
+        started = time.time()
+        lookup(search)
+        timings.append(time.time() - started)
+    timings.sort()
+    print "%-50s p50 %7.2fms p99 %7.2fms" % (label, timings[len(timings) / 2] * 1000,
+                                             timings[len(timings) * 99 / 100] * 1000)
+
+def bench_autocomplete(storage):
+    """typing activity names letter by letter with 20000 activities: the
+       query per keystroke against the in-memory index, as p50 and p99
+       latency"""
+    names = add_activities(storage, 20000)
+
+    legacy_query = """
+                   SELECT a.name AS name, b.name AS category
+                     FROM activities a
+                LEFT JOIN categories b ON coalesce(b.id, -1) = a.category_id
+                LEFT JOIN facts f ON a.id = f.activity_id
+                    WHERE deleted IS NULL
+                      AND a.search_name LIKE ? ESCAPE '\\'
+                 GROUP BY a.id
+                 ORDER BY max(f.start_time) DESC, lower(a.name)
+                    LIMIT 50
+    """
+    keystrokes = []
+    for name in random.sample(names, 100):
+        keystrokes.extend(name[:i] for i in range(len(name) + 1))
+
+    print "%d keystrokes" % len(keystrokes)
+    latencies("LIKE scan with facts joined",
+              lambda search: storage.fetchall(legacy_query, (search.lower() + "%",)), keystrokes)
+    measure("building the activity index", lambda: storage.GetActivities(""), repeat = 1)
+    latencies("activity index", storage.GetActivities, keystrokes)
+
+    assert [tuple(row) for row in storage.fetchall(legacy_query, ("rev%",))] == \
+           [(name, category or None) for name, category in storage.GetActivities("rev")]
+
+def bench_matches(storage):
+    """fuzzy matches of partly typed and misspelt names with 20000
+       activities, as p50 and p99 latency"""
+    names = add_activities(storage, 20000)
+
+    # every name typed part way, and with two letters swapped
+    searches = []
+    for name in random.sample(names, 200):
+        searches.append(name[:random.randint(3, len(name))])
+        i = random.randint(0, len(name) - 2)
+        searches.append(name[:i] + name[i + 1] + name[i] + name[i + 2:])
+
+    measure("building the trigram index", lambda: storage.GetMatches("", "", 10), repeat = 1)
+    latencies("GetMatches, %d searches" % len(searches),
+              lambda search: storage.GetMatches(search, "", 10), searches)
+
+    found = sum(1 for name in names[:200]
+                    if name in [match[1] for match in storage.GetMatches(name[:4] + name[5:], "activity", 10)])
+    print "    a letter left out, the name among the first ten: %d of 200" % found
+
+
+def bench_external(storage):
+    """typing against a task manager that takes 50ms to answer: asking it
+       on every keystroke, as the entry used to, against the tasks fetched
+       in the background and looked up in memory"""
+    tasks = external.MockTasks(count = 5000, delay = 0.05)
+    searches = [name[:length] for name in ("task 1234", "task 42", "task 4999")
+                                  for length in range(1, 10)]
+
+    latencies("asking on every keystroke",
+              lambda search: [task for task in tasks.get_tasks()
+                                  if task['name'].lower().startswith(search)], searches)
+
+    source = external.ActivitiesSource()
+    source.set_source("mock")
+    source.fetch = tasks.fetch
+
+    arrived = []
+    source.connect("activities-changed", lambda source: arrived.append(time.time()))
+    started = time.time()
+    latencies("while the tasks are on their way", source.get_activities, searches)
+    context = gobject.main_context_default()
+    while not arrived:
+        context.iteration(True)
+    print "%-50s %7.3fs" % ("tasks in", arrived[0] - started)
+
+    latencies("from memory", source.get_activities, searches)
+
+
+def bench_tagging(storage):
+    """10000 facts tagged with three out of 50 tags. tag ids looked up as
+       they used to be, with a query again after inserts, against
+       GetTagIds, and the facts of every tag counted as they used to be on
+       saving the autocomplete list, against the usage counts kept"""
+    random.seed(1)
+
+    def tag_lists(prefix):
+        names = ["%s%d" % (prefix, i) for i in range(50)]
+        return [random.sample(names, 3) for i in range(10000)]
+
+    def old_tag_ids(tags):
+        db_tags = storage.fetchall("SELECT * FROM tags WHERE name IN (%s)" % ",".join(["?"] * len(tags)), tags)
+        set_complete = [str(tag["id"]) for tag in db_tags if tag["autocomplete"] == "false"]
+        if set_complete:
+            storage.execute("UPDATE tags SET autocomplete = 'true' WHERE id IN (%s)" % ", ".join(set_complete))
+        add = set(tags) - set(tag["name"] for tag in db_tags)
+        if add:
+            storage.executemany("INSERT INTO tags (name) VALUES (?)", [(tag,) for tag in add])
+            return old_tag_ids(tags)
+        return db_tags
+
+    def looked_up_old():
+        storage.start_batch()
+        for tags in tag_lists("old"):
+            old_tag_ids(tags)
+        storage.end_batch()
+
+    measure("10000 tag lists, looked up as before", looked_up_old, repeat = 1)
+    measure("10000 tag lists, GetTagIds", lambda: storage.Batch([("GetTagIds", [tags])
+                                                                 for tags in tag_lists("new")]), repeat = 1)
+
+    start = db.to_epoch(dt.datetime.now()) - 3650 * 86400
+    facts = [("AddFact", ["Activity %d, #%s" % (i % 200, " #".join(tags)),
+                          start + i * 600, start + i * 600 + 300, False])
+                                            for i, tags in enumerate(tag_lists("tag"))]
+    measure("Batch of 10000 tagged AddFact", lambda: storage.Batch(facts), repeat = 1)
+
+    measure("counting the facts of every tag", lambda: storage.fetchall("""
+                   SELECT b.id AS id, b.autocomplete, count(a.fact_id) AS occurences
+                     FROM tags b
+                LEFT JOIN fact_tags a ON a.tag_id = b.id
+                    WHERE b.id NOT IN (%s)
+                 GROUP BY b.id""" % ",".join(["?"] * 25), range(1, 26)))
+    measure("SetTagsAutocomplete", lambda: storage.SetTagsAutocomplete(
+                                                ", ".join("tag%d" % i for i in range(25))), repeat = 1)
+
+
+BENCHMARKS = {
+    "tags": (bench_tags, 100000, None),
+    "getfacts": (bench_get_facts, 50000, 365),
+    "totals": (bench_totals, 50000, 365),
+    "rollups": (bench_rollups, 100000, 3650),
+    "pages": (bench_pages, 100000, 3650),
+    "fd": (bench_fd, 100000, 3650),
+    "cache": (bench_cache, 50000, 365),
+    "batch": (bench_batch, 10000, 365),
+    "import": (bench_import, 10000, 365),
+    "overlaps": (bench_overlaps, 1000000, 3650),
+    "contention": (bench_contention, 100000, 3650),
+    "writes": (bench_writes, 50000, 365),
+    "merge": (bench_merge, 100000, 3650),
+    "autocomplete": (bench_autocomplete, 100000, 3650),
+    "matches": (bench_matches, 100000, 3650),
+    "external": (bench_external, 0, None),
+    "tagging": (bench_tagging, 10000, 365),
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        sys.exit("Usage: %s {%s} [FACTS [DAYS]]" % (sys.argv[0], "|".join(sorted(BENCHMARKS))))
+
+    benchmark, facts, days = BENCHMARKS[sys.argv[1]]
+    if len(sys.argv) > 2:
+        facts = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        days = int(sys.argv[3])
+
+    try:
+        storage = db.Storage(gobject.MainLoop())
+        measure("populating %d facts" % facts, lambda: populate(storage, facts, days), repeat = 1)
+        if benchmark != bench_cache:
+            # repeated runs would be measuring the cache
+            storage._Storage__results = db.ResultCache(0)
+        benchmark(storage)
+    finally:
+        shutil.rmtree(DATA_HOME)
@@ -0,0 +1,54 @@
+# - coding: utf-8 -
+import sys, os.path
+# a convoluted line to add hamster module to absolute path
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import tempfile, shutil
+
+# the database goes to a throwaway location. has to be set before the
+# storage is imported as xdg reads it on import
+DATA_HOME = tempfile.mkdtemp(prefix = "hamster-test-")
+os.environ["XDG_DATA_HOME"] = DATA_HOME
+
+import unittest
+from hamster.lib import i18n
+i18n.setup_i18n()
+
+import gobject
+from hamster import db
+
+# overlapping records, sorted out on import
+TSV = """activity\tstart time\tend time\tduration minutes\tcategory\tdescription\ttags
+coding\t2010-03-09 09:00:00\t2010-03-09 11:00:00\t120\tWork\t\t
+email\t2010-03-09 10:00:00\t2010-03-09 10:30:00\t30\tWork\t\t
+meeting\t2010-03-09 10:45:00\t2010-03-09 12:00:00\t75\tWork\t\t
+"""
+
+class TestImport(unittest.TestCase):
+    def setUp(self):
+        self.storage = db.Storage(gobject.MainLoop())
+        self.path = os.path.join(DATA_HOME, "import.tsv")
+        with open(self.path, "w") as file:
+            file.write(TSV)
+
+    def get_facts(self):
+        return self.storage.fetchall("""SELECT a.id, b.name, a.start_time, a.end_time
+                                          FROM facts a
+                                          JOIN activities b ON b.id = a.activity_id
+                                      ORDER BY a.start_time, a.id""", as_tuples = True)
+
+    def test_import_twice(self):
+        self.assertEquals(self.storage.ImportFacts(self.path, ""), (3, 0))
+        facts = self.get_facts()
+        self.assertEquals([(name, end - start) for id, name, start, end in facts],
+                          [(u"coding", 3600), (u"email", 1800), (u"coding", 900), (u"meeting", 4500)])
+
+        self.assertEquals(self.storage.ImportFacts(self.path, ""), (0, 3))
+        self.assertEquals(self.get_facts(), facts)
+
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    finally:
+        shutil.rmtree(DATA_HOME)
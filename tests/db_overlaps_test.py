@@ -0,0 +1,53 @@
+# - coding: utf-8 -
+import sys, os.path
+# a convoluted line to add hamster module to absolute path
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import tempfile, shutil
+
+# the database goes to a throwaway location. has to be set before the
+# storage is imported as xdg reads it on import
+DATA_HOME = tempfile.mkdtemp(prefix = "hamster-test-")
+os.environ["XDG_DATA_HOME"] = DATA_HOME
+
+import unittest
+from hamster.lib import i18n
+i18n.setup_i18n()
+
+import calendar
+import datetime as dt
+import gobject
+from hamster import db
+
+START = calendar.timegm(dt.datetime(2010, 3, 9, 9, 0).timetuple())
+
+class TestOverlaps(unittest.TestCase):
+    def setUp(self):
+        self.storage = db.Storage(gobject.MainLoop())
+        self.storage.execute("DELETE FROM facts")
+
+    def get_facts(self):
+        return self.storage.fetchall("""SELECT b.name, a.start_time, a.end_time
+                                          FROM facts a
+                                          JOIN activities b ON b.id = a.activity_id
+                                      ORDER BY a.start_time, a.id""", as_tuples = True)
+
+    def test_ongoing_within(self):
+        # an ongoing fact that starts within the added one is left alone
+        self.storage.AddFact("reading", START + 3600, 0)
+        self.storage.AddFact("coding", START, START + 7200)
+        self.assertEquals(self.get_facts(), [(u"coding", START, START + 7200),
+                                             (u"reading", START + 3600, None)])
+
+    def test_overlap_start(self):
+        self.storage.AddFact("reading", START + 3600, START + 10800)
+        self.storage.AddFact("coding", START, START + 7200)
+        self.assertEquals(self.get_facts(), [(u"coding", START, START + 7200),
+                                             (u"reading", START + 7200, START + 10800)])
+
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    finally:
+        shutil.rmtree(DATA_HOME)
@@ -0,0 +1,66 @@
+# - coding: utf-8 -
+import sys, os.path
+# a convoluted line to add hamster module to absolute path
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import tempfile, shutil
+
+# the database goes to a throwaway location. has to be set before the
+# storage is imported as xdg reads it on import
+DATA_HOME = tempfile.mkdtemp(prefix = "hamster-test-")
+os.environ["XDG_DATA_HOME"] = DATA_HOME
+
+import unittest
+from hamster.lib import i18n
+i18n.setup_i18n()
+
+import calendar
+import datetime as dt
+import gobject
+from hamster import db
+
+START = calendar.timegm(dt.datetime(2010, 3, 9, 9, 0).timetuple())
+
+class TestTransactions(unittest.TestCase):
+    def setUp(self):
+        self.storage = db.Storage(gobject.MainLoop())
+
+    def count(self, table):
+        return self.storage.fetchone("SELECT count(*) FROM %s" % table, as_tuples = True)[0]
+
+    def test_cancel_with_new_tags(self):
+        facts, tags = self.count("facts"), self.count("tags")
+
+        self.storage.start_batch()
+        self.storage.AddFact("coding, #brand-new-tag", START, START + 3600)
+        self.storage.AddFact("email, #another-new-tag", START + 3600, START + 7200)
+        self.storage.cancel_batch()
+
+        self.assertEquals(self.count("facts"), facts)
+        self.assertEquals(self.count("tags"), tags)
+
+    def test_failed_batch_with_new_tags(self):
+        facts, tags = self.count("facts"), self.count("tags")
+
+        self.assertRaises(TypeError, self.storage.Batch,
+                          [("AddFact", ["coding, #batch-tag", START, START + 3600, False]),
+                           ("AddFact", ["email, #other-batch-tag", START + 3600, START + 7200, False]),
+                           ("AddFact", [])])
+
+        self.assertEquals(self.count("facts"), facts)
+        self.assertEquals(self.count("tags"), tags)
+
+    def test_no_tables_in_batch(self):
+        self.storage.start_batch()
+        try:
+            self.assertRaises(db.sqlite.ProgrammingError, self.storage.execute,
+                              "CREATE TABLE batch_table (id integer)")
+        finally:
+            self.storage.cancel_batch()
+
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    finally:
+        shutil.rmtree(DATA_HOME)
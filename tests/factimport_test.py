@@ -0,0 +1,71 @@
+# - coding: utf-8 -
+import sys, os.path
+# a convoluted line to add hamster module to absolute path
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+import datetime as dt
+from StringIO import StringIO
+from hamster.lib import factimport
+
+TSV = u"""activity\tstart time\tend time\tduration minutes\tcategory\tdescription\ttags
+reading\t2010-03-09 13:15:00\t2010-03-09 14:00:00\t45\tWork\tbook\ta, b
+rēading\t2010-03-09 14:00:00\t\t0\tUnsorted\tünicode\t
+"""
+
+XML = """<?xml version="1.0" ?><activities><activity category="Work" description="book" duration_minutes="45" end_time="2010-03-09 14:00:00" name="reading" start_time="2010-03-09 13:15:00" tags="a, b"/></activities>"""
+
+ICAL = """BEGIN:VCALENDAR
+VERSION:1.0
+BEGIN:VEVENT
+CATEGORIES:Work
+DTSTART:20100309T131500
+DTEND:20100309T140000
+SUMMARY:reading
+DESCRIPTION:first line
+second line: not a property
+END:VEVENT
+BEGIN:VEVENT
+CATEGORIES:None
+DTSTART;TZID=Europe/Riga:20100309T140000
+DTEND:20100309T150000
+SUMMARY:folded
+  summary
+DESCRIPTION:escaped\\, and\\nsplit
+END:VEVENT
+END:VCALENDAR
+"""
+
+START, END = dt.datetime(2010, 3, 9, 13, 15), dt.datetime(2010, 3, 9, 14, 0)
+
+class TestFactImport(unittest.TestCase):
+    def test_tsv(self):
+        records = list(factimport.read(StringIO(TSV.encode("utf-8")), "tsv"))
+        self.assertEquals(records[0], (u"reading", u"Work", u"book", [u"a", u"b"], START, END))
+        self.assertEquals(records[1], (u"rēading", u"Unsorted", u"ünicode", [], END, None))
+
+    def test_xml(self):
+        records = list(factimport.read(StringIO(XML), "xml"))
+        self.assertEquals(records, [(u"reading", u"Work", u"book", [u"a", u"b"], START, END)])
+
+    def test_ical(self):
+        records = list(factimport.read(StringIO(ICAL), "ical"))
+        self.assertEquals(records[0], (u"reading", u"Work", u"first line\nsecond line: not a property",
+                                       [], START, END))
+        self.assertEquals(records[1][:3], (u"folded summary", u"", u"escaped, and\nsplit"))
+        self.assertEquals(records[1][4], END)
+
+    def test_bad_times(self):
+        self.assertEquals(factimport.parse_time("2010-13-09 14:00"), None)
+        self.assertEquals(factimport.parse_time("yesterday"), None)
+        self.assertEquals(factimport.parse_time(" 2010-03-09 14:00"), END)
+
+    def test_guess_format(self):
+        self.assertEquals(factimport.guess_format("/tmp/Report.ICS"), "ical")
+        self.assertEquals(factimport.guess_format("/tmp/report.tsv"), "tsv")
+        self.assertEquals(factimport.guess_format("/tmp/report.html"), None)
+        self.assertRaises(ValueError, factimport.read, StringIO(""), "html")
+
+
+if __name__ == '__main__':
+    unittest.main()
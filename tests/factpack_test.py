@@ -0,0 +1,45 @@
+# - coding: utf-8 -
+import sys, os.path
+# a convoluted line to add hamster module to absolute path
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from StringIO import StringIO
+from hamster.lib import factpack
+
+FACTS = [
+    (1, 1000, 2000, u"", u"reading", 3, u"Work", [], 0, 1000),
+    (2, 2000, 0, u"with tags", u"writing", 4, u"Work", [u"a", u"b"], 0, 500),
+    (3, 3000, 3600, u"ünicode", u"rēading", 3, u"Unsorted", [u"b"], 86400, 600),
+]
+
+def packed(facts):
+    out = StringIO()
+    factpack.pack(facts, out)
+    return out.getvalue()
+
+class TestFactPack(unittest.TestCase):
+    def test_round_trip(self):
+        reader = factpack.FactReader(packed(FACTS))
+        self.assertEquals(len(reader), 3)
+        self.assertEquals(list(reader), FACTS)
+
+    def test_random_access(self):
+        reader = factpack.FactReader(packed(FACTS))
+        self.assertEquals(reader[-1], FACTS[-1])
+        self.assertEquals(reader[1][7], [u"a", u"b"])
+        self.assertRaises(IndexError, lambda: reader[3])
+
+    def test_empty(self):
+        self.assertEquals(list(factpack.FactReader(packed([]))), [])
+
+    def test_factory(self):
+        reader = factpack.FactReader(packed(FACTS), lambda fact: fact[0])
+        self.assertEquals(list(reader), [1, 2, 3])
+
+    def test_bad_version(self):
+        self.assertRaises(ValueError, factpack.FactReader, "HMFP\x09\x00" + "\x00" * 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# - coding: utf-8 -
+import sys, os.path
+# a convoluted line to add hamster module to absolute path
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from hamster.lib import trigrams
+
+NOW = 100 * 86400
+
+NAMES = [
+    (1, u"Reading news", 10, NOW - 86400),
+    (2, u"Research", 0, None),
+    (3, u"Writing", 50, NOW),
+    (4, u"Rēviewing", 1, NOW - 300 * 86400),
+]
+
+def keys(matches):
+    return [key for score, key in matches]
+
+class TestTrigrams(unittest.TestCase):
+    def test_trigrams(self):
+        self.assertEquals(trigrams.trigrams(u"Ab cd"),
+                          set([u"  a", u" ab", u"  c", u" cd"]))
+        self.assertEquals(trigrams.trigrams(u"  "), set())
+
+    def test_prefix(self):
+        index = trigrams.TrigramIndex(NAMES, NOW)
+        self.assertEquals(keys(index.find(u"rea", 10))[0], 1)
+        self.assertEquals(keys(index.find(u"rēv", 10))[0], 4)
+
+    def test_misspelt(self):
+        index = trigrams.TrigramIndex(NAMES, NOW)
+        self.assertEquals(keys(index.find(u"wirting", 10))[0], 3)
+        self.assertEquals(keys(index.find(u"news reding", 10))[0], 1)
+
+    def test_usage(self):
+        # same names, the used one comes first
+        index = trigrams.TrigramIndex([(1, u"design", 0, None), (2, u"design", 5, NOW)], NOW)
+        self.assertEquals(keys(index.find(u"design", 10)), [2, 1])
+
+    def test_no_match(self):
+        index = trigrams.TrigramIndex(NAMES, NOW)
+        self.assertEquals(index.find(u"xyz", 10), [])
+        self.assertEquals(index.find(u"", 10), [])
+        self.assertEquals(len(index.find(u"r", 2)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()